@@ -0,0 +1,149 @@
+"""
+Benchmark of decompress_lzss.py on synthetic complzss inputs, against the
+byte by byte port of lzss.c it replaced (kept below as the reference):
+$ python3 benchmark_lzss.py [--size-mb 16] [--seed 0] [--no-reference] [--no-compress]
+The inputs are random token streams shaped like a kernelcache: literals
+between short and long matches, mostly to recent history.
+The compressor is then run on the output, and its result decompressed again.
+"""
+
+from array import array
+import argparse
+import random
+import struct
+import time
+import zlib
+
+from decompress_lzss import N, F, THRESHOLD, complzss_header, compress_lzss, decompress_lzss
+
+
+def decompress_lzss_reference(data):
+    if data[:8] != b"complzss":
+        print('decompress_lzss: complzss magic missing')
+        return
+    decompsize = struct.unpack(">L", data[12:16])[0]
+    text_buf = array("B", b" " * (N + F - 1))
+    src = array("B", data[0x180:])
+    # srclen = len(src)
+    srclen = struct.unpack(">L", data[16:20])[0]
+    dst = array("B", b" " * decompsize)
+    r = N - F
+    srcidx, dstidx, flags, c = 0, 0, 0, 0
+
+    while True:
+        flags >>= 1
+        if ((flags & 0x100) == 0):
+            if (srcidx >= srclen):
+                break
+            c = src[srcidx]
+            srcidx += 1
+            flags = c | 0xFF00
+
+        if (flags & 1):
+            if (srcidx >= srclen):
+                break
+            c = src[srcidx]
+            srcidx += 1
+            dst[dstidx] = c
+            dstidx += 1
+            text_buf[r] = c
+            r += 1
+            r &= (N - 1)
+        else:
+            if (srcidx >= srclen):
+                break
+            i = src[srcidx]
+            srcidx += 1
+            if (srcidx >= srclen):
+                break
+            j = src[srcidx]
+            srcidx += 1
+            i |= ((j & 0xF0) << 4)
+            j = (j & 0x0F) + THRESHOLD
+            for k in range(j + 1):
+                c = text_buf[(i + k) & (N - 1)]
+                dst[dstidx] = c
+                dstidx += 1
+                text_buf[r] = c
+                r += 1
+                r &= (N - 1)
+    return dst.tobytes()
+
+
+def synthetic_complzss(size, seed=0):
+    """ A valid compressed stream that expands to about size bytes """
+    rand = random.Random(seed)
+    literals = bytes(rand.getrandbits(8) for _ in range(0x10000))
+    stream = bytearray()
+    produced = 0
+    while produced < size:
+        flags_at = len(stream)
+        stream.append(0)
+        flags = 0
+        for bit in range(8):
+            if rand.random() < 0.35:
+                flags |= 1 << bit
+                stream.append(literals[produced & 0xFFFF])
+                produced += 1
+                continue
+            length = rand.choice((3, 3, 4, 4, 5, 6, 8, 12, 18))
+            # mostly close, sometimes anywhere in the window
+            distance = rand.randint(1, 64) if rand.random() < 0.7 else rand.randint(1, N)
+            distance = min(distance, produced + N - F)
+            i = (produced + N - F - distance) & (N - 1)
+            stream.append(i & 0xFF)
+            stream.append(((i >> 4) & 0xF0) | (length - THRESHOLD - 1))
+            produced += length
+        stream[flags_at] = flags
+    data = complzss_header(0, produced, len(stream)) + bytes(stream)
+    # the checksum needs the output
+    adler32 = zlib.adler32(decompress_lzss(data))
+    return complzss_header(adler32, produced, len(stream)) + bytes(stream)
+
+
+def measure(function, data, repeat=1):
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(data)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=float, default=16)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-reference", action="store_true",
+                        help="skip the reference implementation, it is slow")
+    parser.add_argument("--no-compress", action="store_true",
+                        help="skip the compressor")
+    args = parser.parse_args()
+
+    data = synthetic_complzss(int(args.size_mb * 0x100000), args.seed)
+    decompsize = struct.unpack(">L", data[12:16])[0]
+    print("input: %d bytes compressed, %d bytes decompressed" % (len(data), decompsize))
+
+    seconds, fast = measure(decompress_lzss, data, args.repeat)
+    print("decompress_lzss:           %7.2fs %7.1f MB/s"
+          % (seconds, decompsize / seconds / 0x100000))
+    if not args.no_reference:
+        reference_seconds, reference = measure(decompress_lzss_reference, data)
+        print("decompress_lzss_reference: %7.2fs %7.1f MB/s"
+              % (reference_seconds, decompsize / reference_seconds / 0x100000))
+        print("speedup: %.1fx, outputs %s" % (reference_seconds / seconds,
+                                             "match" if fast == reference else "DIFFER"))
+    if args.no_compress:
+        return
+    # the compressor is much slower, once is enough
+    seconds, compressed = measure(compress_lzss, fast)
+    print("compress_lzss:             %7.2fs %7.1f MB/s, %d bytes (%.1f%%), round trip %s"
+          % (seconds, decompsize / seconds / 0x100000, len(compressed),
+             100.0 * len(compressed) / decompsize,
+             "match" if decompress_lzss(compressed) == fast else "DIFFER"))
+
+
+if __name__ == "__main__":
+    main()
@@ -18,70 +18,305 @@
  */
 """
 
-from array import array
+import argparse
+import mmap
 import struct
 import sys
+import zlib
 
 N = 4096
 F = 18
 THRESHOLD = 2
 NIL = N
+COMPLZSS_HEADER_SIZE = 0x180
 
 
-def decompress_lzss(data):
-    if data[:8] != b"complzss":
-        print('decompress_lzss: complzss magic missing')
-        return
-    decompsize = struct.unpack(">L", data[12:16])[0]
-    text_buf = array("B", b" " * (N + F - 1))
-    src = array("B", data[0x180:])
-    # srclen = len(src)
-    srclen = struct.unpack(">L", data[16:20])[0]
-    dst = array("B", b" " * decompsize)
-    r = N - F
-    srcidx, dstidx, flags, c = 0, 0, 0, 0
+def _flag_runs(flags):
+    """ The tokens a flag byte announces, lowest bit first:
+    n > 0 for n literals in a row, 0 for one match """
+    runs = []
+    for bit in range(8):
+        if (flags >> bit) & 1:
+            if runs and runs[-1] > 0:
+                runs[-1] += 1
+            else:
+                runs.append(1)
+        else:
+            runs.append(0)
+    return tuple(runs)
+
+
+FLAG_RUNS = [_flag_runs(flags) for flags in range(256)]
+# second byte of a match -> high bits of its ring index, length
+MATCH_HIGH_BITS = [(j & 0xF0) << 4 for j in range(256)]
+MATCH_LENGTH = [(j & 0x0F) + THRESHOLD + 1 for j in range(256)]
+# a flag byte and its eight tokens take at most that many bytes of input
+MAX_GROUP_SIZE = 1 + 8 * 2
+
+
+# output written at once by the streaming decompressor, besides the N bytes window
+STREAM_CHUNK_SIZE = 0x400000
+
+# the compressor looks back no further than the original encoder
+MAX_DISTANCE = N - F
+# candidates tried per position, the longest chains are runs of one byte
+COMPRESS_MAX_CHAIN = 32
+
+
+def _decode_groups(src, srcidx, group_end, dst, limit):
+    """ Whole flag groups, no bounds checks, until srcidx reaches group_end
+    or dst grows to limit. dst ends with the history window, returns srcidx.
+    """
+    dstidx = len(dst)
+    high_bits, match_length, flag_runs = MATCH_HIGH_BITS, MATCH_LENGTH, FLAG_RUNS
+    while srcidx < group_end and dstidx < limit:
+        runs = flag_runs[src[srcidx]]
+        srcidx += 1
+        for run in runs:
+            if run:
+                dst += src[srcidx:srcidx + run]
+                srcidx += run
+                dstidx += run
+                continue
+            j = src[srcidx + 1]
+            length = match_length[j]
+            # the ring index being written is (output size - F) & (N - 1)
+            start = dstidx - (((dstidx - F - 1 - (src[srcidx] | high_bits[j])) & (N - 1)) + 1)
+            srcidx += 2
+            if dstidx - start >= length:
+                dst += dst[start:start + length]
+            else:
+                # the match overlaps what it produces
+                dst += (dst[start:dstidx] * length)[:length]
+            dstidx += length
+    return srcidx
 
+
+def _decode_tail(src, srcidx, srclen, dst):
+    """ The last groups, the input may end anywhere """
+    dstidx = len(dst)
+    flags = 0
     while True:
         flags >>= 1
         if ((flags & 0x100) == 0):
             if (srcidx >= srclen):
                 break
-            c = src[srcidx]
+            flags = src[srcidx] | 0xFF00
             srcidx += 1
-            flags = c | 0xFF00
-
         if (flags & 1):
             if (srcidx >= srclen):
                 break
-            c = src[srcidx]
+            dst.append(src[srcidx])
             srcidx += 1
-            dst[dstidx] = c
             dstidx += 1
-            text_buf[r] = c
-            r += 1
-            r &= (N - 1)
         else:
-            if (srcidx >= srclen):
+            if (srcidx + 1 >= srclen):
                 break
-            i = src[srcidx]
-            srcidx += 1
-            if (srcidx >= srclen):
+            j = src[srcidx + 1]
+            start = dstidx - (((dstidx - F - 1 - (src[srcidx] | MATCH_HIGH_BITS[j])) &
+                               (N - 1)) + 1)
+            srcidx += 2
+            for k in range(MATCH_LENGTH[j]):
+                dst.append(dst[start + k])
+            dstidx += MATCH_LENGTH[j]
+
+
+def complzss_header(adler32, decompsize, compsize):
+    header = b"complzss" + struct.pack(">LLL", adler32, decompsize, compsize)
+    return header + b"\0" * (COMPLZSS_HEADER_SIZE - len(header))
+
+
+def _parse_header(data):
+    """ (adler32, decompsize, the compressed stream) """
+    if len(data) < COMPLZSS_HEADER_SIZE:
+        raise ValueError("truncated complzss header")
+    adler32, decompsize, srclen = struct.unpack(">LLL", data[8:20])
+    src = memoryview(data)[COMPLZSS_HEADER_SIZE:]
+    return adler32, decompsize, src[:min(srclen, len(src))]
+
+
+def decompress_lzss(data):
+    """ The output itself is the history window: it starts with the N spaces the
+    ring buffer of the original code is initialized with, and the ring index of
+    a match is turned into a distance back from the end of the output.
+    """
+    if data[:8] != b"complzss":
+        print('decompress_lzss: complzss magic missing')
+        return
+    _, decompsize, src = _parse_header(data)
+    dst = bytearray(b" ") * N
+    with src:
+        srcidx = _decode_groups(src, 0, len(src) - MAX_GROUP_SIZE, dst, sys.maxsize)
+        _decode_tail(src, srcidx, len(src), dst)
+    del dst[:N]
+    del dst[decompsize:]
+    # the original code leaves spaces after a short stream
+    dst += b" " * (decompsize - len(dst))
+    return bytes(dst)
+
+
+def decompress_lzss_stream(data, sink, chunk_size=STREAM_CHUNK_SIZE, progress=None):
+    """ Decompress to sink.write() in chunks, only the last N bytes of output are
+    kept between them. data may be an mmap, it is never copied.
+    progress(written, decompsize) is called after every chunk.
+    Raises ValueError when the output does not match the adler32 of the header.
+    Returns the size of the output.
+    """
+    if data[:8] != b"complzss":
+        raise ValueError("complzss magic missing")
+    adler32, decompsize, src = _parse_header(data)
+    group_end = len(src) - MAX_GROUP_SIZE
+    # history window, then the output not written yet from dst[pending]
+    dst = bytearray(b" ") * N
+    srcidx, pending, written, checksum = 0, N, 0, 1
+
+    def flush():
+        nonlocal pending, written, checksum
+        end = min(len(dst), pending + decompsize - written)
+        if end > pending:
+            with memoryview(dst)[pending:end] as chunk:
+                sink.write(chunk)
+                checksum = zlib.adler32(chunk, checksum)
+                written += len(chunk)
+        # whole windows are dropped, the ring index of an output byte is its
+        # position in dst modulo N
+        del dst[:(len(dst) - N) & ~(N - 1)]
+        pending = len(dst)
+        if progress is not None:
+            progress(written, decompsize)
+
+    # released on failure too, a view left on an mmap makes closing it raise
+    with src:
+        while True:
+            srcidx = _decode_groups(src, srcidx, group_end, dst, pending + chunk_size)
+            if srcidx >= group_end:
                 break
-            j = src[srcidx]
-            srcidx += 1
-            i |= ((j & 0xF0) << 4)
-            j = (j & 0x0F) + THRESHOLD
-            for k in range(j + 1):
-                c = text_buf[(i + k) & (N - 1)]
-                dst[dstidx] = c
-                dstidx += 1
-                text_buf[r] = c
-                r += 1
-                r &= (N - 1)
-    return dst.tobytes()
+            flush()
+        _decode_tail(src, srcidx, len(src), dst)
+        # the original code leaves spaces after a short stream
+        dst += b" " * (pending + decompsize - written - len(dst))
+        flush()
+    if checksum != adler32:
+        raise ValueError("adler32 mismatch: header 0x%08x, output 0x%08x" % (adler32, checksum))
+    return written
+
+
+def decompress_lzss_file(in_path, out_path, chunk_size=STREAM_CHUNK_SIZE, progress=None):
+    """ Stream in_path (mapped) to out_path, see decompress_lzss_stream """
+    with open(in_path, "rb") as in_file, \
+            mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+            open(out_path, "wb") as out_file:
+        return decompress_lzss_stream(data, out_file, chunk_size, progress)
+
+
+def print_progress(written, decompsize):
+    sys.stderr.write("\r%d / %d bytes" % (written, decompsize))
+    if written >= decompsize:
+        sys.stderr.write("\n")
+
+
+def _encode(data, max_chain):
+    """ The token stream of data, greedy. Every position is put in a hash chain
+    keyed by its first 3 bytes (the shortest match), the chain links live in a
+    ring of N entries since nothing older is reachable. The longest match among
+    max_chain candidates is taken.
+    """
+    size = len(data)
+    mask = N - 1
+    head = {}
+    head_get = head.get
+    chain = [-N] * N
+    # the last position a match can start at
+    last_key = size - THRESHOLD
+    out = bytearray()
+    flags_at, bit = 0, 0x100
+    pos = 0
+
+    while pos < size:
+        if bit == 0x100:
+            flags_at, bit = len(out), 1
+            out.append(0)
+        best_length = 0
+        if pos < last_key:
+            key = data[pos:pos + THRESHOLD + 1]
+            candidate = head_get(key, -N)
+            chain[pos & mask] = candidate
+            head[key] = pos
+            limit = F if pos + F <= size else size - pos
+            lowest = pos - MAX_DISTANCE
+            tries = max_chain
+            while candidate >= lowest and tries:
+                # the byte that would make it longer than the best so far
+                if data[candidate + best_length] == data[pos + best_length]:
+                    if data[candidate:candidate + limit] == data[pos:pos + limit]:
+                        best_length, best_distance = limit, pos - candidate
+                        break
+                    length = THRESHOLD + 1
+                    while data[candidate + length] == data[pos + length]:
+                        length += 1
+                    if length > best_length:
+                        best_length, best_distance = length, pos - candidate
+                candidate = chain[candidate & mask]
+                tries -= 1
+        if best_length:
+            i = (pos + N - F - best_distance) & mask
+            out.append(i & 0xFF)
+            out.append(((i >> 4) & 0xF0) | (best_length - THRESHOLD - 1))
+            # the positions inside the match go in the chains without a search
+            for skipped in range(pos + 1, min(pos + best_length, last_key)):
+                key = data[skipped:skipped + THRESHOLD + 1]
+                chain[skipped & mask] = head_get(key, -N)
+                head[key] = skipped
+            pos += best_length
+        else:
+            out[flags_at] |= bit
+            out.append(data[pos])
+            pos += 1
+        bit <<= 1
+    return out
+
+
+def compress_lzss(data, monitor=b"", max_chain=COMPRESS_MAX_CHAIN):
+    """ The complzss image of data, what decompress_lzss takes: the header with
+    the adler32 and sizes, the compressed stream and monitor appended after it
+    (see kernelcompressedextractmonitor.py).
+    """
+    data = bytes(data)
+    stream = _encode(data, max_chain)
+    return complzss_header(zlib.adler32(data), len(data), len(stream)) + stream + monitor
+
+
+def compress_lzss_file(in_path, out_path, monitor_path=None):
+    with open(in_path, "rb") as in_file:
+        data = in_file.read()
+    monitor = b""
+    if monitor_path is not None:
+        with open(monitor_path, "rb") as monitor_file:
+            monitor = monitor_file.read()
+    compressed = compress_lzss(data, monitor)
+    with open(out_path, "wb") as out_file:
+        out_file.write(compressed)
+    return len(compressed)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input")
+    parser.add_argument("output")
+    parser.add_argument("-c", "--compress", action="store_true",
+                        help="build the complzss image of input instead")
+    parser.add_argument("--monitor", help="file appended after the compressed kernel")
+    args = parser.parse_args()
+    if args.compress:
+        compress_lzss_file(args.input, args.output, args.monitor)
+        return
+    try:
+        decompress_lzss_file(args.input, args.output,
+                             progress=print_progress if sys.stderr.isatty() else None)
+    except ValueError as error:
+        print('decompress_lzss: %s' % error)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    data = decompress_lzss(open(sys.argv[1], "rb").read())
-    if data:
-        open(sys.argv[2], "wb").write(data)
+    main()
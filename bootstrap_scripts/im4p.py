@@ -0,0 +1,175 @@
+"""
+Find the payload of an IM4P image (kernelcache, device tree, ramdisk) and
+copy it out without decoding the whole file:
+IM4P ::= SEQUENCE { "IM4P", type, description, OCTET STRING payload, ... }
+optionally inside IMG4 ::= SEQUENCE { "IMG4", IM4P, ... }.
+Only the headers of the DER elements in front of the payload are read, the
+payload itself is copied from file to file by the kernel when possible.
+"""
+
+from collections import namedtuple
+import mmap
+import os
+import sys
+
+DER_OCTET_STRING = 0x04
+DER_IA5_STRING = 0x16
+DER_SEQUENCE = 0x30
+
+# the payload is copied in pieces of this size where the kernel can not do it
+COPY_CHUNK_SIZE = 0x1000000
+
+# offset and length - where the payload is in the file
+Im4pPayload = namedtuple("Im4pPayload", ["type", "description", "offset", "length"])
+
+
+def _der_header(data, offset, end):
+    """ (tag, offset of the contents, length of the contents) of the element at offset """
+    if offset >= end:
+        raise ValueError("truncated DER element at 0x%x" % offset)
+    tag = data[offset]
+    offset += 1
+    if tag & 0x1F == 0x1F:
+        # high tag number, in base 128
+        while offset < end and data[offset] & 0x80:
+            offset += 1
+        offset += 1
+    if offset >= end:
+        raise ValueError("truncated DER element at 0x%x" % offset)
+    length = data[offset]
+    offset += 1
+    if length == 0x80:
+        raise ValueError("indefinite length at 0x%x, not DER" % offset)
+    if length & 0x80:
+        size = length & 0x7F
+        length = int.from_bytes(data[offset:offset + size], "big")
+        offset += size
+    if offset + length > end:
+        raise ValueError("DER element at 0x%x runs past the end" % offset)
+    return tag, offset, length
+
+
+def _der_elements(data, offset, end):
+    """ The elements between offset and end, headers only """
+    while offset < end:
+        tag, start, length = _der_header(data, offset, end)
+        yield tag, start, length
+        offset = start + length
+
+
+def _der_string(data, element, name):
+    tag, start, length = element
+    if tag != DER_IA5_STRING:
+        raise ValueError("%s: unexpected element, tag 0x%02x" % (name, tag))
+    return bytes(data[start:start + length]).decode("ascii", "replace")
+
+
+def find_payload(data, payload_type=None):
+    """ Where the payload of the IM4P image in data is. data is any buffer, an
+    mmap of the file is only touched in front of the payload.
+    Raises ValueError if data is not an IM4P (or IMG4) image of payload_type.
+    """
+    end = len(data)
+    tag, start, length = _der_header(data, 0, end)
+    while True:
+        if tag != DER_SEQUENCE:
+            raise ValueError("unexpected element, tag 0x%02x" % tag)
+        elements = _der_elements(data, start, start + length)
+        try:
+            magic = _der_string(data, next(elements), "magic")
+            if magic != "IMG4":
+                break
+            tag, start, length = next(elements)
+        except StopIteration:
+            raise ValueError("sequence is truncated")
+    if magic != "IM4P":
+        raise ValueError("unexpected element: " + magic)
+    try:
+        image_type = _der_string(data, next(elements), "type")
+        description = _der_string(data, next(elements), "description")
+        tag, start, length = next(elements)
+    except StopIteration:
+        raise ValueError("IM4P sequence is truncated")
+    if payload_type is not None and image_type != payload_type:
+        raise ValueError("unexpected element: " + image_type)
+    if tag != DER_OCTET_STRING:
+        raise ValueError("payload: unexpected element, tag 0x%02x" % tag)
+    return Im4pPayload(image_type, description, start, length)
+
+
+def decode(data, payload_type=None):
+    """ The payload as a memoryview of data, nothing is copied """
+    payload = find_payload(data, payload_type)
+    return memoryview(data)[payload.offset:payload.offset + payload.length]
+
+
+def _copy_file_range(in_fd, out_fd, offset, count):
+    return os.copy_file_range(in_fd, out_fd, count, offset)
+
+
+def _sendfile(in_fd, out_fd, offset, count):
+    return os.sendfile(out_fd, in_fd, offset, count)
+
+
+# both write at the position of out_fd and move it, the first that works is used
+KERNEL_COPIES = [copy for name, copy in (("copy_file_range", _copy_file_range),
+                                         ("sendfile", _sendfile)) if hasattr(os, name)]
+
+
+def copy_range(in_file, out_file, offset, length):
+    """ Append length bytes of in_file from offset to out_file, in the kernel
+    with copy_file_range or sendfile, through a mapping of in_file otherwise.
+    Raises ValueError when in_file ends before them.
+    """
+    out_file.flush()
+    in_fd, out_fd = in_file.fileno(), out_file.fileno()
+    copied = 0
+    for kernel_copy in KERNEL_COPIES:
+        try:
+            while copied < length:
+                count = kernel_copy(in_fd, out_fd, offset + copied, length - copied)
+                if count == 0:
+                    # end of in_file
+                    break
+                copied += count
+            break
+        except OSError:
+            # not between these files (file systems, or sendfile to a file on macOS)
+            pass
+    else:
+        with mmap.mmap(in_fd, 0, access=mmap.ACCESS_READ) as mapped, \
+                memoryview(mapped) as view:
+            while copied < length:
+                size = min(COPY_CHUNK_SIZE, length - copied)
+                with view[offset + copied:offset + copied + size] as chunk:
+                    if not chunk:
+                        break
+                    out_file.write(chunk)
+                    copied += len(chunk)
+    if copied != length:
+        raise ValueError("truncated input: 0x%x of 0x%x bytes at 0x%x"
+                         % (copied, length, offset))
+    return copied
+
+
+def extract_payload(in_path, out_path, payload_type=None):
+    """ Write the payload of the IM4P image in_path to out_path, returns its description """
+    with open(in_path, "rb") as in_file:
+        with mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            payload = find_payload(mapped, payload_type)
+        with open(out_path, "wb") as out_file:
+            copy_range(in_file, out_file, payload.offset, payload.length)
+    return payload
+
+
+def main(payload_type=None):
+    """ $ python3 <script> input output, payload_type is checked when given """
+    try:
+        extract_payload(sys.argv[1], sys.argv[2], payload_type)
+    except ValueError as error:
+        print("failed: " + str(error))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""
+Prepare the images QEMU boots from an extracted firmware (ipsw) directory,
+in one go instead of running the asn1*decode.py, decompress_lzss.py and
+kernelcompressedextractmonitor.py scripts one by one:
+$ python3 prepare_firmware.py firmware_dir output_dir [--jobs N] [--cache DIR]
+Every IM4P kernel, device tree and ramdisk found is prepared on a process
+pool: the payload is extracted, the kernel also decompressed and its secure
+monitor split off. The results are cached by the SHA-256 of the image, and
+the digests by path, size and mtime, so an unchanged firmware is only copied.
+<output_dir>/<path in firmware_dir>.out is the payload (decompressed for the
+kernel), <path>.monitor the secure monitor.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+import im4p
+from decompress_lzss import COMPLZSS_HEADER_SIZE, decompress_lzss_stream
+
+# the image types prepared, the rest of the firmware is skipped
+PREPARED_TYPES = ("krnl", "dtre", "rdsk")
+# bump when the outputs change, the older cache entries are not used
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "xnu-qemu-firmware")
+DIGESTS_FILE = "digests.json"
+
+
+def image_type(path):
+    """ The IM4P type of the file, None if it is not one; only its headers are read """
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return im4p.find_payload(mapped).type
+    except (ValueError, OSError):
+        # not an image, empty or unreadable
+        return None
+
+
+def find_images(firmware_dir):
+    """ [(path relative to firmware_dir, type)] of the images to prepare """
+    images = []
+    for root, dirs, files in os.walk(firmware_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            found = image_type(path)
+            if found in PREPARED_TYPES:
+                images.append((os.path.relpath(path, firmware_dir), found))
+    return images
+
+
+def file_digest(path):
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return hashlib.sha256(mapped).hexdigest()
+
+
+def _prepare_kernel(path, entry):
+    """ The decompressed kernel and the monitor that follows the compressed one """
+    with open(path, "rb") as in_file, \
+            mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        payload = im4p.find_payload(mapped, "krnl")
+        with memoryview(mapped)[payload.offset:payload.offset + payload.length] as data:
+            with open(os.path.join(entry, "out"), "wb") as out_file:
+                decompress_lzss_stream(data, out_file)
+            monitor = COMPLZSS_HEADER_SIZE + struct.unpack(">L", data[16:20])[0]
+        if monitor < payload.length:
+            with open(os.path.join(entry, "monitor"), "wb") as monitor_file:
+                im4p.copy_range(in_file, monitor_file, payload.offset + monitor,
+                                payload.length - monitor)
+
+
+def prepare_image(path, image_type, cache_dir):
+    """ Runs in a worker: fill the cache entry of the image at path.
+    Returns (digest, seconds spent, whether the entry was there already).
+    """
+    start = time.perf_counter()
+    digest = file_digest(path)
+    entry = cache_entry(cache_dir, digest)
+    if os.path.isdir(entry):
+        return digest, time.perf_counter() - start, True
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    # built aside and renamed, a concurrent run sees a complete entry or none
+    building = tempfile.mkdtemp(dir=os.path.dirname(entry), prefix=".building-")
+    try:
+        if image_type == "krnl":
+            _prepare_kernel(path, building)
+        else:
+            im4p.extract_payload(path, os.path.join(building, "out"), image_type)
+        try:
+            os.rename(building, entry)
+        except OSError:
+            # another run was faster
+            if not os.path.isdir(entry):
+                raise
+    finally:
+        shutil.rmtree(building, ignore_errors=True)
+    return digest, time.perf_counter() - start, False
+
+
+def cache_entry(cache_dir, digest):
+    return os.path.join(cache_dir, "v%d" % CACHE_VERSION, digest[:2], digest)
+
+
+def load_digests(cache_dir):
+    """ realpath -> [size, mtime_ns, sha256] of the images seen before """
+    try:
+        with open(os.path.join(cache_dir, DIGESTS_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_digests(cache_dir, digests):
+    os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=cache_dir, delete=False) as f:
+        json.dump(digests, f)
+    os.replace(f.name, os.path.join(cache_dir, DIGESTS_FILE))
+
+
+def known_digest(digests, path):
+    """ The digest of path if it did not change since it was computed """
+    stat = os.stat(path)
+    known = digests.get(os.path.realpath(path))
+    if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return known[2]
+    return None
+
+
+def copy_outputs(entry, out_path):
+    """ The files of the cache entry to out_path.<name>, copied since they get patched """
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    outputs = []
+    for name in sorted(os.listdir(entry)):
+        shutil.copyfile(os.path.join(entry, name), out_path + "." + name)
+        outputs.append(out_path + "." + name)
+    return outputs
+
+
+def prepare_firmware(firmware_dir, output_dir, cache_dir=DEFAULT_CACHE_DIR, jobs=None):
+    """ Prepare every image of firmware_dir into output_dir.
+    Returns [(path, type, outputs, status)], status is "cached", "extracted"
+    or the error the image failed with.
+    """
+    digests = load_digests(cache_dir)
+    results = []
+    pending = {}
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for relpath, found in find_images(firmware_dir):
+            path = os.path.join(firmware_dir, relpath)
+            digest = known_digest(digests, path)
+            if digest is not None and os.path.isdir(cache_entry(cache_dir, digest)):
+                outputs = copy_outputs(cache_entry(cache_dir, digest),
+                                       os.path.join(output_dir, relpath))
+                results.append((relpath, found, outputs, "cached"))
+                continue
+            pending[relpath] = (found, executor.submit(prepare_image, path, found, cache_dir))
+        for relpath, (found, future) in pending.items():
+            path = os.path.join(firmware_dir, relpath)
+            try:
+                digest, seconds, cached = future.result()
+            except Exception as error:
+                # any worker failure is the image's, the others are still reported
+                results.append((relpath, found, [], str(error) or type(error).__name__))
+                continue
+            stat = os.stat(path)
+            digests[os.path.realpath(path)] = [stat.st_size, stat.st_mtime_ns, digest]
+            outputs = copy_outputs(cache_entry(cache_dir, digest),
+                                   os.path.join(output_dir, relpath))
+            results.append((relpath, found, outputs,
+                            "cached" if cached else "extracted in %.2fs" % seconds))
+    save_digests(cache_dir, digests)
+    return sorted(results)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("firmware_dir")
+    parser.add_argument("output_dir")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="worker processes, the number of cpus by default")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_DIR,
+                        help="where the prepared images are kept (%(default)s)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    results = prepare_firmware(args.firmware_dir, args.output_dir, args.cache, args.jobs)
+    failed = False
+    for relpath, found, outputs, status in results:
+        if not outputs:
+            failed = True
+            print("%s %s: failed: %s" % (found, relpath, status))
+            continue
+        print("%s %s: %s -> %s" % (found, relpath, status, ", ".join(outputs)))
+    print("%d images in %.2fs" % (len(results), time.perf_counter() - start))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
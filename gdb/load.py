@@ -2,33 +2,166 @@
 We want  to change  the code while still in gdb session. Pyhton wont import already loaded
 module. Taht is why we use reload module function. Please note that the ipmorts are not circular
 and their order in MODULES_TO_IPMORT matters.
+
+Sourcing this file is cheap: the commands are registered as stubs and the module
+implementing a command is imported the first time the command is used.
+Sourcing it again reloads only the modules whose files changed (and the modules
+after them in MODULES_TO_IPMORT, as they may depend on them).
+Set XNU_GDB_EAGER=1 in the environment to import everything right away.
 """
 import os
 import sys
+import time
+import hashlib
 import traceback
 import importlib
 import logging
+import gdb
 
 sys.path.insert(0, os.path.dirname(os.path.expanduser(__file__)))
 logging.getLogger("xnu").setLevel(logging.WARNING)
 MODULES_TO_IPMORT = [
     "xnu.constants",
     "xnu.utils",
+    "xnu.export",
+    "xnu.struct_layout",
     "xnu.sys_info",
     "xnu.zone",
     "xnu.xnu_types",
-    "xnu.tasks"
+    "xnu.tasks",
+    "xnu.snapshot",
+    "xnu.sample"
     ]
 
-try:
+# Every command and the module that registers it
+LAZY_COMMANDS = {
+    "xnu-threads": "xnu.tasks",
+    "xnu-bt-all": "xnu.tasks",
+    "xnu-tasks": "xnu.tasks",
+    "xnu-switch": "xnu.tasks",
+    "xnu-thread-info": "xnu.tasks",
+    "xnu-task-info": "xnu.tasks",
+    "xnu-voucher-info": "xnu.tasks",
+    "xnu-ipc-port-info": "xnu.tasks",
+    "xnu-ipc_entry-list": "xnu.tasks",
+    "xnu-port-rights": "xnu.tasks",
+    "xnu-cache": "xnu.tasks",
+    "xnu-profile": "xnu.tasks",
+    "xnu-zones": "xnu.zone",
+    "xnu-zone-walk": "xnu.zone",
+    "xnu-snapshot-save": "xnu.snapshot",
+    "xnu-sample": "xnu.sample",
+}
+
+EAGER_LOAD = os.environ.get("XNU_GDB_EAGER", "0") == "1"
+
+
+def module_path(module):
+    return os.path.join(os.path.dirname(os.path.expanduser(__file__)),
+                        *module.split(".")) + ".py"
+
+
+def file_digest(path):
+    with open(path, "rb") as module_file:
+        return hashlib.sha1(module_file.read()).hexdigest()
+
+
+def is_module_changed(module, stamps):
+    """ Cheap mtime/size check first, hash only files that were touched """
+    path = module_path(module)
+    stat = os.stat(path)
+    stamp = stamps.get(module)
+    if stamp is not None and stamp[:2] == (stat.st_mtime_ns, stat.st_size):
+        return False
+    digest = file_digest(path)
+    changed = stamp is None or stamp[2] != digest
+    stamps[module] = (stat.st_mtime_ns, stat.st_size, digest)
+    return changed
+
+
+def record_stamps(stamps):
+    for module in MODULES_TO_IPMORT:
+        if module in sys.modules and module not in stamps:
+            is_module_changed(module, stamps)
+
+
+def import_module(module, stamps, timings):
+    start = time.perf_counter()
+    importlib.import_module(module)
+    timings.append((module, time.perf_counter() - start))
+    record_stamps(stamps)
+
+
+def reload_changed_modules(stamps, timings):
+    """ Reload every loaded module that changed, and all loaded modules after it """
+    reload_rest = False
+    for module in MODULES_TO_IPMORT:
+        if module not in sys.modules:
+            continue
+        if is_module_changed(module, stamps) or reload_rest:
+            reload_rest = True
+            start = time.perf_counter()
+            importlib.reload(sys.modules[module])
+            timings.append((module, time.perf_counter() - start))
+
+
+def format_timings(timings):
+    return ", ".join(f"{module} {seconds * 1000:.1f}ms" for module, seconds in timings)
+
+
+class LazyCommand(gdb.Command):
+    """ Placeholder of an xnu command, its module is loaded on first use.
+    Run the command (or source load.py with XNU_GDB_EAGER=1) to get its real help.
+    """
+    def __init__(self, name, module, stamps):
+        super(LazyCommand, self).__init__(name, gdb.COMMAND_DATA)
+        self.name = name
+        self.module = module
+        self.stamps = stamps
+        self.tried = False
+
+    def invoke(self, arg, from_tty):
+        if self.tried:
+            raise gdb.GdbError(f"{self.module} did not register {self.name}")
+        self.tried = True
+        timings = []
+        try:
+            import_module(self.module, self.stamps, timings)
+        except Exception as error:
+            raise gdb.GdbError(f"Could not load {self.module}: {error} {traceback.format_exc()}")
+        gdb.write(f"xnu: loaded {format_timings(timings)}\n")
+        # the module registered the real command under the same name
+        gdb.execute(f"{self.name} {arg}", from_tty)
+
+
+def load():
+    start = time.perf_counter()
+    import xnu
+    # survives sourcing this file again, the package itself is never reloaded
+    stamps = xnu.__dict__.setdefault("_module_stamps", {})
+    timings = []
+
     #this will make python to look for new versions
     importlib.invalidate_caches()
-    for module in MODULES_TO_IPMORT:
+    reload_changed_modules(stamps, timings)
+    if EAGER_LOAD:
+        for module in MODULES_TO_IPMORT:
+            if module not in sys.modules:
+                import_module(module, stamps, timings)
+
+    stubs = 0
+    for name, module in LAZY_COMMANDS.items():
         if module not in sys.modules:
-            importlib.import_module(module)
-        else:
-            importlib.reload(importlib.import_module(module))
+            LazyCommand(name, module, stamps)
+            stubs += 1
 
+    gdb.write(f"xnu: ready in {(time.perf_counter() - start) * 1000:.1f}ms, "
+              f"{stubs} commands deferred, "
+              f"loaded: {format_timings(timings) if timings else 'nothing changed'}\n")
+
+
+try:
+    load()
 except Exception as error:
     gdb.write(
         f"NOTE: Could not init the gdb module: {error} {traceback.format_exc()}\n")
@@ -0,0 +1,123 @@
+"""
+Benchmark of the xnu-* commands on synthetic kernels (see fake_kernel.py):
+    $ cd gdb && python3 -m xnu.bench [--scales small,medium,large]
+                                     [--latency ${SECONDS}] [--jsonl ${FILE}]
+For every scale and command it reports the round trips to the target,
+the bytes read and the wall time, with a cold page cache.
+--latency adds that delay to every round trip, like a remote gdb stub.
+--jsonl appends the results, one record per run, to compare commits.
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+from xnu.offline import install_gdb_module, load_commands, execute
+
+SCALES = {
+    # tasks, threads per task, ipc table slots, ports, zones
+    "small": dict(tasks=20, threads_per_task=4, ipc_entries=256, ports=64, zones=64),
+    "medium": dict(tasks=200, threads_per_task=8, ipc_entries=2048, ports=512, zones=200),
+    "large": dict(tasks=500, threads_per_task=8, ipc_entries=4096, ports=4096, zones=256),
+}
+
+COMMANDS = [
+    "xnu-threads",
+    "xnu-tasks",
+    "xnu-zones",
+    "xnu-ipc_entry-list -task {task}",
+    "xnu-port-rights -shared",
+    "xnu-threads --format jsonl",
+    "xnu-bt-all -group",
+]
+
+
+class OutputCounter:
+    """ Swallow the output of the commands, only count it """
+    def __init__(self):
+        self.size = 0
+
+    def write(self, text):
+        self.size += len(text)
+
+    def flush(self):
+        pass
+
+
+def get_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_command(backend, command):
+    import xnu.utils as utils
+    utils.PAGE_CACHE.flush()
+    backend.reset_stats()
+    output = OutputCounter()
+    stdout, sys.stdout = sys.stdout, output
+    start = time.perf_counter()
+    try:
+        execute(command)
+    finally:
+        sys.stdout = stdout
+    return {
+        "seconds": time.perf_counter() - start,
+        "round_trips": backend.reads,
+        "bytes_read": backend.bytes_read,
+        "output_bytes": output.size,
+    }
+
+
+def run(scales, latency, jsonl_path):
+    install_gdb_module()
+    from xnu.fake_kernel import FakeKernelBackend
+    revision = get_revision()
+    out = open(jsonl_path, "a") if jsonl_path else None
+    print(f"{'scale':<8} {'command':<44} {'round trips':>11} {'KB read':>9} "
+          f"{'ms':>9} {'KB out':>8}")
+    try:
+        for scale in scales:
+            start = time.perf_counter()
+            backend = FakeKernelBackend().build(**SCALES[scale])
+            build_seconds = time.perf_counter() - start
+            load_commands(backend)
+            backend.latency = latency
+            for command in COMMANDS:
+                command = command.format(task=hex(backend.tasks[0]))
+                result = run_command(backend, command)
+                print(f"{scale:<8} {command:<44} {result['round_trips']:>11} "
+                      f"{result['bytes_read'] >> 10:>9} {result['seconds'] * 1000:>9.1f} "
+                      f"{result['output_bytes'] >> 10:>8}")
+                if out:
+                    record = {"revision": revision, "scale": scale, "command": command,
+                              "latency": latency, "build_seconds": build_seconds}
+                    record.update(SCALES[scale])
+                    record.update(result)
+                    out.write(json.dumps(record) + "\n")
+    finally:
+        if out:
+            out.close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python3 -m xnu.bench", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="small,medium",
+                        help=f"comma separated, of {', '.join(SCALES)}")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds added to every round trip")
+    parser.add_argument("--jsonl", help="append the results to this file")
+    args = parser.parse_args(argv)
+    scales = args.scales.split(",")
+    unknown = [scale for scale in scales if scale not in SCALES]
+    if unknown:
+        parser.error(f"unknown scales {', '.join(unknown)}")
+    run(scales, args.latency, args.jsonl)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -9,8 +9,20 @@ GLOBAL_TASKS_PTR = 0xfffffff00760f9c0
 NULL_PTR = 0x0000000000000000
 NULL_PTR_STR = "0x0000000000000000"
 CURRENT_THREAD = "$TPIDR_EL1"
+# arm64 kernel stacks, machine.kstackptr points to the saved state at the top
+KERNEL_STACK_SIZE = 0x4000
 
 IE_BITS_TYPE_MASK = 0x001f0000
+IE_BITS_GEN_SHIFT = 24
+
+# osfmk/mach/port.h MACH_PORT_TYPE_* bits, as kept in ie_bits
+IE_BITS_RIGHTS = [
+    (0x00010000, "send"),
+    (0x00020000, "receive"),
+    (0x00040000, "send-once"),
+    (0x00080000, "port-set"),
+    (0x00100000, "dead-name"),
+]
 
 IO_BITS_KOTYPE = 0x00000fff
 
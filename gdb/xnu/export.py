@@ -0,0 +1,103 @@
+"""
+Machine readable output of the xnu-* commands.
+Every listing command accepts --format jsonl/csv and --out ${FILE}.
+Records are written one by one while the kernel objects are walked,
+nothing but the current record is kept in memory.
+Pointers are exported as hex strings, kernel addresses do not fit in a
+signed 64 bit integer and most json consumers lose precision above 2^53.
+"""
+import csv
+import io
+import json
+import gdb
+
+EXPORT_FORMATS = ("jsonl", "csv")
+EXPORT_USAGE = "[--format jsonl/csv] [--out ${FILE}]"
+# records buffered before each gdb.write, when there is no --out file
+RECORDS_PER_WRITE = 64
+
+
+def ptr(value):
+    return None if value is None else f"0x{value:016x}"
+
+
+def parse_export_args(argv):
+    """ Remove the export options from argv.
+    Returns (the rest of argv, RecordWriter or None when no format was asked)
+    """
+    rest = []
+    fmt = None
+    path = None
+    arguments = iter(argv)
+    for argument in arguments:
+        if argument in ("--format", "--out"):
+            value = next(arguments, None)
+            if value is None:
+                raise gdb.GdbError(f"{argument} needs a value, {EXPORT_USAGE}")
+            if argument == "--format":
+                fmt = value
+            else:
+                path = value
+        else:
+            rest.append(argument)
+    if fmt is None and path is None:
+        return rest, None
+    if fmt is None:
+        # --out alone, guess from the file name
+        fmt = "csv" if path.endswith(".csv") else "jsonl"
+    if fmt not in EXPORT_FORMATS:
+        raise gdb.GdbError(f"Unknown format {fmt}, {EXPORT_USAGE}")
+    return rest, RecordWriter(fmt, path)
+
+
+class RecordWriter:
+    """ Stream records (flat dicts) as json lines or csv rows,
+    to a file or to the gdb console.
+    The csv columns are the keys of the first record.
+    """
+    def __init__(self, fmt, path=None):
+        self.fmt = fmt
+        self.path = path
+        self.count = 0
+        self.stream = None
+        self.csv_writer = None
+
+    def __enter__(self):
+        if self.path is not None:
+            self.stream = open(self.path, "w", newline="")
+        else:
+            self.stream = io.StringIO()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if self.path is not None:
+            self.stream.close()
+            gdb.write(f"{self.count} records written to {self.path}\n")
+        else:
+            self.flush()
+        return False
+
+    def write(self, record):
+        if self.fmt == "jsonl":
+            self.stream.write(json.dumps(record) + "\n")
+        else:
+            if self.csv_writer is None:
+                self.csv_writer = csv.DictWriter(self.stream, fieldnames=list(record),
+                                                 restval="", extrasaction="ignore")
+                self.csv_writer.writeheader()
+            self.csv_writer.writerow(record)
+        self.count += 1
+        if self.path is None and self.count % RECORDS_PER_WRITE == 0:
+            self.flush()
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+        return self.count
+
+    def flush(self):
+        """ Console output only, files are flushed by their own buffering """
+        if self.path is None:
+            gdb.write(self.stream.getvalue())
+            self.stream.seek(0)
+            self.stream.truncate()
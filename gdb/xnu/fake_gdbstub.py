@@ -0,0 +1,155 @@
+"""
+A minimal gdbstub serving a memory backend over the remote serial protocol,
+to try the rsp client (and gdb itself) without QEMU:
+    $ cd gdb && python3 -m xnu.fake_gdbstub --port 1234 [--scale small] [--latency 0.001]
+                                          [--snapshot ${FILE}]
+Implements what the client and gdb's "target remote" need: qSupported,
+no-ack mode, the target description, '?', 'm', 'p', 'g', 'c', interrupt and 'D'.
+"""
+import argparse
+import socket
+import socketserver
+import sys
+from xnu.offline import install_gdb_module
+# no-op inside gdb
+install_gdb_module()
+from xnu.rsp import rsp_checksum, rsp_frame
+import gdb
+
+FAKE_STUB_PACKET_SIZE = 0x1000
+CORE_REGISTERS = [(f"x{i}", 64) for i in range(31)] + [("sp", 64), ("pc", 64), ("cpsr", 32)]
+
+
+def get_target_xml(extra_registers):
+    """ aarch64 core feature, and the other registers of the backend as system registers """
+    regs = "".join(f'<reg name="{name}" bitsize="{bits}" regnum="{i}"/>'
+                   for i, (name, bits) in enumerate(CORE_REGISTERS))
+    system = "".join(f'<reg name="{name}" bitsize="64" regnum="{len(CORE_REGISTERS) + i}"/>'
+                     for i, name in enumerate(extra_registers))
+    return ('<?xml version="1.0"?><!DOCTYPE target SYSTEM "gdb-target.dtd">'
+            '<target><architecture>aarch64</architecture>'
+            f'<feature name="org.gnu.gdb.aarch64.core">{regs}</feature>'
+            f'<feature name="org.qemu.gdb.aarch64.sysregs">{system}</feature>'
+            '</target>').encode()
+
+
+class FakeGdbStubHandler(socketserver.BaseRequestHandler):
+    """ One gdb connection, the backend is the one of the server """
+    def setup(self):
+        self.backend = self.server.backend
+        # replies go out one by one, don't let nagle wait for the client's delayed ack
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.ack = True
+        self.buffer = bytearray()
+        core = {name for name, _ in CORE_REGISTERS}
+        self.extra_registers = [name.lstrip("$") for name in
+                                getattr(self.backend, "registers", {})
+                                if name.lstrip("$") not in core]
+        self.registers = CORE_REGISTERS + [(name, 64) for name in self.extra_registers]
+        self.target_xml = get_target_xml(self.extra_registers)
+
+    def handle(self):
+        while True:
+            packet = self.read_packet()
+            if packet is None:
+                return
+            reply = self.dispatch(packet)
+            if reply is not None:
+                self.request.sendall(rsp_frame(reply))
+            if packet == b"D":
+                return
+
+    def read_packet(self):
+        while True:
+            if self.buffer[:1] in (b"+", b"-"):
+                del self.buffer[0]
+                continue
+            if self.buffer[:1] == b"\x03":
+                del self.buffer[0]
+                return b"\x03"
+            end = self.buffer.find(b"#")
+            if self.buffer[:1] == b"$" and end != -1 and len(self.buffer) >= end + 3:
+                payload = bytes(self.buffer[1:end])
+                checksum = int(self.buffer[end + 1:end + 3], 16)
+                del self.buffer[:end + 3]
+                if self.ack:
+                    self.request.sendall(b"+" if checksum == rsp_checksum(payload) else b"-")
+                return payload
+            data = self.request.recv(0x10000)
+            if not data:
+                return None
+            self.buffer += data
+
+    def dispatch(self, packet):
+        if packet.startswith(b"qSupported"):
+            return b"PacketSize=%x;qXfer:features:read+;QStartNoAckMode+" % FAKE_STUB_PACKET_SIZE
+        if packet == b"QStartNoAckMode":
+            self.request.sendall(rsp_frame(b"OK"))
+            self.ack = False
+            return None
+        if packet in (b"?", b"\x03"):
+            return b"S05"
+        if packet.startswith(b"qXfer:features:read:target.xml:"):
+            offset, length = (int(value, 16) for value in packet.rsplit(b":", 1)[1].split(b","))
+            chunk = self.target_xml[offset:offset + length]
+            return (b"l" if offset + length >= len(self.target_xml) else b"m") + chunk
+        if packet.startswith(b"m"):
+            addr, length = (int(value, 16) for value in packet[1:].split(b","))
+            length = min(length, FAKE_STUB_PACKET_SIZE // 2)
+            try:
+                return self.backend.read_memory(addr, length).hex().encode()
+            except gdb.MemoryError:
+                return b"E14"
+        if packet.startswith(b"p"):
+            regnum = int(packet[1:], 16)
+            if regnum >= len(self.registers):
+                return b"E00"
+            return self.read_register(*self.registers[regnum])
+        if packet == b"g":
+            return b"".join(self.read_register(name, bits) for name, bits in CORE_REGISTERS)
+        if packet in (b"c", b"D"):
+            return b"OK" if packet == b"D" else None
+        # not supported
+        return b""
+
+    def read_register(self, name, bits):
+        try:
+            value = self.backend.read_register(f"${name}")
+        except gdb.GdbError:
+            value = 0
+        return value.to_bytes(bits // 8, "little").hex().encode()
+
+
+class FakeGdbStub(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, backend):
+        self.backend = backend
+        super(FakeGdbStub, self).__init__(address, FakeGdbStubHandler)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python3 -m xnu.fake_gdbstub")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1234)
+    parser.add_argument("--scale", default="small", help="a scale of xnu.bench")
+    parser.add_argument("--snapshot", help="serve a snapshot instead of a synthetic kernel")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds added to every read of the synthetic kernel")
+    args = parser.parse_args(argv)
+    if args.snapshot:
+        from xnu.snapshot import SnapshotBackend
+        backend = SnapshotBackend(args.snapshot)
+    else:
+        from xnu.bench import SCALES
+        from xnu.fake_kernel import FakeKernelBackend
+        backend = FakeKernelBackend(latency=args.latency).build(**SCALES[args.scale])
+    with FakeGdbStub((args.host, args.port), backend) as server:
+        sys.stderr.write(f"serving on {args.host}:{server.server_address[1]}\n")
+        server.serve_forever()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
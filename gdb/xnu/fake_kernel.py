@@ -0,0 +1,228 @@
+"""
+A synthetic kernel in the memory of the python process.
+FakeKernelBackend lays out tasks, threads (with their saved states and
+kernel stacks), proc structures, ipc spaces with their tables and ports,
+and a full zone_array, at the offsets of constants.py and zone.py,
+so the commands can be run and measured without QEMU (see bench.py).
+It counts the round trips and the bytes read, and may add a latency to
+every round trip to look like a remote gdb stub.
+"""
+import struct
+import time
+import xnu.constants as const
+import xnu.utils as utils
+from xnu.zone import StructZone
+import gdb
+
+# where the synthetic objects are allocated
+FAKE_HEAP = 0xffffffe000000000
+FAKE_TASK_SIZE = 0x400
+FAKE_THREAD_SIZE = 0x600
+FAKE_PROC_SIZE = 0x300
+FAKE_IPC_SPACE_SIZE = 0x40
+FAKE_IPC_PORT_SIZE = 0xa8
+FAKE_SAVED_STATE_SIZE = 0x130
+# a function the kernel threads are blocked in
+FAKE_BLOCKED_PC = 0xfffffff0070db3fc
+# where Switch_context returns in thread_invoke, and a few callers of the
+# blocking function, so the threads do not all share one stack
+FAKE_SWITCH_RETURN = 0xfffffff0070e2b18
+FAKE_CALLER_PCS = [0xfffffff0071a0c44, 0xfffffff0071b3e10, 0xfffffff007243d88]
+FAKE_USER_PC = 0x100004000
+
+
+class FakeKernelBackend(utils.MemoryBackend):
+    def __init__(self, latency=0.0):
+        self.pages = {}
+        self.registers = {}
+        self.latency = latency
+        self.reads = 0
+        self.bytes_read = 0
+        self.heap = FAKE_HEAP
+        self.tasks = []
+        self.threads = []
+        self.ports = []
+        # sp, fp and lr each thread resumes with, the current one runs with them
+        self.switch_registers = {}
+
+    # memory
+
+    def read_memory(self, addr, size):
+        self.reads += 1
+        self.bytes_read += size
+        if self.latency:
+            time.sleep(self.latency)
+        chunks = []
+        position = addr
+        while position < addr + size:
+            page_addr = position & utils.PAGE_MASK
+            page = self.pages.get(page_addr)
+            if page is None:
+                raise gdb.MemoryError(f"Cannot access memory at address {hex(position)}")
+            length = min(addr + size, page_addr + utils.PAGE_SIZE) - position
+            chunks.append(bytes(page[position - page_addr:position - page_addr + length]))
+            position += length
+        return b"".join(chunks)
+
+    def read_register(self, name):
+        try:
+            return self.registers[name]
+        except KeyError:
+            raise gdb.GdbError(f"Invalid register `{name}'")
+
+    def reset_stats(self):
+        self.reads = 0
+        self.bytes_read = 0
+
+    def poke(self, addr, data):
+        """ Write data, mapping the pages it covers """
+        position = 0
+        while position < len(data):
+            page_addr = (addr + position) & utils.PAGE_MASK
+            page = self.pages.setdefault(page_addr, bytearray(utils.PAGE_SIZE))
+            start = addr + position - page_addr
+            length = min(len(data) - position, utils.PAGE_SIZE - start)
+            page[start:start + length] = data[position:position + length]
+            position += length
+
+    def put_8(self, addr, value):
+        self.poke(addr, utils.U64.pack(value))
+
+    def put_4(self, addr, value):
+        self.poke(addr, utils.U32.pack(value))
+
+    def alloc(self, size, alignment=0x10, mapped=True):
+        """ Memory of the fake heap, zeroed and mapped unless mapped is False """
+        self.heap = (self.heap + alignment - 1) & ~(alignment - 1)
+        addr = self.heap
+        self.heap += size
+        if mapped:
+            self.poke(addr, bytes(size))
+        return addr
+
+    # kernel objects
+
+    def build(self, tasks=10, threads_per_task=4, ipc_entries=64, ports=32, zones=64):
+        """ A kernel with that many tasks, each with threads_per_task threads
+        and an ipc table of ipc_entries slots, one of ports ports (shared
+        between the tasks) in every used slot. zones valid zones in zone_array.
+        """
+        self.ports = [self.build_port(i) for i in range(ports)]
+        for i in range(tasks):
+            self.tasks.append(self.build_task(i, ipc_entries))
+        self.link_queue(const.GLOBAL_TASKS_PTR, self.tasks, const.TaskOffsets.TASK_NEXT.value)
+        for task_index, task in enumerate(self.tasks):
+            threads = [self.build_thread(task, task_index * 1000 + j, user=(j % 2 == 1))
+                       for j in range(threads_per_task)]
+            self.link_queue(task + const.TaskOffsets.THREAD_LST_FROM_TASK.value, threads,
+                            const.ThreadOffsets.TASK_THREADS.value)
+            self.threads += threads
+        self.link_queue(const.GLOBAL_THREADS_PTR, self.threads,
+                        const.ThreadOffsets.GLOBAL_THREADS.value)
+        self.build_zones(zones)
+        self.registers[const.CURRENT_THREAD] = self.threads[0] if self.threads else 0
+        self.registers["$pc"] = FAKE_BLOCKED_PC
+        if self.threads:
+            self.registers.update(self.switch_registers[self.threads[0]])
+        return self
+
+    def link_queue(self, head, elements, next_offset):
+        """ queue_head_t at head, the links point to the elements """
+        for element, next_element in zip(elements, elements[1:] + [head]):
+            self.put_8(element + next_offset, next_element)
+        self.put_8(head, elements[0] if elements else head)
+
+    def build_port(self, i):
+        port = self.alloc(FAKE_IPC_PORT_SIZE)
+        # io_bits: active, kobject type by index
+        self.put_4(port, 0x80000000 | (i % len(const.IO_BITS_TYPES)))
+        self.put_4(port + const.IPCObjectOffsets.IO_REFS.value, 1 + i % 7)
+        self.put_4(port + const.IPCPortOffsets.IP_SRIGHTS.value, 1 + i % 3)
+        return port
+
+    def build_task(self, i, ipc_entries):
+        task = self.alloc(FAKE_TASK_SIZE)
+        proc = self.alloc(FAKE_PROC_SIZE)
+        self.put_4(proc + const.BSDInfoOffsets.PID_IN_BSD_INFO.value, i)
+        self.poke(proc + const.BSDInfoOffsets.NAME_INBSD_INFO.value, b"fakeproc%d\0" % i)
+        self.put_8(task + const.TaskOffsets.BSD_INFO.value, proc)
+        if ipc_entries:
+            self.put_8(task + const.TaskOffsets.IPC_SPACE.value, self.build_space(i, ipc_entries))
+        return task
+
+    def build_space(self, i, ipc_entries):
+        space = self.alloc(FAKE_IPC_SPACE_SIZE)
+        table = self.alloc(ipc_entries * 0x18, utils.PAGE_SIZE)
+        entries = bytearray(ipc_entries * 0x18)
+        # slot 0 is reserved, about one slot of three is used
+        for index in range(1, ipc_entries):
+            if self.ports and index % 3 != 0:
+                port = self.ports[(index + i) % len(self.ports)]
+                right = 0x20000 if (index + i) % len(self.ports) == i else 0x10000
+                struct.pack_into("<QIII", entries, index * 0x18, port,
+                                 right | ((index & 0xff) << 24), 0, 0)
+        self.poke(table, bytes(entries))
+        self.put_4(space + const.IPCSpaceOffsets.IS_TABLE_SIZE.value, ipc_entries)
+        self.put_8(space + const.IPCSpaceOffsets.IS_TABLE.value, table)
+        return space
+
+    def build_saved_state(self, addr, pc, sp, fp=0, lr=0):
+        # x0..x28, fp, lr, sp, pc after the 8 bytes header
+        self.put_8(addr + 0x08 + 0x08 * 29, fp)
+        self.put_8(addr + 0x08 + 0x08 * 30, lr)
+        self.put_8(addr + 0x08 + 0x08 * 31, sp)
+        self.put_8(addr + 0x08 + 0x08 * 32, pc)
+
+    def build_thread(self, task, tid, user):
+        thread = self.alloc(FAKE_THREAD_SIZE)
+        self.put_8(thread + const.ThreadOffsets.TASK.value, task)
+        self.put_8(thread + const.ThreadOffsets.THREAD_ID.value, tid)
+        if user:
+            context = self.alloc(FAKE_SAVED_STATE_SIZE)
+            self.build_saved_state(context, FAKE_USER_PC + tid, 0x16f000000)
+            self.put_8(thread + const.ThreadOffsets.CONTEXT_USER_DATA_PTR.value, context)
+        # blocked in thread_block: Switch_context saved state at the top of the
+        # stack, thread_invoke's frame below it (see Thread.get_kernel_next_pc),
+        # then thread_block_reason's and its caller's, chained by their frame records
+        # only the pages written below are mapped
+        stack = self.alloc(const.KERNEL_STACK_SIZE, const.KERNEL_STACK_SIZE, mapped=False)
+        kstackptr = stack + const.KERNEL_STACK_SIZE - FAKE_SAVED_STATE_SIZE
+        frame = kstackptr - 0x400
+        invoke_record = frame + const.NextPcHelpOffsets.STORED_LR_IN_THREAD_INVOKE_FRAME.value - 8
+        block_record = frame + const.NextPcHelpOffsets.THREAD_INVOKE_FRAME_SIZE.value + 0x40
+        caller_record = block_record + 0x100
+        self.build_saved_state(kstackptr, 0, frame, invoke_record, FAKE_SWITCH_RETURN)
+        self.switch_registers[thread] = {"$sp": frame, "$x29": invoke_record,
+                                         "$x30": FAKE_SWITCH_RETURN}
+        self.put_8(invoke_record, block_record)
+        self.put_8(invoke_record + 8, const.NextPcHelpOffsets.NEXT_IN_THREAD_BLOCK.value)
+        self.put_8(block_record, caller_record)
+        self.put_8(block_record + 8, FAKE_BLOCKED_PC)
+        self.put_8(caller_record + 8, FAKE_CALLER_PCS[tid % len(FAKE_CALLER_PCS)])
+        self.put_8(thread + const.ThreadOffsets.KSTACK_PTR.value, kstackptr)
+        self.put_8(thread + const.ThreadOffsets.CONTINUATION.value,
+                   0 if user else FAKE_BLOCKED_PC)
+        return thread
+
+    def build_zones(self, zones):
+        offsets = StructZone.struct_offsets_16B92
+        struct_size = StructZone.get_struct_size()
+        max_zones = max(zones, 1)
+        zone_array = StructZone.get_zone_array()
+        if zone_array + max_zones * struct_size > StructZone.get_max_zones():
+            raise ValueError(f"zone_array of 16B92 can not hold {max_zones} zones")
+        self.poke(zone_array, bytes(max_zones * struct_size))
+        self.put_4(StructZone.get_max_zones(), max_zones)
+        valid = offsets["flags_valid_mask"] << offsets["flags_valid_shift"]
+        for i in range(zones):
+            zone = zone_array + i * struct_size
+            name = self.alloc(0x20)
+            self.poke(name, b"fake.zone.%d\0" % i)
+            elem_size = 0x10 << (i % 8)
+            self.put_4(zone + offsets["flags"], valid)
+            self.put_4(zone + offsets["index"], i)
+            self.put_8(zone + offsets["elem_size"], elem_size)
+            self.put_8(zone + offsets["alloc_size"], utils.PAGE_SIZE * 4)
+            self.put_8(zone + offsets["cur_size"], utils.PAGE_SIZE * (i + 1))
+            self.put_8(zone + offsets["max_size"], utils.PAGE_SIZE * 0x100)
+            self.put_8(zone + offsets["zone_name"], name)
@@ -0,0 +1,185 @@
+"""
+Collect the state of many QEMU instances at once, through their gdbstubs:
+    $ cd gdb && python3 -m xnu.fleet --targets localhost:1234,localhost:1235
+                                     [--targets-file ${FILE}] [--jobs 8] [--timeout 60]
+                                     [--out fleet.jsonl] ["xnu-threads" "xnu-zones" ...]
+Every target is inspected by its own worker process (the offline commands on an rsp
+client, the xnu modules keep the target in globals), asyncio runs up to --jobs of
+them at once and kills the ones still running after --timeout seconds.
+The records of all the targets are merged in one jsonl stream, each one tagged with
+its target and command, as they come. A summary per target goes to stderr.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+FLEET_DEFAULT_COMMANDS = ["xnu-threads", "xnu-tasks", "xnu-zones"]
+FLEET_DEFAULT_JOBS = 8
+FLEET_DEFAULT_TIMEOUT = 60.0
+# longest record line read from a worker, a longer one fails its target
+FLEET_LINE_LIMIT = 0x4000000
+
+
+class TaggedOutput:
+    """ Stdout of a worker: every jsonl record of a command, tagged, on its own line """
+    def __init__(self, stream, target, command):
+        self.stream = stream
+        self.target = target
+        self.command = command
+        self.pending = ""
+
+    def write(self, text):
+        lines = (self.pending + text).split("\n")
+        self.pending = lines.pop()
+        for line in lines:
+            self.write_line(line)
+
+    def write_line(self, line):
+        if not line.strip():
+            return
+        record = {"target": self.target, "command": self.command}
+        try:
+            record.update(json.loads(line))
+        except ValueError:
+            # a command printing text, not records
+            record["text"] = line
+        self.stream.write(json.dumps(record) + "\n")
+
+    def flush(self):
+        if self.pending:
+            self.write_line(self.pending)
+            self.pending = ""
+        self.stream.flush()
+
+
+def with_jsonl_format(command):
+    return command if "--format" in command.split() else command + " --format jsonl"
+
+
+def run_worker(target, commands):
+    """ In the worker process: run the commands on one target, records to stdout """
+    from xnu.offline import GdbError, execute, open_remote
+    _, client = open_remote(target)
+    stdout = sys.stdout
+    status = 0
+    try:
+        for command in commands:
+            sys.stdout = TaggedOutput(stdout, target, command)
+            try:
+                execute(with_jsonl_format(command))
+            except GdbError as error:
+                sys.stderr.write(f"{command}: {error}\n")
+                status = 1
+            finally:
+                sys.stdout.flush()
+                sys.stdout = stdout
+    finally:
+        client.close()
+    return status
+
+
+class TargetResult:
+    def __init__(self, target):
+        self.target = target
+        self.status = "pending"
+        self.records = 0
+        self.seconds = 0.0
+        self.error = ""
+
+
+async def inspect_target(target, commands, out, semaphore, timeout):
+    """ One worker process, its records are copied to out line by line """
+    result = TargetResult(target)
+    async with semaphore:
+        start = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "xnu.fleet", "--worker", target, *commands,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            limit=FLEET_LINE_LIMIT)
+        stderr = asyncio.ensure_future(process.stderr.read())
+
+        async def copy_records():
+            async for line in process.stdout:
+                out.write(line.decode())
+                result.records += 1
+            return await process.wait()
+
+        try:
+            returncode = await asyncio.wait_for(copy_records(), timeout)
+            result.status = "ok" if returncode == 0 else "failed"
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            result.status = "timeout"
+        except (ValueError, asyncio.LimitOverrunError):
+            # only this target is given up
+            process.kill()
+            await process.wait()
+            result.status = "failed"
+            result.error = f"a record is longer than {FLEET_LINE_LIMIT} bytes\n"
+        result.seconds = time.perf_counter() - start
+        result.error = (result.error + (await stderr).decode()).strip()
+    return result
+
+
+async def collect(targets, commands, out, jobs, timeout):
+    semaphore = asyncio.Semaphore(jobs)
+    return await asyncio.gather(*(inspect_target(target, commands, out, semaphore, timeout)
+                                  for target in targets))
+
+
+def read_targets(targets, targets_file):
+    found = [target for target in (targets or "").split(",") if target]
+    if targets_file:
+        with open(targets_file) as f:
+            for line in f:
+                line = line.split("#", 1)[0].strip()
+                if line:
+                    found.append(line)
+    return found
+
+
+def print_summary(results, seconds):
+    for result in results:
+        sys.stderr.write(f"{result.target:<24} {result.status:<8} {result.records:>8} records "
+                         f"{result.seconds:>8.2f}s\n")
+        if result.status != "ok" and result.error:
+            sys.stderr.write("".join(f"    {line}\n" for line in
+                                     result.error.splitlines()[-3:]))
+    slowest = max((result.seconds for result in results), default=0.0)
+    sys.stderr.write(f"{len(results)} targets in {seconds:.2f}s, slowest target {slowest:.2f}s\n")
+
+
+def main(argv):
+    if argv[:1] == ["--worker"]:
+        return run_worker(argv[1], argv[2:])
+    parser = argparse.ArgumentParser(prog="python3 -m xnu.fleet", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--targets", help="comma separated host:port")
+    parser.add_argument("--targets-file", help="one host:port per line")
+    parser.add_argument("--jobs", type=int, default=FLEET_DEFAULT_JOBS,
+                        help="targets inspected at once")
+    parser.add_argument("--timeout", type=float, default=FLEET_DEFAULT_TIMEOUT,
+                        help="seconds per target")
+    parser.add_argument("--out", help="write the records to this file instead of stdout")
+    parser.add_argument("commands", nargs="*", default=FLEET_DEFAULT_COMMANDS)
+    args = parser.parse_args(argv)
+    targets = read_targets(args.targets, args.targets_file)
+    if not targets:
+        parser.error("no targets, use --targets or --targets-file")
+    out = open(args.out, "w") if args.out else sys.stdout
+    start = time.perf_counter()
+    try:
+        results = asyncio.run(collect(targets, args.commands, out, args.jobs, args.timeout))
+    finally:
+        out.flush()
+        if args.out:
+            out.close()
+    print_summary(results, time.perf_counter() - start)
+    return 0 if all(result.status == "ok" for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,141 @@
+"""
+Run the xnu-* commands on a snapshot (see snapshot.py), without gdb and QEMU:
+    $ cd gdb && python3 -m xnu.offline ${SNAPSHOT} "xnu-threads" "xnu-tasks --format jsonl"
+or on QEMU's gdbstub directly, without gdb (see rsp.py):
+    $ cd gdb && python3 -m xnu.offline --remote localhost:1234 "xnu-tasks --format jsonl"
+The commands only use a small part of the gdb python api, it is provided
+here on top of the snapshot backend. Any number of processes may analyse
+the same snapshot at once, the file is only mapped.
+"""
+import shlex
+import sys
+import types
+
+
+class GdbError(RuntimeError):
+    pass
+
+
+class TargetMemoryError(RuntimeError):
+    pass
+
+
+class Command:
+    """ Commands register themselves by name, execute() dispatches to them """
+    registry = {}
+
+    def __init__(self, name, command_class=None):
+        Command.registry[name] = self
+
+
+class EventRegistry:
+    """ The snapshot never changes, nothing is ever emitted """
+    def __init__(self):
+        self.handlers = []
+
+    def connect(self, handler):
+        self.handlers.append(handler)
+
+    def disconnect(self, handler):
+        self.handlers.remove(handler)
+
+
+def write(text):
+    sys.stdout.write(text)
+
+
+def string_to_argv(arg):
+    return shlex.split(arg)
+
+
+def execute(command, from_tty=False, to_string=False):
+    name, _, arg = command.strip().partition(" ")
+    if name not in Command.registry:
+        raise GdbError(f"{command} is not available offline")
+    Command.registry[name].invoke(arg, from_tty)
+
+
+def not_available(*args, **kwargs):
+    raise GdbError("Not available offline, the target is a snapshot")
+
+
+def make_gdb_module():
+    module = types.ModuleType("gdb")
+    module.GdbError = GdbError
+    module.MemoryError = TargetMemoryError
+    module.Command = Command
+    module.COMMAND_DATA = 0
+    module.BP_WATCHPOINT = 0
+    module.write = write
+    module.string_to_argv = string_to_argv
+    module.execute = execute
+    module.selected_inferior = not_available
+    # a single cpu, its registers are the backend's
+    module.selected_thread = lambda: None
+    module.Breakpoint = not_available
+    module.events = types.SimpleNamespace(cont=EventRegistry(),
+                                          memory_changed=EventRegistry(),
+                                          register_changed=EventRegistry())
+    return module
+
+
+def install_gdb_module():
+    """ Must be called before any xnu module is imported """
+    if "gdb" not in sys.modules:
+        sys.modules["gdb"] = make_gdb_module()
+
+
+def load_commands(backend):
+    """ Register the commands and make them read backend, returns the registry """
+    install_gdb_module()
+    import xnu.utils as utils
+    import xnu.tasks
+    import xnu.zone
+    utils.set_backend(backend)
+    return Command.registry
+
+
+def open_snapshot(path):
+    """ Make the xnu modules read the snapshot, returns the command registry """
+    install_gdb_module()
+    from xnu.snapshot import SnapshotBackend
+    return load_commands(SnapshotBackend(path))
+
+
+def open_remote(address):
+    """ Make the xnu modules read the gdbstub at address (host:port),
+    returns the registry and the client, close it to let the VM run """
+    install_gdb_module()
+    from xnu.rsp import RspBackend, connect
+    client = connect(address)
+    return load_commands(RspBackend(client)), client
+
+
+def run_commands(commands):
+    status = 0
+    for command in commands:
+        try:
+            execute(command)
+        except GdbError as error:
+            sys.stderr.write(f"{command}: {error}\n")
+            status = 1
+    return status
+
+
+def main(argv):
+    if len(argv) >= 3 and argv[0] == "--remote":
+        _, client = open_remote(argv[1])
+        try:
+            return run_commands(argv[2:])
+        finally:
+            client.close()
+    if len(argv) < 2 or argv[0].startswith("--"):
+        sys.stderr.write("Usage: python3 -m xnu.offline ${SNAPSHOT} ${COMMAND}...\n"
+                         "       python3 -m xnu.offline --remote ${HOST}:${PORT} ${COMMAND}...\n")
+        return 1
+    open_snapshot(argv[0])
+    return run_commands(argv[1:])
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
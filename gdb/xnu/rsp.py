@@ -0,0 +1,256 @@
+"""
+A gdb remote serial protocol client, to read the kernel straight from
+QEMU's gdbstub without a gdb process:
+    $ cd gdb && python3 -m xnu.offline --remote localhost:1234 "xnu-tasks --format jsonl"
+QEMU stops the VM while a client is connected, it runs again once we detach.
+Reads are split in the biggest 'm' packets the stub accepts, and in no-ack
+mode all the packets of a read are sent before the first reply is awaited.
+Register numbers come from the target description (qXfer:features:read).
+"""
+import socket
+import xml.etree.ElementTree as ElementTree
+import xnu.utils as utils
+import gdb
+
+RSP_DEFAULT_PACKET_SIZE = 0x1000
+# 'm' replies are hex, keep some room for the framing
+RSP_MAX_READ = 0x2000
+# requests in flight at once, in no-ack mode
+RSP_PIPELINE_DEPTH = 32
+RSP_RECV_SIZE = 0x10000
+RSP_TIMEOUT = 10.0
+
+
+class RspError(Exception):
+    pass
+
+
+class RspMemoryError(RspError):
+    pass
+
+
+def rsp_checksum(payload):
+    return sum(payload) & 0xff
+
+
+def rsp_frame(payload):
+    return b"$" + payload + b"#" + b"%02x" % rsp_checksum(payload)
+
+
+def rsp_decode(payload):
+    """ Undo the binary escapes and the run length encoding of a reply """
+    if b"}" not in payload and b"*" not in payload:
+        return payload
+    out = bytearray()
+    i = 0
+    while i < len(payload):
+        char = payload[i]
+        if char == 0x7d:  # '}'
+            i += 1
+            out.append(payload[i] ^ 0x20)
+        elif char == 0x2a:  # '*', repeat the previous byte
+            i += 1
+            out += out[-1:] * (payload[i] - 29)
+        else:
+            out.append(char)
+        i += 1
+    return bytes(out)
+
+
+class RspClient:
+    """ One connection to a gdbstub """
+    def __init__(self, host, port, timeout=RSP_TIMEOUT):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = bytearray()
+        self.ack = True
+        self.features = {}
+        self.packet_size = RSP_DEFAULT_PACKET_SIZE
+        self.registers = None
+        self.handshake()
+
+    # packets
+
+    def _recv(self):
+        data = self.sock.recv(RSP_RECV_SIZE)
+        if not data:
+            raise RspError("The gdbstub closed the connection")
+        self.buffer += data
+
+    def send(self, payload):
+        self.sock.sendall(rsp_frame(payload))
+        if self.ack:
+            self._wait_ack()
+
+    def send_many(self, payloads):
+        """ Pipelined, the replies are read later with receive() """
+        self.sock.sendall(b"".join(rsp_frame(payload) for payload in payloads))
+
+    def _wait_ack(self):
+        while True:
+            while not self.buffer:
+                self._recv()
+            char = self.buffer[0]
+            del self.buffer[0]
+            if char == 0x2b:  # '+'
+                return
+            if char == 0x2d:  # '-'
+                raise RspError("The gdbstub asked for a retransmission")
+
+    def receive(self):
+        while True:
+            start = self.buffer.find(b"$")
+            end = self.buffer.find(b"#", start) if start != -1 else -1
+            if end == -1 or len(self.buffer) < end + 3:
+                self._recv()
+                continue
+            payload = bytes(self.buffer[start + 1:end])
+            checksum = int(self.buffer[end + 1:end + 3], 16)
+            del self.buffer[:end + 3]
+            if self.ack:
+                if checksum != rsp_checksum(payload):
+                    self.sock.sendall(b"-")
+                    continue
+                self.sock.sendall(b"+")
+            return rsp_decode(payload)
+
+    def request(self, payload):
+        self.send(payload)
+        return self.receive()
+
+    # session
+
+    def handshake(self):
+        reply = self.request(b"qSupported:multiprocess-;swbreak+;hwbreak+;qRelocInsn-;"
+                             b"xmlRegisters=aarch64")
+        for feature in reply.split(b";"):
+            if b"=" in feature:
+                name, value = feature.split(b"=", 1)
+                self.features[name.decode()] = value.decode()
+            elif feature:
+                self.features[feature[:-1].decode()] = feature.endswith(b"+")
+        if "PacketSize" in self.features:
+            self.packet_size = int(self.features["PacketSize"], 16)
+        if self.features.get("QStartNoAckMode") is True:
+            if self.request(b"QStartNoAckMode") == b"OK":
+                self.ack = False
+        self.stop_reason = self.request(b"?")
+
+    @property
+    def max_read(self):
+        return min(RSP_MAX_READ, (self.packet_size - 0x10) // 2)
+
+    def read_memory(self, addr, size):
+        """ One reply per max_read bytes, pipelined when acks are off """
+        requests = [(position, min(self.max_read, addr + size - position))
+                    for position in range(addr, addr + size, self.max_read)]
+        depth = RSP_PIPELINE_DEPTH if not self.ack else 1
+        chunks = []
+        failed = None
+        for window in range(0, len(requests), depth):
+            batch = requests[window:window + depth]
+            payloads = [b"m%x,%x" % request for request in batch]
+            if self.ack:
+                self.send(payloads[0])
+            else:
+                self.send_many(payloads)
+            # read all the replies of the batch, even after an error
+            for position, length in batch:
+                reply = self.receive()
+                if failed is None and (reply.startswith(b"E") or len(reply) != length * 2):
+                    failed = position
+                elif failed is None:
+                    chunks.append(bytes.fromhex(reply.decode()))
+            if failed is not None:
+                raise RspMemoryError(f"Cannot access memory at address {hex(failed)}")
+        return b"".join(chunks)
+
+    def read_feature_xml(self, annex):
+        """ A file of the target description """
+        data = b""
+        while True:
+            reply = self.request(b"qXfer:features:read:%s:%x,%x" %
+                                 (annex.encode(), len(data), self.packet_size - 0x10))
+            if not reply or reply[:1] not in (b"m", b"l"):
+                raise RspError(f"qXfer of {annex} failed: {reply!r}")
+            data += reply[1:]
+            if reply[:1] == b"l":
+                return data
+
+    def load_registers(self):
+        """ Register name -> (regnum, size in bytes), from target.xml and its includes """
+        self.registers = {}
+        regnum = 0
+        annexes = ["target.xml"]
+        while annexes:
+            root = ElementTree.fromstring(self.read_feature_xml(annexes.pop(0)))
+            for element in root.iter():
+                tag = element.tag.rsplit("}", 1)[-1]
+                if tag == "include":
+                    annexes.append(element.get("href"))
+                elif tag == "reg":
+                    regnum = int(element.get("regnum", regnum))
+                    self.registers[element.get("name")] = \
+                        (regnum, int(element.get("bitsize")) // 8)
+                    regnum += 1
+        return self.registers
+
+    def read_register(self, name):
+        """ name with or without gdb's leading $, case insensitive for system registers """
+        if self.registers is None:
+            self.load_registers()
+        name = name.lstrip("$")
+        found = self.registers.get(name)
+        if found is None:
+            found = next((value for key, value in self.registers.items()
+                          if key.lower() == name.lower()), None)
+        if found is None:
+            raise RspError(f"Register {name} is not in the target description")
+        regnum, size = found
+        reply = self.request(b"p%x" % regnum)
+        if reply.startswith(b"E") or len(reply) != size * 2:
+            raise RspError(f"Reading register {name} failed: {reply!r}")
+        return int.from_bytes(bytes.fromhex(reply.decode()), "little")
+
+    def interrupt(self):
+        """ Stop a running target, returns the stop reply """
+        self.sock.sendall(b"\x03")
+        self.stop_reason = self.receive()
+        return self.stop_reason
+
+    def resume(self):
+        """ Continue, the stop reply comes with the next interrupt """
+        self.sock.sendall(rsp_frame(b"c"))
+
+    def close(self, detach=True):
+        """ Detaching lets QEMU run the VM again """
+        try:
+            if detach:
+                self.request(b"D")
+        except (RspError, OSError):
+            pass
+        self.sock.close()
+
+
+class RspBackend(utils.MemoryBackend):
+    """ The kernel memory through an RspClient """
+    def __init__(self, client):
+        self.client = client
+
+    def read_memory(self, addr, size):
+        try:
+            return self.client.read_memory(addr, size)
+        except RspMemoryError as error:
+            raise gdb.MemoryError(str(error))
+
+    def read_register(self, name):
+        try:
+            return self.client.read_register(name)
+        except RspError as error:
+            raise gdb.GdbError(str(error))
+
+
+def connect(address, timeout=RSP_TIMEOUT):
+    """ address - host:port """
+    host, _, port = address.rpartition(":")
+    return RspClient(host or "localhost", int(port), timeout)
@@ -0,0 +1,193 @@
+"""
+Statistical sampling of where the emulated kernel spends its time.
+xnu-sample lets the target run and interrupts it every 1/hz seconds.
+At every stop only pc, fp, lr, sp and the current thread are fetched, in one
+register round trip, and the stack above sp is read at once; the return
+addresses are taken from it and the target runs again right away.
+Symbols and process names are resolved once, after the last sample.
+"""
+import threading
+import time
+import traceback
+from collections import Counter, namedtuple
+import xnu.constants as const
+import xnu.utils as utils
+import xnu.sys_info as sys_info
+import xnu.xnu_types as types
+import gdb
+
+SAMPLE_REGISTERS = ["$pc", "$sp", "$x29", "$x30", const.CURRENT_THREAD]
+SAMPLE_DEFAULT_HZ = 100
+SAMPLE_DEFAULT_COUNT = 1000
+SAMPLE_DEFAULT_TOP = 20
+SAMPLE_USAGE = "xnu-sample [-hz ${HZ}] [-n ${SAMPLES}] [-t ${SECONDS}] [-top ${N}] " \
+    "[-collapsed ${FILE}]"
+USER_FRAME = "[user]"
+
+# chain - the return addresses found on the stack, innermost first
+Sample = namedtuple("Sample", ["thread", "pc", "lr", "chain"])
+
+
+def capture_sample():
+    """ The target is stopped: one register fetch and one stack read """
+    regs = utils.read_registers(SAMPLE_REGISTERS)
+    pc = regs["$pc"]
+    chain = ()
+    if sys_info.is_kernel_address(pc):
+        sp = regs["$sp"]
+        # the top of the stack is unknown, the frames beyond what is read are dropped
+        stack = types.read_stack(sp, cached=False)
+        chain = tuple(types.frame_chain(stack, sp, regs["$x29"]))
+    return Sample(regs[const.CURRENT_THREAD], pc, regs["$x30"], chain)
+
+
+def interrupt_target():
+    """ Runs in gdb's thread (see gdb.post_event), the target may have stopped already """
+    thread = gdb.selected_thread()
+    if thread is not None and thread.is_running():
+        gdb.execute("interrupt")
+
+
+def collect_samples(hz, count, seconds):
+    """ Resume, get interrupted, capture; until count samples or seconds elapsed.
+    Returns the samples and the time spent capturing them.
+    """
+    samples = []
+    capture_seconds = 0.0
+    deadline = time.monotonic() + seconds if seconds else None
+    try:
+        while len(samples) < count and (deadline is None or time.monotonic() < deadline):
+            timer = threading.Timer(1.0 / hz, gdb.post_event, (interrupt_target,))
+            timer.start()
+            try:
+                gdb.execute("continue", to_string=True)
+            finally:
+                timer.cancel()
+            start = time.perf_counter()
+            samples.append(capture_sample())
+            capture_seconds += time.perf_counter() - start
+    except KeyboardInterrupt:
+        # keep what was collected so far
+        pass
+    return samples, capture_seconds
+
+
+class SampleReport:
+    """ Per-function counts and collapsed stacks, every address symbolized once """
+    def __init__(self, samples):
+        self.samples = len(samples)
+        self.functions = {}
+        self.processes = {}
+        self.self_counts = Counter()
+        self.total_counts = Counter()
+        self.stacks = Counter()
+        for sample in samples:
+            stack = self.get_stack(sample)
+            self.self_counts[stack[0]] += 1
+            for function in set(stack):
+                self.total_counts[function] += 1
+            process = self.get_process_name(sample.thread)
+            self.stacks[";".join([process] + stack[::-1])] += 1
+
+    def get_function(self, addr):
+        if addr not in self.functions:
+            if not sys_info.is_kernel_address(addr):
+                name = USER_FRAME
+            else:
+                found = sys_info.get_symbols().lookup(addr)
+                name = hex(addr) if found is None else found[0]
+            self.functions[addr] = name
+        return self.functions[addr]
+
+    def get_stack(self, sample):
+        """ Function names, innermost first """
+        stack = [self.get_function(sample.pc)]
+        if stack[0] == USER_FRAME:
+            return stack
+        # a leaf function did not save lr, its caller is only there.
+        # elsewhere lr is either the saved one or stale, inside the function itself
+        caller = self.get_function(sample.lr) if sample.lr else stack[0]
+        if caller not in (stack[0], USER_FRAME) and sample.chain[:1] != (sample.lr,):
+            stack.append(caller)
+        stack += [self.get_function(addr) for addr in sample.chain]
+        return stack
+
+    def get_process_name(self, thread):
+        if thread not in self.processes:
+            try:
+                task = types.Thread(thread).task_object
+                name = task.bsdinfo_object.bsd_name \
+                    if task.initialized and task.bsdinfo_object.initialized else "N/A"
+            except gdb.GdbError:
+                name = "N/A"
+            self.processes[thread] = name.replace(";", "_").replace(" ", "_")
+        return self.processes[thread]
+
+    def format(self, top):
+        if self.samples == 0:
+            return "no samples\n"
+        out = f"{'self':>7} {'total':>7}  function\n"
+        for function, count in self.self_counts.most_common(top):
+            out += f"{100.0 * count / self.samples:>6.1f}% " \
+                f"{100.0 * self.total_counts[function] / self.samples:>6.1f}%  {function}\n"
+        return out
+
+    def write_collapsed(self, path):
+        """ One 'process;outer;...;inner count' line per distinct stack, for flamegraph.pl """
+        with open(path, "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+
+
+class SampleCommand(gdb.Command):
+    """ gdb command to sample where the kernel spends its time """
+    def __init__(self):
+        super(SampleCommand, self).__init__("xnu-sample", gdb.COMMAND_DATA)
+
+    def invoke(self, arg, from_tty):
+        """ xnu-sample [-hz ${HZ}] [-n ${SAMPLES}] [-t ${SECONDS}] [-top ${N}] [-collapsed ${FILE}]
+        -hz - interrupts per second, -n/-t - stop after that many samples or seconds
+        -collapsed - also write the stacks in the collapsed format of flame graphs
+        """
+        if sys_info.is_in_kernel_space() is False:
+            gdb.write("\nYou are currently in user space, "
+                      "this functionality is not available here.\n\n")
+            return
+        options = {"-hz": SAMPLE_DEFAULT_HZ, "-n": None, "-t": None,
+                   "-top": SAMPLE_DEFAULT_TOP, "-collapsed": None}
+        argv = gdb.string_to_argv(arg)
+        try:
+            while argv:
+                option = argv.pop(0)
+                if option not in options or not argv:
+                    raise ValueError(option)
+                value = argv.pop(0)
+                options[option] = value if option == "-collapsed" else float(value)
+            for option in ("-hz", "-n", "-t", "-top"):
+                if options[option] is not None and not 0 < options[option] < float("inf"):
+                    raise ValueError(option)
+        except ValueError:
+            gdb.write(f"\nUsage: {SAMPLE_USAGE}\n")
+            return
+        try:
+            count = options["-n"]
+            if count is None:
+                # -t alone samples for that long
+                count = SAMPLE_DEFAULT_COUNT if options["-t"] is None else float("inf")
+            start = time.perf_counter()
+            samples, capture_seconds = collect_samples(options["-hz"], count, options["-t"])
+            seconds = time.perf_counter() - start
+            report = SampleReport(samples)
+            out = f"\n{len(samples)} samples in {seconds:.2f}s"
+            if samples:
+                out += f", {1000 * capture_seconds / len(samples):.2f}ms per stop"
+            out += "\n" + report.format(int(options["-top"]))
+            if options["-collapsed"] is not None:
+                report.write_collapsed(options["-collapsed"])
+                out += f"{len(report.stacks)} stacks written to {options['-collapsed']}\n"
+            gdb.write(out)
+        except Exception:
+            raise gdb.GdbError(traceback.format_exc())
+
+
+SampleCommand()
@@ -0,0 +1,254 @@
+"""
+Offline snapshots of the kernel memory the helpers use.
+xnu-snapshot-save walks the kernel objects once while every page read is
+recorded, and dumps the pages and the registers to an indexed file.
+SnapshotBackend maps that file and serves the reads of xnu_types, zone and
+tasks from it, see offline.py to run the commands from a plain python process.
+
+File layout (little endian):
+    header    - magic, version, page size, pages count, registers json size
+    registers - json {"$name": value}, padded to 8 bytes
+    index     - sorted page addresses (Q), padded to a page
+    pages     - the pages, in the order of the index
+"""
+import bisect
+import json
+import mmap
+import os
+import struct
+import time
+import traceback
+import xnu.constants as const
+import xnu.utils as utils
+import xnu.sys_info as sys_info
+import xnu.xnu_types as types
+from xnu.zone import StructZone, ZoneWalker
+import gdb
+
+SNAPSHOT_MAGIC = b"XNUSNAP1"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<8sIIQQ")
+SNAPSHOT_REGISTERS = [const.CURRENT_THREAD, "$pc", "$sp", "$cpsr"] + \
+    [f"$x{i}" for i in range(31)]
+
+
+def align(value, alignment):
+    return (value + alignment - 1) & ~(alignment - 1)
+
+
+class RecordingBackend(utils.MemoryBackend):
+    """ Pass the reads to another backend and keep a copy of every page read """
+    def __init__(self, backend):
+        self.backend = backend
+        self.pages = {}
+        self.registers = {}
+
+    def read_memory(self, addr, size):
+        data = self.backend.read_memory(addr, size)
+        if addr & ~utils.PAGE_MASK == 0 and size & ~utils.PAGE_MASK == 0:
+            for offset in range(0, size, utils.PAGE_SIZE):
+                self.pages[addr + offset] = data[offset:offset + utils.PAGE_SIZE]
+            return data
+        # a partial read, keep the whole pages around it when they are readable
+        page_addr = addr & utils.PAGE_MASK
+        while page_addr < addr + size:
+            if page_addr not in self.pages:
+                try:
+                    self.pages[page_addr] = self.backend.read_memory(page_addr, utils.PAGE_SIZE)
+                except gdb.MemoryError:
+                    pass
+            page_addr += utils.PAGE_SIZE
+        return data
+
+    def read_register(self, name):
+        value = self.registers[name] = self.backend.read_register(name)
+        return value
+
+    def record_registers(self, names):
+        for name in names:
+            try:
+                self.read_register(name)
+            except Exception:
+                # not all the stubs expose all the registers
+                pass
+
+
+def write_snapshot(path, pages, registers):
+    """ Write the snapshot next to path, then move it in place """
+    addresses = sorted(pages)
+    registers_json = json.dumps(registers).encode()
+    registers_size = align(len(registers_json), 8)
+    index_end = align(SNAPSHOT_HEADER.size + registers_size + len(addresses) * 8,
+                      utils.PAGE_SIZE)
+    tmp_path = f"{path}.{os.getpid()}"
+    with open(tmp_path, "wb") as snapshot_file:
+        snapshot_file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                                                 utils.PAGE_SIZE, len(addresses),
+                                                 len(registers_json)))
+        snapshot_file.write(registers_json.ljust(registers_size, b"\x00"))
+        snapshot_file.write(struct.pack(f"<{len(addresses)}Q", *addresses))
+        snapshot_file.write(b"\x00" * (index_end - snapshot_file.tell()))
+        for addr in addresses:
+            snapshot_file.write(pages[addr])
+    os.replace(tmp_path, path)
+    return index_end + len(addresses) * utils.PAGE_SIZE
+
+
+class SnapshotBackend(utils.MemoryBackend):
+    """ Target memory and registers served from a snapshot file.
+    The file is mapped, pages are found by a binary search of the index
+    and nothing is read before it is needed.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as snapshot_file:
+            self.map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, page_size, count, registers_size = \
+            SNAPSHOT_HEADER.unpack_from(self.map)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise gdb.GdbError(f"{path} is not a snapshot of version {SNAPSHOT_VERSION}")
+        if page_size != utils.PAGE_SIZE:
+            raise gdb.GdbError(f"{path} has pages of {hex(page_size)} bytes")
+        start = SNAPSHOT_HEADER.size
+        self.registers = json.loads(bytes(self.map[start:start + registers_size]))
+        start += align(registers_size, 8)
+        self.addresses = memoryview(self.map)[start:start + count * 8].cast('Q')
+        self.pages_start = align(start + count * 8, utils.PAGE_SIZE)
+
+    def _page_offset(self, page_addr):
+        index = bisect.bisect_left(self.addresses, page_addr)
+        if index == len(self.addresses) or self.addresses[index] != page_addr:
+            raise gdb.MemoryError(f"Cannot access memory at address {hex(page_addr)}, "
+                                  f"not in the snapshot")
+        return self.pages_start + index * utils.PAGE_SIZE
+
+    def read_memory(self, addr, size):
+        chunks = []
+        position = addr
+        while position < addr + size:
+            page_addr = position & utils.PAGE_MASK
+            offset = self._page_offset(page_addr) + position - page_addr
+            length = min(addr + size, page_addr + utils.PAGE_SIZE) - position
+            chunks.append(self.map[offset:offset + length])
+            position += length
+        return b"".join(chunks)
+
+    def read_register(self, name):
+        try:
+            return self.registers[name]
+        except KeyError:
+            raise gdb.GdbError(f"Register {name} is not in the snapshot")
+
+    def stats(self):
+        return f"{self.path}: {len(self.addresses)} pages, {len(self.registers)} registers"
+
+
+def record_span(addr, size):
+    """ Read [addr, addr + size) to have it recorded, at once when all of it is
+    readable, else page by page. Returns the number of pages that could not be read.
+    Goes through the cache even when it is disabled, only to be recorded.
+    """
+    try:
+        utils.PAGE_CACHE.read(addr, size)
+        return 0
+    except gdb.MemoryError:
+        pass
+    unreadable = 0
+    page_addr = addr & utils.PAGE_MASK
+    while page_addr < addr + size:
+        try:
+            utils.PAGE_CACHE.read(page_addr, utils.PAGE_SIZE)
+        except gdb.MemoryError:
+            unreadable += 1
+        page_addr += utils.PAGE_SIZE
+    return unreadable
+
+
+def record_stack(thread):
+    """ What get_backtrace reads: the saved state at kstackptr, then the stack from
+    sp up to its top, sp from the registers for the current thread.
+    Returns the number of pages that could not be read.
+    """
+    if thread.is_currect():
+        sp = utils.read_registers(["$sp"])["$sp"]
+    else:
+        unreadable = record_span(thread.kernel_stack_ptr, types.SAVED_STATE_LAYOUT.end)
+        if unreadable:
+            return unreadable
+        sp = thread.kernel_saved_state.sp
+    if sp == const.NULL_PTR:
+        return 0
+    bottom, top = thread.kernel_stack_bounds
+    if not bottom <= sp < top:
+        # on another stack, get_backtrace only reads around sp
+        top = sp + types.STACK_READ_SIZE
+    return record_span(sp, top - sp)
+
+
+def record_kernel(stacks=True, zone_pages=False):
+    """ Walk everything the commands walk, the reads are recorded by the backend.
+    Returns the number of stack pages that could not be read.
+    """
+    sys_info.get_current_thread_ptr()
+    types.collect_thread_rows(is_global=True)
+    unreadable = 0
+    for thread in iter(types.ThreadsIterator(is_global=True)):
+        if stacks and thread.kernel_stack_ptr != const.NULL_PTR:
+            unreadable += record_stack(thread)
+        if thread.voucher_ptr != const.NULL_PTR:
+            types.ThreadVoucher(thread.voucher_ptr)
+    for task in iter(types.TasksIterator()):
+        space = task.ipc_space_object
+        if space.initialized is True and space.is_table_size:
+            used = types.scan_ipc_table(space.is_table, space.is_table_size)
+            utils.PAGE_CACHE.prefetch((entry[1] for entry in used if entry[1]),
+                                      types.IPC_PORT_LAYOUT.end)
+    for _, zone in StructZone.iter_valid_zones():
+        if zone_pages:
+            for _ in ZoneWalker(zone).walk():
+                pass
+    return unreadable
+
+
+class SnapshotSaveCommand(gdb.Command):
+    """ gdb command to dump the kernel memory the helpers use to a snapshot file """
+    def __init__(self):
+        super(SnapshotSaveCommand, self).__init__("xnu-snapshot-save", gdb.COMMAND_DATA)
+
+    def invoke(self, arg, from_tty):
+        """ xnu-snapshot-save ${FILE} [-no-stacks] [-zone-pages] """
+        if sys_info.is_in_kernel_space() is False:
+            gdb.write("\nYou are currently in user space, "
+                      "this functionality is not available here.\n\n")
+            return
+        try:
+            argv = gdb.string_to_argv(arg)
+            options = [argument for argument in argv if argument.startswith("-")]
+            argv = [argument for argument in argv if not argument.startswith("-")]
+            if len(argv) != 1 or set(options) - {"-no-stacks", "-zone-pages"}:
+                gdb.write("\nUsage: xnu-snapshot-save ${FILE} [-no-stacks] [-zone-pages]\n")
+                return
+            self.save(argv[0], "-no-stacks" not in options, "-zone-pages" in options)
+        except Exception:
+            raise gdb.GdbError(traceback.format_exc())
+
+    @staticmethod
+    def save(path, stacks, zone_pages):
+        start = time.perf_counter()
+        recorder = RecordingBackend(utils.BACKEND)
+        previous = utils.set_backend(recorder)
+        try:
+            recorder.record_registers(SNAPSHOT_REGISTERS)
+            unreadable = record_kernel(stacks, zone_pages)
+        finally:
+            utils.set_backend(previous)
+        if unreadable:
+            gdb.write(f"{unreadable} stack pages could not be read, "
+                      f"the backtraces of their threads will be incomplete\n")
+        size = write_snapshot(path, recorder.pages, recorder.registers)
+        gdb.write(f"{len(recorder.pages)} pages and {len(recorder.registers)} registers "
+                  f"({size >> 10}KB) saved to {path} in "
+                  f"{time.perf_counter() - start:.2f}s\n")
+
+
+SnapshotSaveCommand()
@@ -0,0 +1,73 @@
+"""
+Declarative description of the kernel structures we parse.
+A layout is a list of fields (name, offset, struct format, optional bitfield),
+it knows its extent, so a structure is fetched with a single read and all of
+its fields are decoded with a single unpack.
+"""
+import struct
+from collections import namedtuple
+import xnu.utils as utils
+
+
+class Field(namedtuple("Field", ["name", "offset", "fmt", "shift", "mask"])):
+    """ One field of a structure.
+    fmt is a struct format of one item ('Q', 'I', 'H', 'B', '17s'...).
+    When mask is given the value is (raw >> shift) & mask, several bitfields
+    may share the same offset and format.
+    """
+    __slots__ = ()
+
+    def __new__(cls, name, offset, fmt="Q", shift=0, mask=None):
+        return super(Field, cls).__new__(cls, name, offset, fmt, shift, mask)
+
+
+class StructLayout:
+    """ Decode all fields of a structure from one buffer.
+    read() returns a record (namedtuple) with a member per field.
+    """
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = tuple(fields)
+        slots = sorted({(field.offset, field.fmt) for field in self.fields})
+        self.start = slots[0][0]
+        fmt = "<"
+        position = self.start
+        for offset, field_fmt in slots:
+            if offset < position:
+                raise ValueError(f"{name}: field at {hex(offset)} overlaps its predecessor")
+            if offset > position:
+                fmt += f"{offset - position}x"
+            fmt += field_fmt
+            position = offset + struct.calcsize("<" + field_fmt)
+        self.end = position
+        self.size = self.end - self.start
+        self.struct = struct.Struct(fmt)
+        self.record = namedtuple(name, [field.name for field in self.fields])
+
+        slot_index = {slot: index for index, slot in enumerate(slots)}
+        self._decoders = tuple((slot_index[(field.offset, field.fmt)], field.shift, field.mask)
+                               for field in self.fields)
+        # when every field owns its slot and fields are sorted by offset
+        # the raw tuple is already the record
+        self._plain = all(mask is None for _, _, mask in self._decoders) and \
+            [index for index, _, _ in self._decoders] == list(range(len(slots)))
+
+    def read(self, address):
+        """ One read of the structure extent, one unpack of all the fields """
+        return self._decode(self.struct.unpack(utils.read_memory(address + self.start, self.size)))
+
+    def unpack_from(self, buffer, offset=0):
+        """ Decode the structure that starts (its offset 0) at offset of buffer """
+        return self._decode(self.struct.unpack_from(buffer, offset + self.start))
+
+    def _decode(self, raw):
+        if self._plain:
+            return self.record._make(raw)
+        return self.record._make(
+            raw[index] if mask is None else (raw[index] >> shift) & mask
+            for index, shift, mask in self._decoders)
+
+
+def c_string(raw):
+    """ Decode inline char array field """
+    return raw.split(b"\x00", 1)[0].decode("utf-8", errors="replace")
@@ -1,19 +1,34 @@
+import array
+import bisect
+import functools
 import json
+import mmap
 import os
+import struct
 import xnu.constants as const
 import xnu.utils as utils
 import gdb
 
+LOGGER = utils.LOGGER
+
 
 def get_current_task_ptr():
     try:
-        address = utils.print_val(const.CURRENT_THREAD)
+        address = get_current_thread_ptr()
         return utils.get_8_byte_at(address + const.ThreadOffsets.TASK.value)
     except Exception:
         raise gdb.GdbError(f"Error occured, maybe in user land?")
 
 
 def get_current_thread_ptr():
+    # every cpu is a gdb thread with its own TPIDR_EL1, and selecting
+    # another one does not end the stop
+    selected = gdb.selected_thread()
+    return _get_current_thread_ptr(None if selected is None else selected.ptid)
+
+
+@utils.stop_scoped
+def _get_current_thread_ptr(selected):
     try:
         return utils.print_val(const.CURRENT_THREAD)
     except Exception:
@@ -24,6 +39,10 @@ def is_user_thread(thread):
     return thread.ucontext_data != const.NULL_PTR
 
 
+def is_kernel_address(addr):
+    return addr >> 63 == 1
+
+
 def is_valid_ptr(ptr):
     try:
         utils.get_8_byte_at(ptr)
@@ -40,34 +59,167 @@ def is_in_kernel_space():
         return False
 
 
+# Addresses further than that from the closest preceding symbol stay raw,
+# the symbols have no sizes and many functions are not named
+MAX_SYMBOL_OFFSET = 0x1000
+SYMBOLS_CACHE_SIZE = 0x4000
+
+# Binary index: header, sorted addresses (Q), names offsets (I, count + 1), names blob
+SYMBOLS_INDEX_MAGIC = b"XNUSYMI1"
+SYMBOLS_INDEX_HEADER = struct.Struct("<8sQ")
+
+
 class Symbols:
     """ until implemented in the gdb itself
     symbols are taken from files manually exported from ghidra and jtool2
+    The json files are compiled once to a sorted binary index next to them,
+    later loads only map it. An address up to MAX_SYMBOL_OFFSET past a
+    known symbol resolves to name+0xoffset.
     """
 
     def __init__(self):
-        self.sym_dict = {}
-        self.found_fuct_name_dict = {}
         self.sym_dir_path = os.path.dirname(__file__)
+        self.sym_path = os.path.join(self.sym_dir_path, "SymbolsNew")
+        self.known_labels_path = os.path.join(self.sym_dir_path, "KnownLables")
+        self.index_path = os.path.join(self.sym_dir_path, "SymbolsNew.idx")
+        self.addresses = array.array('Q')
+        self.names_offsets = array.array('I', [0])
+        self.names = b""
+        # the whole index and where names start in it, searched by get_address
+        self.index = b""
+        self.names_start = 0
         self.load_symbols()
+        self.lookup = functools.lru_cache(maxsize=SYMBOLS_CACHE_SIZE)(self._lookup)
 
     def load_symbols(self):
-        with open(os.path.join(self.sym_dir_path, "SymbolsNew"), "r") as sym_file:
-            self.sym_dict = json.load(sym_file)
-        with open(os.path.join(self.sym_dir_path, "KnownLables"), "r") as known_func_name_file:
-            self.found_fuct_name_dict = json.load(known_func_name_file)
+        if not self._is_index_fresh():
+            index = self._build_index()
+            try:
+                self._write_index(index)
+            except OSError:
+                LOGGER.warning("Can not write %s, keeping the symbols in memory", self.index_path)
+                self._map_index(index)
+                return
+        with open(self.index_path, "rb") as index_file:
+            self._map_index(mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def _is_index_fresh(self):
+        try:
+            index_mtime = os.stat(self.index_path).st_mtime
+        except OSError:
+            return False
+        for path in (self.sym_path, self.known_labels_path):
+            if os.path.exists(path) and os.stat(path).st_mtime > index_mtime:
+                return False
+        return True
+
+    def _build_index(self):
+        """ Merge the json files into the binary index format.
+        Names from SymbolsNew win, unless they are ghidra's default FUN_ names
+        """
+        sym_dict = {}
+        for path in (self.known_labels_path, self.sym_path):
+            if not os.path.exists(path):
+                LOGGER.warning("Symbols file %s is missing", path)
+                continue
+            with open(path, "r") as sym_file:
+                for addrr, name in json.load(sym_file).items():
+                    addrr = int(addrr, 16)
+                    if 'FUN_' not in name or addrr not in sym_dict:
+                        sym_dict[addrr] = name
+
+        addresses = array.array('Q', sorted(sym_dict))
+        names = bytearray()
+        names_offsets = array.array('I', [0])
+        for addrr in addresses:
+            names += sym_dict[addrr].encode()
+            names_offsets.append(len(names))
+        return b"".join([SYMBOLS_INDEX_HEADER.pack(SYMBOLS_INDEX_MAGIC, len(addresses)),
+                         addresses.tobytes(), names_offsets.tobytes(), bytes(names)])
+
+    def _write_index(self, index):
+        tmp_path = f"{self.index_path}.{os.getpid()}"
+        with open(tmp_path, "wb") as index_file:
+            index_file.write(index)
+        os.replace(tmp_path, self.index_path)
+
+    def _map_index(self, index):
+        magic, count = SYMBOLS_INDEX_HEADER.unpack_from(index)
+        if magic != SYMBOLS_INDEX_MAGIC:
+            raise gdb.GdbError(f"{self.index_path} is not a symbols index, delete it")
+        view = memoryview(index)
+        start = SYMBOLS_INDEX_HEADER.size
+        self.addresses = view[start:start + count * 8].cast('Q')
+        start += count * 8
+        self.names_offsets = view[start:start + (count + 1) * 4].cast('I')
+        start += (count + 1) * 4
+        self.names = view[start:]
+        self.index = index
+        self.names_start = start
+
+    def _name_at(self, index):
+        return bytes(self.names[self.names_offsets[index]:self.names_offsets[index + 1]]).decode()
+
+    def _lookup(self, addrr):
+        """ (name, offset) of the closest symbol at or below addrr, or None """
+        index = bisect.bisect_right(self.addresses, addrr) - 1
+        if index < 0:
+            return None
+        offset = addrr - self.addresses[index]
+        if offset > MAX_SYMBOL_OFFSET:
+            return None
+        return self._name_at(index), offset
+
+    def get_address(self, name):
+        """ Address of the symbol with exactly that name, or None """
+        needle = name.encode()
+        # searched in place, the index may be a mapping of the file
+        found = self.index.find(needle, self.names_start)
+        while found != -1:
+            position = found - self.names_start
+            index = bisect.bisect_right(self.names_offsets, position) - 1
+            if self.names_offsets[index] == position and \
+                    self.names_offsets[index + 1] == position + len(needle):
+                return self.addresses[index]
+            found = self.index.find(needle, found + 1)
+        return None
 
     def get_symbol_internal(self, addrr):
-        if addrr in self.sym_dict:
-            if 'FUN_' not in self.sym_dict[addrr]:
-                return self.sym_dict[addrr]
-        if addrr in self.found_fuct_name_dict:
-            return self.found_fuct_name_dict[addrr]
-        return addrr
+        try:
+            addrr_value = int(addrr, 16) if isinstance(addrr, str) else addrr
+        except ValueError:
+            return addrr
+        found = self.lookup(addrr_value)
+        if found is None:
+            return addrr
+        name, offset = found
+        if offset == 0 and name.lower() == f"fun_{addrr_value:x}":
+            # ghidra's default name of that very address carries no more info
+            return addrr
+        return name if offset == 0 else f"{name}+{hex(offset)}"
+
+
+# loaded on first lookup, see get_symbols
+SYMBOLS = None
 
 
-SYMBOLS = Symbols()
+def get_symbols():
+    global SYMBOLS
+    if SYMBOLS is None:
+        SYMBOLS = Symbols()
+    return SYMBOLS
 
 
 def get_symbol(addrr):
-    return SYMBOLS.get_symbol_internal(addrr)
+    if utils.PROFILE is not None:
+        return utils.PROFILE.time_symbol(get_symbols().get_symbol_internal, addrr)
+    return get_symbols().get_symbol_internal(addrr)
+
+
+def get_symbol_address(name):
+    """ Address of a kernel global by its name, with or without the leading underscore """
+    symbols = get_symbols()
+    address = symbols.get_address(name)
+    if address is None and not name.startswith("_"):
+        address = symbols.get_address("_" + name)
+    return address
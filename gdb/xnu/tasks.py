@@ -1,8 +1,12 @@
 """ This module exposes functions available to user from th gdb """
+import cProfile
+import re
+import time
 import traceback
 import xnu.xnu_types as types
 import xnu.sys_info as sys_info
 import xnu.utils as utils
+import xnu.export as export
 
 import gdb
 
@@ -19,21 +23,22 @@ class PrintThreadList(gdb.Command):
         All user threads - xnu-threads user
         All threads whithin the system - xnu-threads
         All threads of specific task - xnu-threads ${task_ptr}
+        Any of them with --format jsonl/csv [--out ${FILE}] streams records instead
         """
         if sys_info.is_in_kernel_space() is False:
             gdb.write("\nYou are currently in user space, "
                       "this functionality is not available here.\n\n")
             return
         try:
-            argv = gdb.string_to_argv(arg)
+            argv, writer = export.parse_export_args(gdb.string_to_argv(arg))
             if len(argv) == 0:
-                self.print_all_threads(is_global=True)
+                self.print_all_threads(is_global=True, writer=writer)
             elif len(argv) == 1:
                 if argv[0] == "user":
-                    self.print_all_threads(user_only=True, is_global=True)
+                    self.print_all_threads(user_only=True, is_global=True, writer=writer)
                 elif argv[0] == "current":
                     task = sys_info.get_current_task_ptr()
-                    self.print_all_threads(task=task)
+                    self.print_all_threads(task=task, writer=writer)
                 else:
                     try:
                         requested_task = int(argv[0], 0)
@@ -41,7 +46,7 @@ class PrintThreadList(gdb.Command):
                             if not types.is_task_exist(requested_task):
                                 gdb.write(f"\nRequested task {argv[0]} do not exist"
                                           f" in the tasks list of the system!\n\n\n")
-                            self.print_all_threads(task=requested_task)
+                            self.print_all_threads(task=requested_task, writer=writer)
                     except Exception:
                         gdb.write("\nUsage: xnu-threads ${TASK_PTR}\n")
             else:
@@ -49,37 +54,123 @@ class PrintThreadList(gdb.Command):
         except Exception:
             raise gdb.GdbError(traceback.format_exc())
 
-    def print_all_threads(self, user_only=False, is_global=False, task=None):
-        """ Iterate over threads iterator and print data for each """
-        counter = 0
-        max_length_proc = types.get_max_length_proc_name()
-        max_length_cont = types.get_max_length_cont_name()
-        max_length_pc = types.get_max_length_pc_name()
-        gdb.write(
-            types.get_thead_info_title(max_length_proc, max_length_cont, max_length_pc)+'\n')
-        for thread in iter(types.ThreadsIterator(is_global, task)):
-            if user_only is False or sys_info.is_user_thread(thread):
-                counter += 1
-                gdb.write(thread.print_thead_info_short(
-                    max_length_proc, max_length_cont, max_length_pc)+'\n')
-        gdb.write(f"TOTAL {counter}\n")
+    def print_all_threads(self, user_only=False, is_global=False, task=None, writer=None):
+        """ Collect the threads table in one walk, then print it """
+        if writer is not None:
+            with writer:
+                writer.write_all(types.thread_row_record(row) for row in
+                                 types.iter_thread_rows(is_global, task, user_only))
+            return
+        rows = types.collect_thread_rows(is_global, task, user_only)
+        widths = types.get_thread_rows_widths(rows)
+        gdb.write(types.get_thead_info_title(*widths)+'\n')
+        gdb.write("".join(types.print_thread_row(row, *widths)+'\n' for row in rows))
+        gdb.write(f"TOTAL {len(rows)}\n")
 
 
 PrintThreadList()
 
 
+class PrintBacktraceAll(gdb.Command):
+    """ Gdb command to print the kernel backtrace of every thread """
+    def __init__(self):
+        super(PrintBacktraceAll, self).__init__("xnu-bt-all", gdb.COMMAND_DATA)
+
+    def invoke(self, arg, from_tty):
+        """ xnu-bt-all [user/current/${TASK_PTR}] [-group] [--format jsonl/csv] [--out ${FILE}]
+        Threads are selected like in xnu-threads.
+        -group - print every distinct stack once, with the threads sharing it
+        """
+        if sys_info.is_in_kernel_space() is False:
+            gdb.write("\nYou are currently in user space, "
+                      "this functionality is not available here.\n\n")
+            return
+        try:
+            argv, writer = export.parse_export_args(gdb.string_to_argv(arg))
+            group = "-group" in argv
+            argv = [argument for argument in argv if argument != "-group"]
+            if len(argv) > 1:
+                gdb.write("\nUsage: xnu-bt-all [user/current/${TASK_PTR}] [-group]\n")
+                return
+            selection = argv[0] if argv else None
+            if selection is None or selection == "user":
+                threads = types.ThreadsIterator(is_global=True)
+            elif selection == "current":
+                threads = types.ThreadsIterator(task=sys_info.get_current_task_ptr())
+            else:
+                try:
+                    # is_valid_ptr raises on a pointer it can not read
+                    requested_task = int(selection, 0)
+                    sys_info.is_valid_ptr(requested_task)
+                except (ValueError, gdb.GdbError):
+                    gdb.write("\nUsage: xnu-bt-all [user/current/${TASK_PTR}] [-group]\n")
+                    return
+                if not types.is_task_exist(requested_task):
+                    gdb.write(f"\nRequested task {selection} do not exist"
+                              f" in the tasks list of the system!\n\n\n")
+                    return
+                threads = types.ThreadsIterator(task=requested_task)
+            threads = [thread for thread in iter(threads)
+                       if selection != "user" or sys_info.is_user_thread(thread)]
+            backtraces = types.collect_backtraces(threads)
+            if writer is not None:
+                with writer:
+                    writer.write_all(types.backtrace_record(thread, frames)
+                                     for thread, frames in backtraces)
+            elif group:
+                self.print_grouped(backtraces)
+            else:
+                self.print_all(backtraces)
+        except Exception:
+            raise gdb.GdbError(traceback.format_exc())
+
+    @staticmethod
+    def print_all(backtraces):
+        for thread, frames in backtraces:
+            pid, name = thread.process
+            gdb.write(f"\nthread {hex(thread.address)} tid {thread.tid} "
+                      f"[{'X' if pid is None else pid}] {name}\n")
+            gdb.write(types.print_backtrace(frames))
+        gdb.write(f"TOTAL {len(backtraces)}\n")
+
+    @staticmethod
+    def print_grouped(backtraces):
+        """ Most shared stacks first, the user pcs are left out of the comparison """
+        groups = {}
+        for thread, frames in backtraces:
+            kernel_frames = tuple(addr for addr in frames if sys_info.is_kernel_address(addr))
+            groups.setdefault(kernel_frames, []).append(thread)
+        for frames, threads in sorted(groups.items(), key=lambda item: -len(item[1])):
+            names = sorted({thread.process[1] for thread in threads})
+            gdb.write(f"\n{len(threads)} threads of {', '.join(names)}\n")
+            gdb.write(types.print_backtrace(frames))
+        gdb.write(f"TOTAL {len(backtraces)} threads, {len(groups)} distinct stacks\n")
+
+
+PrintBacktraceAll()
+
+
 class PrintTaskList(gdb.Command):
     """ Gdb command to print all tasks """
     def __init__(self):
         super(PrintTaskList, self).__init__("xnu-tasks", gdb.COMMAND_DATA)
 
     def invoke(self, arg, from_tty):
-        """ Go over task iterator and print all task data """
+        """ Go over task iterator and print all task data
+        xnu-tasks [--format jsonl/csv] [--out ${FILE}]
+        """
         if sys_info.is_in_kernel_space() is False:
             gdb.write("\nYou are currently in user space, "
                       "this functionality is not available here.\n\n")
             return
         try:
+            _, writer = export.parse_export_args(gdb.string_to_argv(arg))
+            if writer is not None:
+                current_task = sys_info.get_current_task_ptr()
+                with writer:
+                    writer.write_all(task.to_record(current_task)
+                                     for task in iter(types.TasksIterator()))
+                return
             max_length_proc = types.get_max_length_proc_name()
             for task in iter(types.TasksIterator()):
                 gdb.write(task.print_task_info_short(max_length_proc)+'\n')
@@ -152,15 +243,18 @@ class PrintThreadInfo(gdb.Command):
                       "this functionality is not available here.\n\n")
             return
         try:
-            argv = gdb.string_to_argv(arg)
+            argv, writer = export.parse_export_args(gdb.string_to_argv(arg))
             if len(argv) == 1:
                 thread = int(argv[0], 0)
-                if types.is_thread_exist(thread):
+                if types.is_thread_exist(thread) and writer is not None:
+                    with writer:
+                        writer.write(types.Thread(thread).to_record())
+                elif types.is_thread_exist(thread):
                     gdb.write(types.Thread(thread).print_thread_info_long()+'\n')
                 else:
                     gdb.write("Given thread do not exist\n")
             else:
-                gdb.write("\nUsage: xnu-thread-info ${THREAD_PTR}\n")
+                gdb.write(f"\nUsage: xnu-thread-info ${{THREAD_PTR}} {export.EXPORT_USAGE}\n")
         except Exception:
             raise gdb.GdbError(traceback.format_exc())
 
@@ -180,7 +274,7 @@ class PrintTaskInfo(gdb.Command):
                       "this functionality is not available here.\n\n")
             return
         try:
-            argv = gdb.string_to_argv(arg)
+            argv, writer = export.parse_export_args(gdb.string_to_argv(arg))
             if len(argv) == 1:
                 """convert to integer"""
                 task = int(argv[0], 0)
@@ -188,11 +282,16 @@ class PrintTaskInfo(gdb.Command):
                     if not types.is_task_exist(task):
                         gdb.write(f"\nRequested task {argv[0]} do not exist in the task "
                                   f"list of the system!\n\n\n")
-                    gdb.write(types.Task(task).print_task_info_long()+'\n')
+                    if writer is not None:
+                        with writer:
+                            writer.write(types.Task(task).to_record(
+                                sys_info.get_current_task_ptr()))
+                    else:
+                        gdb.write(types.Task(task).print_task_info_long()+'\n')
                 else:
                     gdb.write("Given task do not exist\n")
             else:
-                gdb.write("\nUsage: xnu-task-info ${TASK_PTR}\n")
+                gdb.write(f"\nUsage: xnu-task-info ${{TASK_PTR}} {export.EXPORT_USAGE}\n")
         except Exception:
             raise gdb.GdbError(traceback.format_exc())
 
@@ -216,10 +315,14 @@ class PrintVoucherInfo(gdb.Command):
                       "this functionality is not available here.\n\n")
             return
         try:
-            argv = gdb.string_to_argv(arg)
+            argv, writer = export.parse_export_args(gdb.string_to_argv(arg))
             if len(argv) == 1 and sys_info.is_valid_ptr(int(argv[0], 0)):
                 voucher = int(argv[0], 0)
-                gdb.write(types.ThreadVoucher(voucher).print_voucher_info()+'\n')
+                if writer is not None:
+                    with writer:
+                        writer.write(types.ThreadVoucher(voucher).to_record())
+                else:
+                    gdb.write(types.ThreadVoucher(voucher).print_voucher_info()+'\n')
             else:
                 gdb.write("\nUsage: xnu-voucher-info ${THREAD_PTR} "
                           "(maybe wrong pointer?)\n")
@@ -246,12 +349,16 @@ class PrintIpcPortInfo(gdb.Command):
                       "this functionality is not available here.\n\n")
             return
         try:
-            argv = gdb.string_to_argv(arg)
+            argv, writer = export.parse_export_args(gdb.string_to_argv(arg))
             if len(argv) == 1 and sys_info.is_valid_ptr(int(argv[0], 0)):
                 ipc_port = int(argv[0], 0)
-                gdb.write(types.IPCPort(ipc_port).print_ipc_port_info()+'\n')
+                if writer is not None:
+                    with writer:
+                        writer.write(types.IPCPort(ipc_port).to_record())
+                else:
+                    gdb.write(types.IPCPort(ipc_port).print_ipc_port_info()+'\n')
             else:
-                gdb.write("\nUsage: xnu-ipc-port-info ${IPC_PORT_PTR}\n")
+                gdb.write(f"\nUsage: xnu-ipc-port-info ${{IPC_PORT_PTR}} {export.EXPORT_USAGE}\n")
         except Exception:
             raise gdb.GdbError(traceback.format_exc())
 
@@ -277,17 +384,17 @@ class PrintIPCEntryList(gdb.Command):
                       "this functionality is not available here.\n\n")
             return
         try:
-            argv = gdb.string_to_argv(arg)
+            argv, writer = export.parse_export_args(gdb.string_to_argv(arg))
             if len(argv) == 2 and sys_info.is_valid_ptr(int(argv[1], 0)):
                 if argv[0] == "-task":
                     task = int(argv[1], 0)
                     if not types.is_task_exist(task):
                         gdb.write(f"\nRequested task {argv[1]} do not exist in the tasks"
                                   f"list of the system!\n\n\n")
-                    self.print_ipc_space_table(types.Task(task).ipc_space)
+                    self.print_ipc_space_table(types.Task(task).ipc_space, writer)
                 elif argv[0] == "-space":
                     space = int(argv[1], 0)
-                    self.print_ipc_space_table(space)
+                    self.print_ipc_space_table(space, writer)
                 else:
                     gdb.write(
                         "\nUsage: xnu-ipc_entry-list -task/space"
@@ -298,8 +405,13 @@ class PrintIPCEntryList(gdb.Command):
         except Exception:
             raise gdb.GdbError(traceback.format_exc())
 
-    def print_ipc_space_table(self, address):
+    def print_ipc_space_table(self, address, writer=None):
         """ print info """
+        if writer is not None:
+            with writer:
+                writer.write_all(entry.to_record() for entry in
+                                 iter(types.IPCEntryIterator(address, with_objects=False)))
+            return
         gdb.write("=================================================\n")
         gdb.write(types.IPCSpace(address).print_ipc_space_info())
         gdb.write("=================================================\n\n")
@@ -309,3 +421,152 @@ class PrintIPCEntryList(gdb.Command):
 
 
 PrintIPCEntryList()
+
+
+class PrintPortRights(gdb.Command):
+    """
+    gdb command to find who holds rights to ipc ports, across all the tasks
+    xnu kernel ref:
+    darwin-xnu/osfmk/ipc/ipc_space.h  (ipc_space)
+    darwin-xnu/osfmk/ipc/ipc_entry.h  (ipc_entry)
+    """
+    def __init__(self):
+        super(PrintPortRights, self).__init__("xnu-port-rights", gdb.COMMAND_DATA)
+
+    def invoke(self, arg, from_tty):
+        """ xnu-port-rights ${IPC_PORT_PTR} [send/receive/send-once/dead-name]
+        xnu-port-rights -shared [${MIN_TASKS}]
+        The index is built once per stop """
+        if sys_info.is_in_kernel_space() is False:
+            gdb.write("\nYou are currently in user space, "
+                      "this functionality is not available here.\n\n")
+            return
+        try:
+            argv, writer = export.parse_export_args(gdb.string_to_argv(arg))
+            if len(argv) in (1, 2) and argv[0] == "-shared":
+                self.print_shared(int(argv[1], 0) if len(argv) == 2 else 2, writer)
+            elif len(argv) in (1, 2):
+                self.print_holders(int(argv[0], 0), argv[1] if len(argv) == 2 else None, writer)
+            else:
+                gdb.write("\nUsage: xnu-port-rights ${IPC_PORT_PTR} [send/receive/send-once]\n"
+                          "       xnu-port-rights -shared [${MIN_TASKS}]\n")
+        except Exception:
+            raise gdb.GdbError(traceback.format_exc())
+
+    def print_holders(self, port, right, writer=None):
+        holders = types.get_port_rights_index().get_holders(port, right)
+        if writer is not None:
+            with writer:
+                writer.write_all(types.port_right_record(port, holder) for holder in holders)
+            return
+        out = f"{len(holders)} {right + ' ' if right else ''}rights to {hex(port)}:\n"
+        out += "".join(types.print_port_right(holder)+'\n' for holder in holders)
+        gdb.write(out)
+
+    def print_shared(self, min_tasks, writer=None):
+        index = types.get_port_rights_index()
+        shared = index.get_shared_ports(min_tasks)
+        if writer is not None:
+            with writer:
+                writer.write_all(types.port_right_record(port, holder)
+                                 for port, holders in shared for holder in holders)
+            return
+        gdb.write(f"{len(shared)} ports held by {min_tasks} tasks or more "
+                  f"({index.entries} entries in {index.tasks} spaces):\n")
+        for port, holders in shared:
+            out = f"{hex(port)} - {len(holders)} rights:\n"
+            out += "".join(types.print_port_right(holder)+'\n' for holder in holders)
+            gdb.write(out)
+
+
+PrintPortRights()
+
+
+class PageCacheControl(gdb.Command):
+    """ gdb command to inspect and control the per-stop page cache of target memory """
+    def __init__(self):
+        super(PageCacheControl, self).__init__("xnu-cache", gdb.COMMAND_DATA)
+
+    def invoke(self, arg, from_tty):
+        """ xnu-cache [stats|flush|reset|on|off] """
+        try:
+            argv = gdb.string_to_argv(arg)
+            if len(argv) == 0 or argv[0] == "stats":
+                pass
+            elif argv[0] == "flush":
+                utils.PAGE_CACHE.flush()
+            elif argv[0] == "reset":
+                utils.PAGE_CACHE.reset_stats()
+            elif argv[0] in ("on", "off"):
+                utils.PAGE_CACHE.flush()
+                utils.PAGE_CACHE.enabled = (argv[0] == "on")
+            else:
+                gdb.write("\nUsage: xnu-cache [stats|flush|reset|on|off]\n")
+                return
+            gdb.write(utils.PAGE_CACHE.stats() + '\n')
+        except Exception:
+            raise gdb.GdbError(traceback.format_exc())
+
+
+PageCacheControl()
+
+
+# one argument, maybe quoted, and the spaces after it
+PROFILE_ARG_TOKEN = re.compile(r"""("[^"]*"|'[^']*'|\S+)\s*""")
+
+
+class ProfileCommand(gdb.Command):
+    """ gdb command to run another xnu command and show where its time went """
+    def __init__(self):
+        super(ProfileCommand, self).__init__("xnu-profile", gdb.COMMAND_DATA)
+
+    def invoke(self, arg, from_tty):
+        """ xnu-profile [-cold] [-pstats ${FILE}] ${COMMAND}
+        -cold - flush the page cache first, every page is then read from the target
+        -pstats - also run the command under cProfile and dump the stats to the file
+        """
+        # the command is passed on as typed, quoting included
+        command = arg.strip()
+        cold = False
+        pstats_path = None
+        while True:
+            option = PROFILE_ARG_TOKEN.match(command)
+            if option is None or option.group(1) not in ("-cold", "-pstats"):
+                break
+            command = command[option.end():]
+            if option.group(1) == "-cold":
+                cold = True
+                continue
+            value = PROFILE_ARG_TOKEN.match(command)
+            if value is not None:
+                pstats_path = gdb.string_to_argv(value.group(1))[0]
+                command = command[value.end():]
+        if not command:
+            gdb.write("\nUsage: xnu-profile [-cold] [-pstats ${FILE}] ${COMMAND}\n")
+            return
+        if cold:
+            utils.PAGE_CACHE.flush()
+        hits, misses = utils.PAGE_CACHE.hits, utils.PAGE_CACHE.misses
+        profiler = cProfile.Profile() if pstats_path else None
+        profile = utils.start_profile()
+        start = time.perf_counter()
+        try:
+            if profiler is not None:
+                profiler.enable()
+            gdb.execute(command, from_tty)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            total_seconds = time.perf_counter() - start
+            utils.stop_profile()
+        out = f"\n{command}\n"
+        out += profile.format(total_seconds)
+        out += f"page cache: {utils.PAGE_CACHE.hits - hits} hits, "\
+            f"{utils.PAGE_CACHE.misses - misses} pages missed\n"
+        if profiler is not None:
+            profiler.dump_stats(pstats_path)
+            out += f"cProfile stats written to {pstats_path}\n"
+        gdb.write(out)
+
+
+ProfileCommand()
@@ -1,62 +1,435 @@
+import abc
+import functools
 import traceback
 import logging
+import os
+import struct
+import sys
+import time
+from collections import Counter
 import gdb
 from xnu.constants import NULL_PTR_STR
 
 LOGGER = logging.getLogger("xnu")
 
+# Longest string we are willing to read with get_string_at
+MAX_STRING_LENGTH = 0x400
+STRING_READ_CHUNK = 0x40
 
-def get_8_byte_at(addr):
-    return execute_get_val(addr, 'g')
+U64 = struct.Struct("<Q")
+U32 = struct.Struct("<I")
 
 
-def get_4_byte_at(addr):
-    return execute_get_val(addr, 'w')
+PAGE_SIZE = 0x1000
+PAGE_MASK = ~(PAGE_SIZE - 1)
+# Drop everything if a single stop reads more than that (64MB)
+MAX_CACHED_PAGES = 0x4000
 
 
-def get_string_at(value):
-    return execute_get_string(value)
+class PageCache:
+    """ While the target is halted kernel memory can not change, so every page
+    read during a stop is kept until gdb resumes the target or changes
+    memory/registers itself (see the events connected at the bottom).
+    """
+    def __init__(self):
+        self.pages = {}
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        # results of stop_scoped functions, dropped together with the pages
+        self.memos = []
 
+    def flush(self, event=None):
+        if self.pages:
+            self.flushes += 1
+        self.pages.clear()
+        for memo in self.memos:
+            memo.clear()
 
-def execute_get_string(value):
-    try:
-        command = f"x /1s {str(value)}"
-        LOGGER.debug("Going to excute %s ", command)
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+
+    def read(self, addr, size):
+        first = addr & PAGE_MASK
+        last = (addr + size - 1) & PAGE_MASK
+        offset = addr - first
+        if first == last:
+            page = self.pages.get(first)
+            if page is None:
+                page = self._fetch(first, first)
+            else:
+                self.hits += 1
+            return page[offset:offset + size]
+
+        chunks = []
+        page_addr = first
+        while page_addr <= last:
+            page = self.pages.get(page_addr)
+            if page is not None:
+                self.hits += 1
+                chunks.append(page)
+                page_addr += PAGE_SIZE
+                continue
+            # fetch the whole run of missing pages in one request
+            run_last = page_addr
+            while run_last < last and (run_last + PAGE_SIZE) not in self.pages:
+                run_last += PAGE_SIZE
+            self._fetch(page_addr, run_last)
+            while page_addr <= run_last:
+                chunks.append(self.pages[page_addr])
+                page_addr += PAGE_SIZE
+        return b"".join(chunks)[offset:offset + size]
+
+    def _fetch(self, first, last):
+        """ Read pages [first, last] from the target and store them,
+        return the first one """
+        if len(self.pages) > MAX_CACHED_PAGES:
+            self.flush()
+        data = _read_target_memory(first, last + PAGE_SIZE - first)
+        count = (last - first) // PAGE_SIZE + 1
+        self.misses += count
+        for i in range(count):
+            self.pages[first + i * PAGE_SIZE] = data[i * PAGE_SIZE:(i + 1) * PAGE_SIZE]
+        return self.pages[first]
+
+    def prefetch(self, addr_iter, size):
+        """ Make sure the spans [addr, addr + size) are cached, pages holding
+        several spans are read once and adjacent missing pages in one request
+        """
+        self.prefetch_spans((addr, size) for addr in addr_iter)
+
+    def prefetch_spans(self, spans):
+        """ Like prefetch, for (addr, size) spans of different sizes """
+        missing = set()
+        for addr, size in spans:
+            page_addr = addr & PAGE_MASK
+            while page_addr < addr + size:
+                if page_addr not in self.pages:
+                    missing.add(page_addr)
+                page_addr += PAGE_SIZE
+        missing = sorted(missing)
+        run_start = 0
+        for i, page_addr in enumerate(missing):
+            if i + 1 == len(missing) or missing[i + 1] != page_addr + PAGE_SIZE:
+                try:
+                    self._fetch(missing[run_start], page_addr)
+                except gdb.MemoryError:
+                    # read it (and fail) when it is really used
+                    pass
+                run_start = i + 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        ratio = (100.0 * self.hits / total) if total else 0.0
+        return (f"page cache: {'enabled' if self.enabled else 'disabled'}, "
+                f"{len(self.pages)} pages held, {self.hits} hits, {self.misses} misses "
+                f"({ratio:.1f}% hit rate), {self.flushes} flushes")
+
+
+PAGE_CACHE = PageCache()
+
+
+class MemoryBackend(abc.ABC):
+    """ Where the target memory and registers come from.
+    read_memory returns exactly size bytes or raises gdb.MemoryError,
+    every call is one round trip to the target.
+    """
+    @abc.abstractmethod
+    def read_memory(self, addr, size):
+        pass
+
+    @abc.abstractmethod
+    def read_register(self, name):
+        """ name as gdb spells it, '$pc', '$TPIDR_EL1'... """
+
+    def read_registers(self, names):
+        """ {name: value}, backends that can should fetch them at once """
+        return {name: self.read_register(name) for name in names}
+
+
+class GdbBackend(MemoryBackend):
+    """ Target memory and registers, as seen by the gdb session """
+    def read_memory(self, addr, size):
+        return gdb.selected_inferior().read_memory(addr, size).tobytes()
+
+    def read_register(self, name):
+        command = f"print /1x {name}"
         res = gdb.execute(command, to_string=True)
-        res = " ".join(res.split()[1:])
-        LOGGER.debug("Got a result %s ", str(res))
-        return res
-    except Exception:
-        raise gdb.GdbError(traceback.format_exc())
+        return int(res.split()[2], 0)
+
+    def read_registers(self, names):
+        """ One 'info registers' for all of them """
+        wanted = {name.lstrip("$").lower(): name for name in names}
+        res = gdb.execute("info registers " + " ".join(name.lstrip("$") for name in names),
+                          to_string=True)
+        values = {}
+        for line in res.splitlines():
+            words = line.split()
+            if len(words) >= 2 and words[0].lower() in wanted:
+                values[wanted[words[0].lower()]] = int(words[1], 0)
+        missing = [name for name in names if name not in values]
+        if missing:
+            raise gdb.GdbError(f"Invalid registers {', '.join(missing)}")
+        return values
+
+
+# where the target memory and registers come from, see set_backend
+BACKEND = GdbBackend()
+
+
+def set_backend(backend, flush=True):
+    """ Read the target through backend from now on (a snapshot file for example),
+    returns the previous backend. flush=False when backend sees the same target.
+    """
+    global BACKEND
+    previous = BACKEND
+    if flush:
+        PAGE_CACHE.flush()
+    BACKEND = backend
+    return previous
+
+
+# upper bounds of the latency histogram buckets, in microseconds
+LATENCY_BUCKETS_US = [10, 100, 1000, 10000, 100000]
+# call sites are the first frames outside of these files
+PROFILE_SKIP_FILES = {os.path.join(os.path.dirname(__file__), name)
+                      for name in ("utils.py", "struct_layout.py")}
+
+
+class Profile:
+    """ What a command cost: the target round trips, the registers reads
+    and the symbol lookups. Only exists while xnu-profile runs a command.
+    """
+    def __init__(self):
+        self.reads = 0
+        self.bytes_read = 0
+        self.read_seconds = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS_US) + 1)
+        self.sites = Counter()
+        self.registers = 0
+        self.register_seconds = 0.0
+        self.symbols = 0
+        self.symbol_seconds = 0.0
+
+    def add_read(self, size, seconds):
+        self.reads += 1
+        self.bytes_read += size
+        self.read_seconds += seconds
+        micros = seconds * 1e6
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS_US) and micros > LATENCY_BUCKETS_US[bucket]:
+            bucket += 1
+        self.histogram[bucket] += 1
+        frame = sys._getframe(2)
+        while frame is not None and frame.f_code.co_filename in PROFILE_SKIP_FILES:
+            frame = frame.f_back
+        if frame is not None:
+            self.sites[f"{os.path.basename(frame.f_code.co_filename)}:"
+                       f"{frame.f_lineno} {frame.f_code.co_name}"] += 1
+
+    def time_symbol(self, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.symbols += 1
+            self.symbol_seconds += time.perf_counter() - start
+
+    def format(self, total_seconds, top_sites=10):
+        other = total_seconds - self.read_seconds - self.register_seconds - self.symbol_seconds
+        out = f"total: {total_seconds * 1000:.1f}ms\n"
+        out += f"  memory reads: {self.reads} round trips, {self.bytes_read} bytes, "\
+            f"{self.read_seconds * 1000:.1f}ms\n"
+        out += f"  register reads: {self.registers}, {self.register_seconds * 1000:.1f}ms\n"
+        out += f"  symbol lookups: {self.symbols}, {self.symbol_seconds * 1000:.1f}ms\n"
+        out += f"  everything else (parsing, decoding, formatting): {other * 1000:.1f}ms\n"
+        out += "read latency:\n"
+        low = 0
+        for bound, count in zip(LATENCY_BUCKETS_US + [None], self.histogram):
+            label = f"{low}-{bound}us" if bound is not None else f">{low}us"
+            out += f"  {label:>14}: {count}\n"
+            low = bound
+        out += "top read call sites:\n"
+        for site, count in self.sites.most_common(top_sites):
+            out += f"  {count:>8} {site}\n"
+        return out
+
+
+class ProfilingBackend(MemoryBackend):
+    """ Time every round trip of another backend into a Profile """
+    def __init__(self, backend, profile):
+        self.backend = backend
+        self.profile = profile
+
+    def read_memory(self, addr, size):
+        start = time.perf_counter()
+        data = self.backend.read_memory(addr, size)
+        self.profile.add_read(size, time.perf_counter() - start)
+        return data
+
+    def read_register(self, name):
+        start = time.perf_counter()
+        try:
+            return self.backend.read_register(name)
+        finally:
+            self.profile.registers += 1
+            self.profile.register_seconds += time.perf_counter() - start
 
+    def read_registers(self, names):
+        """ The wrapped backend fetches them at once, one register read """
+        start = time.perf_counter()
+        try:
+            return self.backend.read_registers(names)
+        finally:
+            self.profile.registers += 1
+            self.profile.register_seconds += time.perf_counter() - start
 
-def execute_get_val(val, size):
+
+# the running profile, None (nothing is counted) outside of xnu-profile
+PROFILE = None
+
+
+def start_profile():
+    global PROFILE
+    PROFILE = Profile()
+    set_backend(ProfilingBackend(BACKEND, PROFILE), flush=False)
+    return PROFILE
+
+
+def stop_profile():
+    global PROFILE
+    if isinstance(BACKEND, ProfilingBackend):
+        set_backend(BACKEND.backend, flush=False)
+    profile = PROFILE
+    PROFILE = None
+    return profile
+
+
+def _read_target_memory(addr, size):
+    return BACKEND.read_memory(addr, size)
+
+
+def read_memory(addr, size, cached=True):
+    """ Read a raw span of target memory.
+    This is the only place where the target memory is accessed,
+    everything else should decode the returned bytes.
+    Spans are served from the page cache when possible, set cached=False
+    for big one-shot reads that should not fill it.
+    """
     try:
-        check_arguments(size)
-        command = f"x /1x{size} {hex(val)}"
-        LOGGER.debug("Going to excute %s ", command)
-        res = gdb.execute(command, to_string=True)
-        res = int(res.split()[1], 0)
-        LOGGER.debug("Got a result %s ", str(res))
-        return res
+        if cached and PAGE_CACHE.enabled:
+            try:
+                return PAGE_CACHE.read(addr, size)
+            except gdb.MemoryError:
+                # some of the pages around the span are not readable,
+                # fall back to read exactly what was asked
+                pass
+        return _read_target_memory(addr, size)
     except Exception:
         raise gdb.GdbError(f"{traceback.format_exc()}")
 
 
+def prefetch(addr_iter, size):
+    """ Warm the page cache with many small spans before decoding them one by one """
+    if PAGE_CACHE.enabled:
+        PAGE_CACHE.prefetch(addr_iter, size)
+
+
+def prefetch_spans(spans):
+    if PAGE_CACHE.enabled:
+        PAGE_CACHE.prefetch_spans(spans)
+
+
+def stop_scoped(func):
+    """ Decorator, remember the results of func for the current stop only """
+    memo = {}
+    PAGE_CACHE.memos.append(memo)
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        if not PAGE_CACHE.enabled:
+            return func(*args)
+        try:
+            return memo[args]
+        except KeyError:
+            result = memo[args] = func(*args)
+            return result
+    return wrapper
+
+
+class lazy_property:
+    """ Decorator, like property but computed on first access only,
+    the value is then kept in the instance and shadows the descriptor
+    """
+    def __init__(self, func):
+        self.func = func
+        functools.update_wrapper(self, func)
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.func.__name__] = self.func(instance)
+        return value
+
+
+def get_8_byte_at(addr):
+    return U64.unpack_from(read_memory(addr, U64.size))[0]
+
+
+def get_4_byte_at(addr):
+    return U32.unpack_from(read_memory(addr, U32.size))[0]
+
+
+def get_string_at(addr):
+    """ Read NULL terminated string, chunk by chunk """
+    res = b""
+    while len(res) < MAX_STRING_LENGTH:
+        # never cross a page boundary, the next page may be unmapped
+        chunk_size = min(STRING_READ_CHUNK, 0x1000 - ((addr + len(res)) & 0xfff))
+        chunk = read_memory(addr + len(res), chunk_size)
+        end = chunk.find(b"\x00")
+        if end != -1:
+            res += chunk[:end]
+            break
+        res += chunk
+    return res.decode("utf-8", errors="replace")
+
+
+def quote_string(value):
+    """ value the way 'x /1s' shows it: quoted, unprintable bytes in octal """
+    out = '"'
+    for char in value:
+        if char in '"\\':
+            out += "\\" + char
+        elif " " <= char <= "~":
+            out += char
+        else:
+            out += "".join(f"\\{byte:03o}" for byte in char.encode("utf-8", errors="replace"))
+    return out + '"'
+
+
 def print_val(var):
     try:
+        if str(var).startswith("$"):
+            # a register, ask the backend
+            return BACKEND.read_register(str(var))
         command = f"print /1x {str(var)}"
-        LOGGER.debug("Going to excute %s ", command)
         res = gdb.execute(command, to_string=True)
-        LOGGER.debug("Got a result %s ", str(res))
         res = int(res.split()[2], 0)
         return res
     except Exception:
         raise gdb.GdbError(traceback.format_exc())
 
 
-def check_arguments(size):
-    return size in ['b', 'h', 'w', 'g']
+def read_registers(names):
+    """ Many registers in one round trip when the backend can, {name: value} """
+    try:
+        return BACKEND.read_registers(names)
+    except Exception:
+        raise gdb.GdbError(traceback.format_exc())
 
 
 def print_ptr_as_string(addr):
@@ -84,3 +457,16 @@ def enable_all_bp():
 
 def disable_all_bp():
     gdb.execute("disable br")
+
+
+# The target may change once it runs or once the user changes it by hand.
+# load.py may reload this module, drop the handlers of the previous instance first.
+for _registry, _handler in globals().get("_CONNECTED_HANDLERS", []):
+    _registry.disconnect(_handler)
+_CONNECTED_HANDLERS = [
+    (gdb.events.cont, PAGE_CACHE.flush),
+    (gdb.events.memory_changed, PAGE_CACHE.flush),
+    (gdb.events.register_changed, PAGE_CACHE.flush),
+]
+for _registry, _handler in _CONNECTED_HANDLERS:
+    _registry.connect(_handler)
@@ -1,46 +1,91 @@
+import struct
+from collections import defaultdict, namedtuple
 import xnu.constants as const
 import xnu.utils as utils
 import xnu.sys_info as sys_info
+from xnu.struct_layout import Field, StructLayout, c_string
+from xnu.export import ptr
 import gdb
 
+try:
+    import numpy
+except ImportError:
+    # tables are then scanned with struct.iter_unpack
+    numpy = None
+
 
 # thread
+ThreadRow = namedtuple("ThreadRow", [
+    "is_current", "is_user", "pid", "name", "tid", "address", "continuation", "next_pc"])
+
+THREAD_LAYOUT = StructLayout("thread", [
+    Field("continuation", const.ThreadOffsets.CONTINUATION.value),
+    Field("task", const.ThreadOffsets.TASK.value),
+    Field("thread_id", const.ThreadOffsets.THREAD_ID.value),
+    Field("context_data", const.ThreadOffsets.CONTEXT_USER_DATA_PTR.value),
+    Field("kstackptr", const.ThreadOffsets.KSTACK_PTR.value),
+    Field("voucher_name", const.ThreadOffsets.VOUCHER_NAME.value, "I"),
+    Field("voucher", const.ThreadOffsets.VOUCHER_PTR.value),
+])
+
+
 class Thread:
+    """ Only the queue links are computed on creation, everything that needs
+    the target memory is read on first access (see utils.lazy_property)
+    """
     def __init__(self, address):
         if address != const.NULL_PTR:
             self.address = address
-            self.task_ptr = utils.get_8_byte_at(
-                address + const.ThreadOffsets.TASK.value)
-            self.tid = utils.get_8_byte_at(
-                address + const.ThreadOffsets.THREAD_ID.value)
-            self.continuation = utils.get_8_byte_at(
-                address + const.ThreadOffsets.CONTINUATION.value)
             self.global_threads_ptr = address + const.ThreadOffsets.GLOBAL_THREADS.value
             self.curr_task_threads_ptr = address + const.ThreadOffsets.TASK_THREADS.value
-            self.ucontext_data = utils.get_8_byte_at(
-                address + const.ThreadOffsets.CONTEXT_USER_DATA_PTR.value)
-            self.kernel_stack_ptr = utils.get_8_byte_at(
-                address + const.ThreadOffsets.KSTACK_PTR.value)
-            self.voucher_ptr = utils.get_8_byte_at(
-                address + const.ThreadOffsets.VOUCHER_PTR.value)
 
             self.initialized = True
-
-            # Meta Data
-            self.next_pc = const.NULL_PTR
-            if self.is_currect():
-                self.next_pc = utils.print_val('$pc')
-            elif self.ucontext_data != const.NULL_PTR:
-                user_saved_state = ThreadSavedState(self.ucontext_data)
-                self.next_pc = user_saved_state.pc
-            elif self.kernel_stack_ptr != const.NULL_PTR:
-                self.next_pc = self.get_kernel_next_pc()
-
-            self.task_object = Task(self.task_ptr)
         else:
             self.initialized = False
             #gdb.write(f"WARNING: null pointer in {__name__}: {self.__class__.__name__}\n")
 
+    @utils.lazy_property
+    def fields(self):
+        return THREAD_LAYOUT.read(self.address)
+
+    @property
+    def task_ptr(self):
+        return self.fields.task
+
+    @property
+    def tid(self):
+        return self.fields.thread_id
+
+    @property
+    def continuation(self):
+        return self.fields.continuation
+
+    @property
+    def ucontext_data(self):
+        return self.fields.context_data
+
+    @property
+    def kernel_stack_ptr(self):
+        return self.fields.kstackptr
+
+    @property
+    def voucher_ptr(self):
+        return self.fields.voucher
+
+    @utils.lazy_property
+    def next_pc(self):
+        if self.is_currect():
+            return utils.print_val('$pc')
+        if self.ucontext_data != const.NULL_PTR:
+            return ThreadSavedState(self.ucontext_data).pc
+        if self.kernel_stack_ptr != const.NULL_PTR:
+            return self.get_kernel_next_pc()
+        return const.NULL_PTR
+
+    @utils.lazy_property
+    def task_object(self):
+        return Task(self.task_ptr)
+
     # we cheating here.
     # the context switch happens in Switch_context function,
     # which is called only from thread_invoke function.
@@ -100,29 +145,85 @@ class Thread:
             kernel_next_pc = pc_from_saved_state
         return kernel_next_pc
 
-    def print_thead_info_short(self, max_length_proc, max_length_cont, max_length_pc):
-        if self.initialized is False:
-            return ""
-
-        res_str = ""
-        is_user = (self.ucontext_data != const.NULL_PTR)
-        is_current = (self.address == sys_info.get_current_thread_ptr())
-        res_str += '*' if is_current else ' '
-        res_str += 'U |' if is_user else 'K |'
+    @utils.lazy_property
+    def process(self):
+        """ (pid, name) of the owning proc, (None, "N/A") without one """
         if self.task_object.initialized is True and\
                 self.task_object.bsdinfo_object.initialized is True:
-            res_str += f" [{self.task_object.bsdinfo_object.bsd_pid}] |"
-            res_str += f" {self.task_object.bsdinfo_object.bsd_name:<{max_length_proc}} |"
+            return self.task_object.bsdinfo_object.bsd_pid, \
+                self.task_object.bsdinfo_object.bsd_name
+        return None, "N/A"
+
+    @utils.lazy_property
+    def kernel_saved_state(self):
+        return ThreadSavedState(self.kernel_stack_ptr)
+
+    @property
+    def kernel_stack_bounds(self):
+        """ (base, top) of the kernel stack. kstackptr points to the thread_kernel_state
+        stored in the last page of the stack, below its top, the base is one
+        KERNEL_STACK_SIZE under the top and the guard page under the base.
+        """
+        top = (self.kernel_stack_ptr & utils.PAGE_MASK) + utils.PAGE_SIZE
+        return top - const.KERNEL_STACK_SIZE, top
+
+    def get_backtrace(self):
+        """ Return addresses of the kernel frames, innermost first, then the user pc
+        for a thread with a user context. The current thread is unwound from the
+        live registers, the others from the state Switch_context saved at
+        kstackptr, whose lr is where the thread resumes. The stack from sp up
+        is read at once and the fp/lr chain is walked in it (see frame_chain).
+        """
+        if self.initialized is False:
+            return []
+        frames = []
+        if self.is_currect():
+            regs = utils.read_registers(["$pc", "$sp", "$x29", "$x30"])
+            frames.append(regs["$pc"])
+            sp, fp, lr = regs["$sp"], regs["$x29"], regs["$x30"]
+            pc_function = sys_info.get_symbols().lookup(regs["$pc"])
+            lr_function = sys_info.get_symbols().lookup(lr)
+            if pc_function is not None and lr_function is not None and \
+                    pc_function[0] == lr_function[0]:
+                # lr is stale, left by a call the function made
+                lr = const.NULL_PTR
+        elif self.kernel_stack_ptr != const.NULL_PTR:
+            regs = self.kernel_saved_state.regs
+            sp, fp, lr = regs.sp, regs.fp, regs.lr
         else:
-            res_str += f" [X] |"
-            res_str += f' {"N/A":<{max_length_proc}} |'
-        res_str += f" {self.tid} | {hex(self.address)} |"
-        res_str += f' {"N/A":^{max_length_cont}} |' if self.continuation == const.NULL_PTR \
-            else f" {sys_info.get_symbol(hex(self.continuation)):^{max_length_cont}} |"
-        res_str += f' {"N/A":^{max_length_pc}} |' if self.next_pc == const.NULL_PTR \
-            else f" {sys_info.get_symbol(hex(self.next_pc)):^{max_length_pc}} |"
-
-        return res_str
+            sp = const.NULL_PTR
+        if sp != const.NULL_PTR:
+            bottom, top = self.kernel_stack_bounds
+            # on another stack (interrupt stack...), only read around sp
+            chain = frame_chain(read_stack(sp, top if bottom <= sp < top else None), sp, fp)
+            # a leaf function did not save lr, its caller is only in the register
+            if lr != const.NULL_PTR and chain[:1] != [lr]:
+                frames.append(lr)
+            frames += chain
+        if self.ucontext_data != const.NULL_PTR:
+            frames.append(ThreadSavedState(self.ucontext_data).pc)
+        return frames
+
+    def get_thread_row(self, current_thread):
+        """ Everything the threads table shows, resolved once """
+        pid, name = self.process
+        continuation = "N/A" if self.continuation == const.NULL_PTR \
+            else sys_info.get_symbol(hex(self.continuation))
+        next_pc = "N/A" if self.next_pc == const.NULL_PTR \
+            else sys_info.get_symbol(hex(self.next_pc))
+        return ThreadRow(self.address == current_thread, sys_info.is_user_thread(self),
+                         pid, name, self.tid, self.address, continuation, next_pc)
+
+    def to_record(self):
+        row = self.get_thread_row(sys_info.get_current_thread_ptr())
+        record = thread_row_record(row)
+        record.update({
+            "task": ptr(self.task_ptr),
+            "context_data": ptr(self.ucontext_data),
+            "kstackptr": ptr(self.kernel_stack_ptr),
+            "voucher": ptr(self.voucher_ptr),
+        })
+        return record
 
     def print_thread_info_long(self):
         if self.initialized is False:
@@ -142,7 +243,7 @@ class Thread:
                 f"{utils.print_ptr_as_string(self.task_object.bsd_info_ptr)}\n"
         if self.task_object.initialized is True:
             res_str += f"thread->task->bsd_info->p_name: "\
-                f"{self.task_object.bsdinfo_object.bsd_name}\n"
+                f"{utils.quote_string(self.task_object.bsdinfo_object.bsd_name)}\n"
             res_str += f"thread->task->bsd_info->p_pid: "\
                 f"{utils.print_ptr_as_string(self.task_object.bsdinfo_object.bsd_pid)}\n"
         res_str += f"thread->thread_id: {str(self.tid)}\n"
@@ -170,13 +271,19 @@ class Thread:
 
 
 # proc
+BSD_INFO_LAYOUT = StructLayout("proc", [
+    Field("p_pid", const.BSDInfoOffsets.PID_IN_BSD_INFO.value, "I"),
+    # inline char array, long enough for both p_comm and p_name
+    Field("p_name", const.BSDInfoOffsets.NAME_INBSD_INFO.value, "33s"),
+])
+
+
 class BsdInfo:
     def __init__(self, address):
         if address != const.NULL_PTR:
-            self.bsd_pid = utils.get_4_byte_at(
-                address + const.BSDInfoOffsets.PID_IN_BSD_INFO.value)
-            self.bsd_name = utils.get_string_at(
-                address + const.BSDInfoOffsets.NAME_INBSD_INFO.value)
+            fields = BSD_INFO_LAYOUT.read(address)
+            self.bsd_pid = fields.p_pid
+            self.bsd_name = c_string(fields.p_name)
             self.initialized = True
         else:
             self.initialized = False
@@ -184,15 +291,20 @@ class BsdInfo:
 
 
 # ipc_space
+IPC_SPACE_LAYOUT = StructLayout("ipc_space", [
+    Field("is_table_size", const.IPCSpaceOffsets.IS_TABLE_SIZE.value, "I"),
+    Field("is_table_free", const.IPCSpaceOffsets.IS_TABLE_FREE.value, "I"),
+    Field("is_table", const.IPCSpaceOffsets.IS_TABLE.value),
+])
+
+
 class IPCSpace:
     def __init__(self, address):
         if address != const.NULL_PTR:
-            self.is_table = utils.get_8_byte_at(
-                address + const.IPCSpaceOffsets.IS_TABLE.value)
-            self.is_table_size = utils.get_4_byte_at(
-                address + const.IPCSpaceOffsets.IS_TABLE_SIZE.value)
-            self.is_table_free = utils.get_4_byte_at(
-                address + const.IPCSpaceOffsets.IS_TABLE_FREE.value)
+            fields = IPC_SPACE_LAYOUT.read(address)
+            self.is_table = fields.is_table
+            self.is_table_size = fields.is_table_size
+            self.is_table_free = fields.is_table_free
             self.initialized = True
         else:
             self.initialized = False
@@ -208,25 +320,46 @@ class IPCSpace:
         return res_str
 
 
+IPC_ENTRY_LAYOUT = StructLayout("ipc_entry", [
+    Field("ie_object", 0x0),
+    Field("ie_bits", const.IPCEntryOffsets.IE_BITS.value, "I"),
+    Field("ie_index", const.IPCEntryOffsets.IE_INDEX.value, "I"),
+    Field("index", const.IPCEntryOffsets.INDEX.value, "I"),  # ie_next / ie_request
+])
+IPC_ENTRY_SIZE = 0x18
+IPC_ENTRY_STRUCT = struct.Struct("<QIII4x")
+if numpy is not None:
+    IPC_ENTRY_DTYPE = numpy.dtype([("ie_object", "<u8"), ("ie_bits", "<u4"),
+                                   ("ie_index", "<u4"), ("index", "<u4"), ("pad", "<u4")])
+
+
 class IPCEntry:
-    def __init__(self, address):
+    def __init__(self, address, fields=None):
+        """ fields - IPC_ENTRY_LAYOUT record, when the entry was already read with its table """
         if address != const.NULL_PTR:
             self.address = address
-            self.ie_object = utils.get_8_byte_at(address)
-            self.ie_bits = utils.get_4_byte_at(
-                address + const.IPCEntryOffsets.IE_BITS.value)
-            self.ie_index = utils.get_4_byte_at(
-                address + const.IPCEntryOffsets.IE_INDEX.value)
-            self.index = utils.get_4_byte_at(
-                address + const.IPCEntryOffsets.INDEX.value)
-
-            if self.ie_object:
-                self.ie_object_object = IPCObject(self.ie_object)
+            if fields is None:
+                fields = IPC_ENTRY_LAYOUT.read(address)
+            self.ie_object, self.ie_bits, self.ie_index, self.index = fields
             self.initialized = True
         else:
             self.initialized = False
             #gdb.write(f"WARNING: null pointer in {__name__}: {self.__class__.__name__}\n")
 
+    @utils.lazy_property
+    def ie_object_object(self):
+        return IPCObject(self.ie_object)
+
+    def to_record(self):
+        return {
+            "entry": ptr(self.address),
+            "ie_object": ptr(self.ie_object),
+            "ie_bits": self.ie_bits,
+            "rights": get_rights_names(self.ie_bits),
+            "ie_index": self.ie_index,
+            "ie_next": self.index,
+        }
+
     def print_ipc_entry_info(self):
         if self.initialized is False:
             return ""
@@ -238,17 +371,19 @@ class IPCEntry:
         return res_str
 
 
+IPC_OBJECT_LAYOUT = StructLayout("ipc_object", [
+    Field("io_bits", 0x0, "I"),
+    Field("io_references", const.IPCObjectOffsets.IO_REFS.value, "I"),
+    Field("io_lock_data_1", const.IPCObjectOffsets.IO_LOCK_DATA.value),
+    Field("io_lock_data_2", const.IPCObjectOffsets.IO_LOCK_DATA.value + 0x08),
+])
+
+
 class IPCObject:
     def __init__(self, address):
         if address != const.NULL_PTR:
-            self.io_bits = utils.get_4_byte_at(
-                address)  # parse it from ipc_object
-            self.io_references = utils.get_4_byte_at(
-                address + const.IPCObjectOffsets.IO_REFS.value)
-            self.io_lock_data_1 = utils.get_8_byte_at(
-                address + const.IPCObjectOffsets.IO_LOCK_DATA.value)
-            self.io_lock_data_2 = utils.get_8_byte_at(
-                address + const.IPCObjectOffsets.IO_LOCK_DATA.value + 0x08)  # next
+            (self.io_bits, self.io_references,
+             self.io_lock_data_1, self.io_lock_data_2) = IPC_OBJECT_LAYOUT.read(address)
             self.initialized = True
         else:
             self.initialized = False
@@ -266,41 +401,58 @@ class IPCObject:
         return res_str
 
 
+IPC_PORT_SPREQ = const.IPCPortOffsets.IP_SPREQ.value
+IPC_PORT_LAYOUT = StructLayout("ipc_port", [
+    Field("ip_messages", const.IPCPortOffsets.IP_MSG.value),
+    Field("data", const.IPCPortOffsets.DATA.value),
+    Field("kdata", const.IPCPortOffsets.KDATA.value),
+    Field("kdata2", const.IPCPortOffsets.KDATA2.value),
+    Field("ip_context", const.IPCPortOffsets.IP_CTXT.value),
+    Field("ip_sprequests", IPC_PORT_SPREQ, "I", mask=(1 << 0)),
+    Field("ip_spimportant", IPC_PORT_SPREQ, "I", mask=(1 << 1)),
+    Field("ip_impdonation", IPC_PORT_SPREQ, "I", mask=(1 << 2)),
+    Field("ip_tempowner", IPC_PORT_SPREQ, "I", mask=(1 << 3)),
+    Field("ip_guarded", IPC_PORT_SPREQ, "I", mask=(1 << 4)),
+    Field("ip_strict_guard", IPC_PORT_SPREQ, "I", mask=(1 << 5)),
+    Field("ip_specialreply", IPC_PORT_SPREQ, "I", mask=(1 << 6)),
+    Field("ip_sync_link_state", IPC_PORT_SPREQ, "I", mask=0x000001ff),
+    Field("ip_impcount", IPC_PORT_SPREQ, "I", mask=0xfffffe00),
+    Field("ip_mscount", const.IPCPortOffsets.IP_MSCNT.value, "I"),
+    Field("ip_srights", const.IPCPortOffsets.IP_SRIGHTS.value, "I"),
+    Field("ip_sorights", const.IPCPortOffsets.IP_SORIGHTS.value, "I"),
+])
+
+
 class IPCPort:
     def __init__(self, address):
         if address != const.NULL_PTR:
+            # the ipc_object header and the port body are on the same page,
+            # the second read is served by the page cache
+            self.address = address
             self.ip_object_object = IPCObject(address)
-            self.ip_messages = utils.get_8_byte_at(
-                address + const.IPCPortOffsets.IP_MSG.value)
-            self.data = utils.get_8_byte_at(
-                address + const.IPCPortOffsets.DATA.value)
-            self.kdata = utils.get_8_byte_at(
-                address + const.IPCPortOffsets.KDATA.value)
-            self.kdata2 = utils.get_8_byte_at(
-                address + const.IPCPortOffsets.KDATA2.value)
-            self.ip_context = utils.get_8_byte_at(
-                address + const.IPCPortOffsets.IP_CTXT.value)
-            four_byte_data = utils.get_4_byte_at(address + const.IPCPortOffsets.IP_SPREQ.value)
-            self.ip_sprequests = (four_byte_data & (1 << 0))
-            self.ip_spimportant = (four_byte_data & (1 << 1))
-            self.ip_impdonation = (four_byte_data & (1 << 2))
-            self.ip_tempowner = (four_byte_data & (1 << 3))
-            self.ip_guarded = (four_byte_data & (1 << 4))
-            self.ip_strict_guard = (four_byte_data & (1 << 5))
-            self.ip_specialreply = (four_byte_data & (1 << 6))
-            self.ip_sync_link_state = (four_byte_data & (0x000001ff))
-            self.ip_impcount = (four_byte_data & (0xfffffe00))
-            self.ip_mscount = utils.get_4_byte_at(
-                address + const.IPCPortOffsets.IP_MSCNT.value)
-            self.ip_srights = utils.get_4_byte_at(
-                address + const.IPCPortOffsets.IP_SRIGHTS.value)
-            self.ip_sorights = utils.get_4_byte_at(
-                address + const.IPCPortOffsets.IP_SORIGHTS.value)
+            (self.ip_messages, self.data, self.kdata, self.kdata2, self.ip_context,
+             self.ip_sprequests, self.ip_spimportant, self.ip_impdonation,
+             self.ip_tempowner, self.ip_guarded, self.ip_strict_guard,
+             self.ip_specialreply, self.ip_sync_link_state, self.ip_impcount,
+             self.ip_mscount, self.ip_srights,
+             self.ip_sorights) = IPC_PORT_LAYOUT.read(address)
             self.initialized = True
         else:
             self.initialized = False
             #gdb.write(f"WARNING: null pointer in {__name__}: {self.__class__.__name__}\n")
 
+    def to_record(self):
+        record = {"port": ptr(self.address)}
+        if self.ip_object_object.initialized is True:
+            record["io_bits"] = self.ip_object_object.io_bits
+            record["io_kotype"] = const.IO_BITS_TYPES[
+                self.ip_object_object.io_bits & const.IO_BITS_KOTYPE]
+            record["io_references"] = self.ip_object_object.io_references
+        for name in IPC_PORT_LAYOUT.record._fields:
+            value = getattr(self, name)
+            record[name] = ptr(value) if name in ("data", "kdata", "kdata2") else value
+        return record
+
     def print_ipc_port_info(self):
         if self.initialized is False:
             return ""
@@ -335,26 +487,60 @@ class IPCPort:
         return res_str
 
 
+TASK_LAYOUT = StructLayout("task", [
+    Field("itk_self", const.TaskOffsets.ITK_SELF.value),
+    Field("itk_space", const.TaskOffsets.IPC_SPACE.value),
+    Field("bsd_info", const.TaskOffsets.BSD_INFO.value),
+])
+
+
 class Task:
     def __init__(self, address):
         if address != const.NULL_PTR:
             self.address = address
             self.task_lst_ptr = address + const.TaskOffsets.TASK_NEXT.value
             self.threads_lst_ptr = address + const.TaskOffsets.THREAD_LST_FROM_TASK.value
-            self.bsd_info_ptr = utils.get_8_byte_at(
-                address + const.TaskOffsets.BSD_INFO.value)
-            self.itk_self = utils.get_8_byte_at(
-                address + const.TaskOffsets.ITK_SELF.value)
-            self.ipc_space = utils.get_8_byte_at(
-                address + const.TaskOffsets.IPC_SPACE.value)
-
-            self.ipc_space_object = IPCSpace(self.ipc_space)
-            self.bsdinfo_object = BsdInfo(self.bsd_info_ptr)
             self.initialized = True
         else:
             self.initialized = False
             #gdb.write(f"WARNING: null pointer in {__name__}: {self.__class__.__name__}\n")
 
+    @utils.lazy_property
+    def fields(self):
+        return TASK_LAYOUT.read(self.address)
+
+    @property
+    def bsd_info_ptr(self):
+        return self.fields.bsd_info
+
+    @property
+    def itk_self(self):
+        return self.fields.itk_self
+
+    @property
+    def ipc_space(self):
+        return self.fields.itk_space
+
+    @utils.lazy_property
+    def ipc_space_object(self):
+        return IPCSpace(self.ipc_space)
+
+    @utils.lazy_property
+    def bsdinfo_object(self):
+        return BsdInfo(self.bsd_info_ptr)
+
+    def to_record(self, current_task=None):
+        bsdinfo = self.bsdinfo_object
+        return {
+            "current": self.address == current_task,
+            "pid": bsdinfo.bsd_pid if bsdinfo.initialized is True else None,
+            "name": bsdinfo.bsd_name if bsdinfo.initialized is True else None,
+            "task": ptr(self.address),
+            "bsd_info": ptr(self.bsd_info_ptr),
+            "itk_self": ptr(self.itk_self),
+            "ipc_space": ptr(self.ipc_space),
+        }
+
     def print_task_info_short(self, max_length_proc):
         if self.initialized is False:
             return ""
@@ -363,7 +549,7 @@ class Task:
         res_str += '*' if is_current else ' '
         if self.bsdinfo_object.initialized is True:
             res_str += f" [{self.bsdinfo_object.bsd_pid:^2}] | "\
-                f"{self.bsdinfo_object.bsd_name:<{max_length_proc}} |"
+                f"{utils.quote_string(self.bsdinfo_object.bsd_name):<{max_length_proc}} |"
         else:
             res_str += f" [{'X':^2}] | {'N/A':<{max_length_proc}} |"
         res_str += f"  {hex(self.address)} "
@@ -376,7 +562,8 @@ class Task:
         res_str = "\n"
         res_str += f"task->bsd_info: {utils.print_ptr_as_string(self.bsd_info_ptr)}\n"
         if self.bsdinfo_object.initialized is True:
-            res_str += f"task->bsd_info->p_name: {self.bsdinfo_object.bsd_name}\n"
+            res_str += f"task->bsd_info->p_name: "\
+                f"{utils.quote_string(self.bsdinfo_object.bsd_name)}\n"
             res_str += f"task->bsd_info->p_pid: {hex(self.bsdinfo_object.bsd_pid)}\n"
         res_str += f"task->itk_self: {utils.print_ptr_as_string(self.itk_self)}\n"
         res_str += f"task->ipc_space: {utils.print_ptr_as_string(self.ipc_space)}\n"
@@ -387,49 +574,25 @@ class Task:
 
 # Saved State
 
+SAVED_STATE_REGISTERS = [f"x{i}" for i in range(29)] + ["fp", "lr", "sp", "pc"]
+# arm_saved_state, skip arm_state_hdr_t ash
+SAVED_STATE_LAYOUT = StructLayout(
+    "arm_saved_state",
+    [Field(reg, 0x08 + 0x08 * i) for i, reg in enumerate(SAVED_STATE_REGISTERS)] + [
+        Field("cpsr", 0x110, "I"),
+        Field("reserved", 0x114, "I"),
+        Field("far", 0x118),
+        Field("esr", 0x120, "I"),
+        Field("exception", 0x124, "I"),
+    ])
+
 
 class ThreadSavedState:
     def __init__(self, address):
         if address != const.NULL_PTR:
-            address += 0x08  # skip arm_state_hdr_t ash at arm_saved_state
-            self._x0 = utils.get_8_byte_at(address)
-            self._x1 = utils.get_8_byte_at(address + 0x08)
-            self._x2 = utils.get_8_byte_at(address + 0x10)
-            self._x3 = utils.get_8_byte_at(address + 0x18)
-            self._x4 = utils.get_8_byte_at(address + 0x20)
-            self._x5 = utils.get_8_byte_at(address + 0x28)
-            self._x6 = utils.get_8_byte_at(address + 0x30)
-            self._x7 = utils.get_8_byte_at(address + 0x38)
-            self._x8 = utils.get_8_byte_at(address + 0x40)
-            self._x9 = utils.get_8_byte_at(address + 0x48)
-            self._x10 = utils.get_8_byte_at(address + 0x50)
-            self._x11 = utils.get_8_byte_at(address + 0x58)
-            self._x12 = utils.get_8_byte_at(address + 0x60)
-            self._x13 = utils.get_8_byte_at(address + 0x68)
-            self._x14 = utils.get_8_byte_at(address + 0x70)
-            self._x15 = utils.get_8_byte_at(address + 0x78)
-            self._x16 = utils.get_8_byte_at(address + 0x80)
-            self._x17 = utils.get_8_byte_at(address + 0x88)
-            self._x18 = utils.get_8_byte_at(address + 0x90)
-            self._x19 = utils.get_8_byte_at(address + 0x98)
-            self._x20 = utils.get_8_byte_at(address + 0xa0)
-            self._x21 = utils.get_8_byte_at(address + 0xa8)
-            self._x22 = utils.get_8_byte_at(address + 0xb0)
-            self._x23 = utils.get_8_byte_at(address + 0xb8)
-            self._x24 = utils.get_8_byte_at(address + 0xc0)
-            self._x25 = utils.get_8_byte_at(address + 0xc8)
-            self._x26 = utils.get_8_byte_at(address + 0xd0)
-            self._x27 = utils.get_8_byte_at(address + 0xd8)
-            self._x28 = utils.get_8_byte_at(address + 0xe0)
-            self._fp = utils.get_8_byte_at(address + 0xe8)
-            self._lr = utils.get_8_byte_at(address + 0xf0)
-            self.sp = utils.get_8_byte_at(address + 0xf8)
-            self.pc = utils.get_8_byte_at(address + 0x100)
-            self._cpsr = utils.get_4_byte_at(address + 0x108)
-            self._reserved = utils.get_4_byte_at(address + 0x10c)
-            self._far = utils.get_8_byte_at(address + 0x110)
-            self._esr = utils.get_4_byte_at(address + 0x118)
-            self._exception = utils.get_4_byte_at(address + 0x11c)
+            self.regs = SAVED_STATE_LAYOUT.read(address)
+            self.sp = self.regs.sp
+            self.pc = self.regs.pc
 
             self.initialized = True
         else:
@@ -440,69 +603,118 @@ class ThreadSavedState:
         if self.initialized is False:
             return ""
         res_str = ""
-        res_str += f"{previous_struct}->x0: {utils.print_ptr_as_string(self._x0)}\n"
-        res_str += f"{previous_struct}->x1: {utils.print_ptr_as_string(self._x1)}\n"
-        res_str += f"{previous_struct}->x2: {utils.print_ptr_as_string(self._x2)}\n"
-        res_str += f"{previous_struct}->x3: {utils.print_ptr_as_string(self._x3)}\n"
-        res_str += f"{previous_struct}->x4: {utils.print_ptr_as_string(self._x4)}\n"
-        res_str += f"{previous_struct}->x5: {utils.print_ptr_as_string(self._x5)}\n"
-        res_str += f"{previous_struct}->x6: {utils.print_ptr_as_string(self._x6)}\n"
-        res_str += f"{previous_struct}->x7: {utils.print_ptr_as_string(self._x7)}\n"
-        res_str += f"{previous_struct}->x8: {utils.print_ptr_as_string(self._x8)}\n"
-        res_str += f"{previous_struct}->x9: {utils.print_ptr_as_string(self._x9)}\n"
-        res_str += f"{previous_struct}->x10: {utils.print_ptr_as_string(self._x10)}\n"
-        res_str += f"{previous_struct}->x11: {utils.print_ptr_as_string(self._x11)}\n"
-        res_str += f"{previous_struct}->x12: {utils.print_ptr_as_string(self._x12)}\n"
-        res_str += f"{previous_struct}->x13: {utils.print_ptr_as_string(self._x13)}\n"
-        res_str += f"{previous_struct}->x14: {utils.print_ptr_as_string(self._x14)}\n"
-        res_str += f"{previous_struct}->x15: {utils.print_ptr_as_string(self._x15)}\n"
-        res_str += f"{previous_struct}->x16: {utils.print_ptr_as_string(self._x16)}\n"
-        res_str += f"{previous_struct}->x17: {utils.print_ptr_as_string(self._x17)}\n"
-        res_str += f"{previous_struct}->x18: {utils.print_ptr_as_string(self._x18)}\n"
-        res_str += f"{previous_struct}->x19: {utils.print_ptr_as_string(self._x19)}\n"
-        res_str += f"{previous_struct}->x20: {utils.print_ptr_as_string(self._x20)}\n"
-        res_str += f"{previous_struct}->x21: {utils.print_ptr_as_string(self._x21)}\n"
-        res_str += f"{previous_struct}->x22: {utils.print_ptr_as_string(self._x22)}\n"
-        res_str += f"{previous_struct}->x23: {utils.print_ptr_as_string(self._x23)}\n"
-        res_str += f"{previous_struct}->x24: {utils.print_ptr_as_string(self._x24)}\n"
-        res_str += f"{previous_struct}->x25: {utils.print_ptr_as_string(self._x25)}\n"
-        res_str += f"{previous_struct}->x26: {utils.print_ptr_as_string(self._x26)}\n"
-        res_str += f"{previous_struct}->x27: {utils.print_ptr_as_string(self._x27)}\n"
-        res_str += f"{previous_struct}->x28: {utils.print_ptr_as_string(self._x28)}\n"
-        res_str += f"{previous_struct}->fp: {utils.print_ptr_as_string(self._fp)}\n"
-        res_str += f"{previous_struct}->lr: {utils.print_ptr_as_string(self._lr)}\n"
-        res_str += f"{previous_struct}->sp: {utils.print_ptr_as_string(self.sp)}\n"
-        res_str += f"{previous_struct}->pc: \
-{sys_info.get_symbol(utils.print_ptr_as_string(self.pc))}\n"
-        res_str += f"{previous_struct}->cpsr: {hex(self._cpsr)}\n"
-        res_str += f"{previous_struct}->reserved: {hex(self._reserved)}\n"
-        res_str += f"{previous_struct}->far: {utils.print_ptr_as_string(self._far)}\n"
-        res_str += f"{previous_struct}->esr: {hex(self._esr)}\n"
-        res_str += f"{previous_struct}->exception: {hex(self._exception)}\n"
+        for name, value in zip(self.regs._fields, self.regs):
+            if name == "pc":
+                value = sys_info.get_symbol(utils.print_ptr_as_string(value))
+            elif name in ("cpsr", "reserved", "esr", "exception"):
+                value = hex(value)
+            else:
+                value = utils.print_ptr_as_string(value)
+            res_str += f"{previous_struct}->{name}: {value}\n"
 
         return res_str
 
+
+# Frame records, {fp, lr} pairs chained by fp, callers higher on the stack
+FRAME_RECORD_STRUCT = struct.Struct("<QQ")
+MAX_FRAMES = 128
+# read above sp when the top of its stack is unknown
+STACK_READ_SIZE = 0x1000
+
+
+def frame_chain(stack, stack_base, fp, max_frames=MAX_FRAMES):
+    """ Return addresses of the frames starting at fp, as long as the records
+    are inside stack (the bytes read at stack_base). Nothing is read here.
+    """
+    frames = []
+    stack_end = stack_base + len(stack) - FRAME_RECORD_STRUCT.size
+    while stack_base <= fp <= stack_end and fp & 0x7 == 0 and len(frames) < max_frames:
+        next_fp, lr = FRAME_RECORD_STRUCT.unpack_from(stack, fp - stack_base)
+        if lr == const.NULL_PTR:
+            break
+        frames.append(lr)
+        if next_fp <= fp:
+            break
+        fp = next_fp
+    return frames
+
+
+def read_stack(sp, top=None, cached=True):
+    """ The stack bytes from sp to top. When top is unknown, up to
+    STACK_READ_SIZE or the end of the page of sp. Empty when unreadable.
+    """
+    if top is not None and sp < top:
+        sizes = [top - sp]
+    else:
+        sizes = [STACK_READ_SIZE, utils.PAGE_SIZE - (sp & ~utils.PAGE_MASK)]
+    for size in sizes:
+        try:
+            return utils.read_memory(sp, size, cached=cached)
+        except gdb.GdbError:
+            continue
+    return b""
+
+
+def collect_backtraces(threads):
+    """ [(thread, frames)] for all the threads. The saved states, then the used
+    part of every kernel stack, are fetched in bulk before any thread is unwound
+    """
+    threads = [thread for thread in threads if thread.initialized]
+    utils.prefetch_spans([(address, SAVED_STATE_LAYOUT.end) for thread in threads
+                          for address in (thread.kernel_stack_ptr, thread.ucontext_data)
+                          if address != const.NULL_PTR])
+    spans = []
+    for thread in threads:
+        if thread.kernel_stack_ptr != const.NULL_PTR and not thread.is_currect():
+            sp = thread.kernel_saved_state.sp
+            bottom, top = thread.kernel_stack_bounds
+            if bottom <= sp < top:
+                spans.append((sp, top - sp))
+    utils.prefetch_spans(spans)
+    return [(thread, thread.get_backtrace()) for thread in threads]
+
 # Voucher
 
 
 #TODO offsets
+VOUCHER_LAYOUT = StructLayout("ipc_voucher", [
+    Field("iv_hash", 0x00, "I"),
+    Field("iv_sum", 0x04, "I"),
+    Field("iv_refs", 0x08, "I"),
+    Field("iv_table_size", 0x0c, "I"),
+    Field("iv_inline_table", 0x10, "I"),  # first of iv_inline_table[]
+    Field("iv_table", 0x30),
+    Field("iv_port", 0x38),
+    Field("iv_hash_link", 0x40),
+])
+
+
 class ThreadVoucher:
     def __init__(self, address):
         if address != const.NULL_PTR:
-            self.iv_hash = utils.get_8_byte_at(address)
-            self.iv_sum = utils.get_8_byte_at(address + 0x04)
-            self.iv_refs = utils.get_8_byte_at(address + 0x08)
-            self.iv_table_size = utils.get_8_byte_at(address + 0x0c)
-            self.iv_inline_table = utils.get_8_byte_at(address + 0x10)
-            self.iv_table = utils.get_8_byte_at(address + 0x30)
-            self.iv_port = utils.get_8_byte_at(address + 0x38)
-            self.iv_hash_link = utils.get_8_byte_at(address + 0x40)
+            (self.iv_hash, self.iv_sum, self.iv_refs, self.iv_table_size,
+             self.iv_inline_table, self.iv_table, self.iv_port,
+             self.iv_hash_link) = VOUCHER_LAYOUT.read(address)
+            self.address = address
 
             self.initialized = True
         else:
             self.initialized = False
             #gdb.write(f"WARNING: null pointer in {__name__}: {self.__class__.__name__}\n")
 
+    def to_record(self):
+        return {
+            "voucher": ptr(self.address),
+            "iv_hash": self.iv_hash,
+            "iv_sum": self.iv_sum,
+            "iv_refs": self.iv_refs,
+            "iv_table_size": self.iv_table_size,
+            "iv_inline_table": self.iv_inline_table,
+            "iv_table": ptr(self.iv_table),
+            "iv_port": ptr(self.iv_port),
+            "iv_hash_link": ptr(self.iv_hash_link),
+        }
+
     def print_voucher_info(self):
         if self.initialized is False:
             return ""
@@ -576,12 +788,38 @@ class TasksIterator:
         raise StopIteration
 
 
+def scan_ipc_table(table, size):
+    """ Fetch the whole is_table in one read and return the used entries as
+    [(index, ie_object, ie_bits, ie_index, next)], filtered by the type bits
+    in one vectorized step when numpy is available
+    """
+    buf = utils.read_memory(table, size * IPC_ENTRY_SIZE)
+    if numpy is not None:
+        entries = numpy.frombuffer(buf, dtype=IPC_ENTRY_DTYPE)
+        used = numpy.flatnonzero(entries["ie_bits"] & const.IE_BITS_TYPE_MASK)
+        entries = entries[used]
+        return list(zip(used.tolist(), entries["ie_object"].tolist(),
+                        entries["ie_bits"].tolist(), entries["ie_index"].tolist(),
+                        entries["index"].tolist()))
+    return [(index,) + entry for index, entry in enumerate(IPC_ENTRY_STRUCT.iter_unpack(buf))
+            if entry[1] & const.IE_BITS_TYPE_MASK]
+
+
 class IPCEntryIterator:
-    def __init__(self, address):
+    """ Used entries of an ipc space.
+    with_objects - also fetch the ipc_object headers of the entries up front,
+    one read per page holding objects
+    """
+    def __init__(self, address, with_objects=True):
         if sys_info.is_valid_ptr(address):
-            self.entry = IPCSpace(address).is_table
-            self.size = IPCSpace(address).is_table_size
+            space = IPCSpace(address)
+            self.entry = space.is_table
+            self.size = space.is_table_size
+            self.used = scan_ipc_table(self.entry, self.size) if self.size else []
             self.index = 0
+            if with_objects:
+                utils.prefetch((used[1] for used in self.used if used[1]),
+                               IPC_OBJECT_LAYOUT.end)
         else:
             raise gdb.GdbError(f"Wrong ipc_entry pointer {address}")
 
@@ -589,48 +827,199 @@ class IPCEntryIterator:
         return self
 
     def __next__(self):
-        while self.index < self.size:
-            result = IPCEntry(self.entry + (self.index * 0x18))
+        if self.index < len(self.used):
+            index, ie_object, ie_bits, ie_index, next_index = self.used[self.index]
             self.index += 1
-            if (result.ie_bits & const.IE_BITS_TYPE_MASK) != 0:
-                return result
+            return IPCEntry(self.entry + (index * IPC_ENTRY_SIZE),
+                            IPC_ENTRY_LAYOUT.record(ie_object, ie_bits, ie_index, next_index))
         raise StopIteration
 
 
+PortRight = namedtuple("PortRight", ["task", "pid", "proc_name", "name", "ie_bits"])
+
+
+def get_rights_names(ie_bits):
+    return "+".join(name for bit, name in const.IE_BITS_RIGHTS if ie_bits & bit)
+
+
+class PortRightsIndex:
+    """ Inverted index of all the ipc spaces of the system:
+    ipc object address -> every (task, port name, rights) holding it
+    """
+    def __init__(self):
+        self.holders = defaultdict(list)
+        self.tasks = 0
+        self.entries = 0
+        for task in iter(TasksIterator()):
+            space = task.ipc_space_object
+            if space.initialized is False or space.is_table_size == 0:
+                continue
+            self.tasks += 1
+            if task.bsdinfo_object.initialized is True:
+                pid, proc_name = task.bsdinfo_object.bsd_pid, task.bsdinfo_object.bsd_name
+            else:
+                pid, proc_name = None, "N/A"
+            for index, ie_object, ie_bits, _, _ in \
+                    scan_ipc_table(space.is_table, space.is_table_size):
+                self.entries += 1
+                if ie_object == const.NULL_PTR:
+                    continue
+                # MACH_PORT_MAKE(index, IE_BITS_GEN(ie_bits))
+                name = (index << 8) | (ie_bits >> const.IE_BITS_GEN_SHIFT)
+                self.holders[ie_object].append(
+                    PortRight(task.address, pid, proc_name, name, ie_bits))
+
+    def get_holders(self, port, right=None):
+        """ Holders of port, only those with the given right name if given """
+        return [holder for holder in self.holders.get(port, [])
+                if right is None or right in get_rights_names(holder.ie_bits).split("+")]
+
+    def get_shared_ports(self, min_tasks=2):
+        """ [(port, holders)] of the objects held by at least min_tasks tasks,
+        most shared first """
+        shared = [(port, holders) for port, holders in self.holders.items()
+                  if len({holder.task for holder in holders}) >= min_tasks]
+        return sorted(shared, key=lambda shared_port: -len(shared_port[1]))
+
+
+@utils.stop_scoped
+def get_port_rights_index():
+    return PortRightsIndex()
+
+
+def port_right_record(port, holder):
+    return {
+        "port": ptr(port),
+        "task": ptr(holder.task),
+        "pid": holder.pid,
+        "name": holder.proc_name,
+        "port_name": holder.name,
+        "rights": get_rights_names(holder.ie_bits),
+    }
+
+
+def print_port_right(holder):
+    pid = "X" if holder.pid is None else holder.pid
+    return f"  [{pid}] {holder.proc_name} task: {hex(holder.task)} "\
+        f"name: {hex(holder.name)} rights: {get_rights_names(holder.ie_bits)}"
+
+
 # Global functions
+@utils.stop_scoped
+def get_queue_addresses(head, next_offset):
+    """ Addresses of all the elements of a kernel queue, following only the links """
+    addresses = set()
+    element = utils.get_8_byte_at(head)
+    while element != head and element not in addresses:
+        addresses.add(element)
+        element = utils.get_8_byte_at(element + next_offset)
+    return frozenset(addresses)
+
+
+def get_task_addresses():
+    return get_queue_addresses(const.GLOBAL_TASKS_PTR, const.TaskOffsets.TASK_NEXT.value)
+
+
+def get_thread_addresses():
+    return get_queue_addresses(const.GLOBAL_THREADS_PTR,
+                               const.ThreadOffsets.GLOBAL_THREADS.value)
+
+
 def is_task_exist(task):
-    return task in list(tmptask.address for tmptask in iter(TasksIterator()))
+    return task in get_task_addresses()
 
 
 def is_thread_exist(thread):
-    return thread in list(tmpthread.address for tmpthread in iter(ThreadsIterator(is_global=True)))
+    return thread in get_thread_addresses()
 
 
 def get_max_length_proc_name():
     max_length = 0
     for task in iter(TasksIterator()):
-        if task.bsdinfo_object.initialized is True and \
-                len(task.bsdinfo_object.bsd_name) > max_length:
-            max_length = len(task.bsdinfo_object.bsd_name)
+        if task.bsdinfo_object.initialized is True:
+            max_length = max(max_length,
+                             len(utils.quote_string(task.bsdinfo_object.bsd_name)))
     return max_length
 
 
-def get_max_length_cont_name():
-    max_length = 0
-    for thread in iter(ThreadsIterator(True)):
-        if len(sys_info.get_symbol(utils.print_ptr_as_string(thread.continuation))) > max_length:
-            max_length = len(sys_info.get_symbol(
-                utils.print_ptr_as_string(thread.continuation)))
-    return max_length
+def iter_thread_rows(is_global=False, task=None, user_only=False):
+    """ Walk the threads queue once, yield the rows of the table """
+    current_thread = sys_info.get_current_thread_ptr()
+    for thread in iter(ThreadsIterator(is_global, task)):
+        if user_only is False or sys_info.is_user_thread(thread):
+            yield thread.get_thread_row(current_thread)
 
 
-def get_max_length_pc_name():
-    max_length = 0
-    for thread in iter(ThreadsIterator(True)):
-        if len(sys_info.get_symbol(utils.print_ptr_as_string(thread.next_pc))) > max_length:
-            max_length = len(sys_info.get_symbol(
-                utils.print_ptr_as_string(thread.next_pc)))
-    return max_length
+def collect_thread_rows(is_global=False, task=None, user_only=False):
+    """ The table needs its widths, so here the rows are kept """
+    return list(iter_thread_rows(is_global, task, user_only))
+
+
+def thread_row_record(row):
+    return {
+        "current": row.is_current,
+        "user": row.is_user,
+        "pid": row.pid,
+        "name": row.name,
+        "tid": row.tid,
+        "thread": ptr(row.address),
+        "continuation": row.continuation,
+        "next_pc": row.next_pc,
+    }
+
+
+def frame_symbol(addr):
+    if not sys_info.is_kernel_address(addr):
+        return f"{hex(addr)} (user)"
+    return sys_info.get_symbol(hex(addr))
+
+
+def backtrace_record(thread, frames):
+    pid, name = thread.process
+    return {
+        "thread": ptr(thread.address),
+        "tid": thread.tid,
+        "pid": pid,
+        "name": name,
+        "frames": ";".join(frame_symbol(addr) for addr in frames),
+    }
+
+
+def print_backtrace(frames):
+    res_str = ""
+    for i, addr in enumerate(frames):
+        res_str += f"  #{i:<3} {utils.print_ptr_as_string(addr)}"
+        if not sys_info.is_kernel_address(addr):
+            res_str += " (user)"
+        elif sys_info.get_symbol(hex(addr)) != hex(addr):
+            res_str += f" {sys_info.get_symbol(hex(addr))}"
+        res_str += "\n"
+    return res_str
+
+
+def row_name_text(row):
+    """ The process name as the table shows it, quoted like gdb prints strings """
+    return row.name if row.pid is None else utils.quote_string(row.name)
+
+
+def get_thread_rows_widths(rows):
+    """ Widths of the NAME, CONTINUATION and NEXT_PC* columns """
+    max_length_proc = max((len(row_name_text(row)) for row in rows), default=0)
+    max_length_cont = max((len(row.continuation) for row in rows), default=0)
+    max_length_pc = max((len(row.next_pc) for row in rows), default=0)
+    return max_length_proc, max_length_cont, max_length_pc
+
+
+def print_thread_row(row, max_length_proc, max_length_cont, max_length_pc):
+    res_str = ""
+    res_str += '*' if row.is_current else ' '
+    res_str += 'U |' if row.is_user else 'K |'
+    res_str += f" [X] |" if row.pid is None else f" [{row.pid}] |"
+    res_str += f" {row_name_text(row):<{max_length_proc}} |"
+    res_str += f" {row.tid} | {hex(row.address)} |"
+    res_str += f" {row.continuation:^{max_length_cont}} |"
+    res_str += f" {row.next_pc:^{max_length_pc}} |"
+    return res_str
 
 
 def get_thead_info_title(max_length_proc, max_length_cont, max_length_pc):
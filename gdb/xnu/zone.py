@@ -1,5 +1,10 @@
+import traceback
+from collections import namedtuple
 import xnu.utils as utils
 import xnu.sys_info as sys_info
+import xnu.export as export
+from xnu.struct_layout import Field, StructLayout
+from xnu.export import ptr
 import gdb
 
 
@@ -7,12 +12,23 @@ class StructZone(object):
     zone_globals_16B92 = {
         "max_zones": 0xfffffff00763df48,
         "zone_array": 0xfffffff007624ef0,
-        "zone_struct_size": 0x140
+        "zone_struct_size": 0x140,
+        "page_size": 0x4000,
+        # resolved through the symbols (sys_info.get_symbol_address)
+        "zone_map_min_address": "zone_map_min_address",
+        "zone_metadata_region_min": "zone_metadata_region_min",
     }
     # TODO: support more versions
     globs = zone_globals_16B92
 
     struct_offsets_16B92 = {
+        "free_elements": 0x0,
+        "pages_any_free_foreign": 0x8,
+        "pages_all_free": 0x18,
+        "pages_intermediate": 0x28,
+        "pages_all_used": 0x38,
+        "count": 0x48,
+        "countfree": 0x4c,
         "zone_name": 0x118,
         "index": 0x114,
         "flags": 0x110,
@@ -26,21 +42,35 @@ class StructZone(object):
         "cur_size": 0xe0
     }
 
-    def __init__(self, addr):
+    def __init__(self, addr, fields=None):
+        """ fields - ZONE_LAYOUT record, when the zone was already read in bulk """
         # TODO: support more versions
         self.offsets = StructZone.struct_offsets_16B92
         self.globals = StructZone.zone_globals_16B92
         self.addr = addr
-        self.cur_size = utils.get_8_byte_at(addr + self.offsets["cur_size"])
-        self.max_size = utils.get_8_byte_at(addr + self.offsets["max_size"])
-        self.elem_size = utils.get_8_byte_at(addr + self.offsets["elem_size"])
-        self.alloc_size = utils.get_8_byte_at(addr + self.offsets["alloc_size"])
-        self.page_count = utils.get_8_byte_at(addr + self.offsets["page_count"])
-        self.sum_count = utils.get_8_byte_at(addr + self.offsets["sum_count"])
-        self.flags = utils.get_4_byte_at(addr + self.offsets["flags"])
-        self.index = utils.get_4_byte_at(addr + self.offsets["index"])
-        name_ptr = utils.get_8_byte_at(addr + self.offsets["zone_name"])
-        self.zone_name = utils.get_string_at(name_ptr)
+        if fields is None:
+            fields = ZONE_LAYOUT.read(addr)
+        (self.count, self.countfree, self.cur_size, self.max_size, self.elem_size,
+         self.alloc_size, self.page_count, self.sum_count, self.flags, self.index,
+         name_ptr) = fields
+        self.zone_name = get_zone_name(name_ptr)
+
+    def to_record(self, i=None):
+        return {
+            "zone": ptr(self.addr),
+            "array_index": i,
+            "index": self.index,
+            "zone_name": self.zone_name,
+            "elem_size": self.elem_size,
+            "flags": self.flags,
+            "count": self.count,
+            "countfree": self.countfree,
+            "sum_count": self.sum_count,
+            "page_count": self.page_count,
+            "alloc_size": self.alloc_size,
+            "max_size": self.max_size,
+            "cur_size": self.cur_size,
+        }
 
     def is_valid(self):
         shift = self.offsets["flags_valid_shift"]
@@ -60,6 +90,222 @@ class StructZone(object):
     def get_struct_size(cls):
         return cls.globs["zone_struct_size"]
 
+    @classmethod
+    def get_page_size(cls):
+        return cls.globs["page_size"]
+
+    @classmethod
+    def get_global_value(cls, name):
+        """ 8 byte kernel global, located by its symbol """
+        address = sys_info.get_symbol_address(cls.globs[name])
+        if address is None:
+            raise gdb.GdbError(f"Symbol {cls.globs[name]} is missing, "
+                               f"add it to SymbolsNew or KnownLables")
+        return utils.get_8_byte_at(address)
+
+    @classmethod
+    def iter_valid_zones(cls):
+        """ Read the whole zone_array at once and yield (index, zone) of the valid ones.
+        Only the valid zones are decoded and only their names are read.
+        """
+        zone_arr_addr = cls.get_zone_array()
+        max_zones = utils.get_4_byte_at(cls.get_max_zones())
+        struct_size = cls.get_struct_size()
+        zone_array = utils.read_memory(zone_arr_addr, max_zones * struct_size)
+
+        # flags column of all the zones in one strided view of the buffer
+        # (host and target are both little endian)
+        flags_offset = cls.struct_offsets_16B92["flags"]
+        valid_bit = cls.struct_offsets_16B92["flags_valid_mask"] << \
+            cls.struct_offsets_16B92["flags_valid_shift"]
+        all_flags = memoryview(zone_array).cast('I')[flags_offset // 4::struct_size // 4]
+        valid_indexes = [i for i, flags in enumerate(all_flags) if flags & valid_bit]
+
+        for i in valid_indexes:
+            fields = ZONE_LAYOUT.unpack_from(zone_array, i * struct_size)
+            yield i, cls(zone_arr_addr + (struct_size * i), fields)
+
+
+# TODO: support more versions
+ZONE_LAYOUT = StructLayout("zone", [
+    Field(name, StructZone.struct_offsets_16B92[name], fmt) for name, fmt in [
+        ("count", "I"),
+        ("countfree", "I"),
+        ("cur_size", "Q"),
+        ("max_size", "Q"),
+        ("elem_size", "Q"),
+        ("alloc_size", "Q"),
+        ("page_count", "Q"),
+        ("sum_count", "Q"),
+        ("flags", "I"),
+        ("index", "I"),
+        ("zone_name", "Q"),
+    ]])
+
+
+# xnu kernel ref: darwin-xnu/osfmk/kern/zalloc.c (zone_page_metadata)
+ZONE_PAGE_METADATA_SIZE = 0x18
+ZONE_PAGE_METADATA_LAYOUT = StructLayout("zone_page_metadata", [
+    Field("next", 0x00),
+    Field("prev", 0x08),
+    Field("freelist_offset", 0x10, "I"),
+    Field("free_count", 0x14, "I", 0, 0xffff),
+    Field("zindex", 0x14, "I", 16, 0x3ff),
+    Field("page_count", 0x14, "I", 26, 0x1f),
+])
+PAGE_METADATA_EMPTY_FREELIST = 0xffffffff
+ZONE_PAGE_QUEUES = ["any_free_foreign", "all_free", "intermediate", "all_used"]
+
+
+class ZoneWalker:
+    """ Walk the pages of a zone, and the free list of each page.
+    Pages are read one allocation chunk at a time and never kept,
+    so the memory used does not depend on the size of the zone.
+    """
+    def __init__(self, zone):
+        self.zone = zone
+        self.page_size = StructZone.get_page_size()
+        self.zone_map_min = StructZone.get_global_value("zone_map_min_address")
+        self.metadata_min = StructZone.get_global_value("zone_metadata_region_min")
+
+    def iter_page_metadata(self):
+        """ yield (queue, metadata address, ZONE_PAGE_METADATA_LAYOUT record) """
+        for queue in ZONE_PAGE_QUEUES:
+            head = self.zone.addr + self.zone.offsets[f"pages_{queue}"]
+            seen = set()
+            meta = utils.get_8_byte_at(head)
+            while meta not in (head, 0) and meta not in seen:
+                seen.add(meta)
+                fields = ZONE_PAGE_METADATA_LAYOUT.read(meta)
+                yield queue, meta, fields
+                meta = fields.next
+
+    def get_page_address(self, queue, meta):
+        """ Address of the chunk and offset of its first element """
+        if queue == "any_free_foreign":
+            # foreign pages carry their metadata in the page itself
+            return meta & ~(self.page_size - 1), ZONE_PAGE_METADATA_SIZE
+        index = (meta - self.metadata_min) // ZONE_PAGE_METADATA_SIZE
+        return self.zone_map_min + index * self.page_size, 0
+
+    def walk_chunk(self, queue, meta, fields):
+        """ Read the chunk once, walk its free list inside the buffer.
+        Returns (ZoneChunk, set of free element offsets)
+        """
+        page, first = self.get_page_address(queue, meta)
+        chunk_size = max(fields.page_count, 1) * self.page_size
+        elem_size = self.zone.elem_size
+        total = (chunk_size - first) // elem_size if elem_size else 0
+        free = set()
+        broken = False
+        # nothing to walk on a full page
+        if fields.free_count and fields.freelist_offset != PAGE_METADATA_EMPTY_FREELIST:
+            buf = utils.read_memory(page, chunk_size, cached=False)
+            offset = fields.freelist_offset
+            while len(free) <= total:
+                if offset < first or offset + 8 > chunk_size or \
+                        (offset - first) % elem_size or offset in free:
+                    broken = True
+                    break
+                free.add(offset)
+                next_elem = utils.U64.unpack_from(buf, offset)[0]
+                if next_elem == 0:
+                    break
+                offset = next_elem - page
+        return ZoneChunk(queue, meta, page, first, total, fields.free_count, len(free), broken), free
+
+    def walk(self):
+        """ yield (ZoneChunk, free offsets) for every chunk of the zone """
+        for queue, meta, fields in self.iter_page_metadata():
+            yield self.walk_chunk(queue, meta, fields)
+
+
+ZoneChunk = namedtuple("ZoneChunk", [
+    "queue", "meta", "page", "first", "total", "free_count", "free_walked", "broken"])
+
+
+def zone_element_record(zone, chunk, offset, is_free):
+    return {
+        "zone": zone.zone_name,
+        "queue": chunk.queue,
+        "page": ptr(chunk.page),
+        "meta": ptr(chunk.meta),
+        "element": ptr(chunk.page + offset),
+        "free": is_free,
+        "broken": chunk.broken,
+    }
+
+
+class ZoneStats:
+    """ Occupancy of a zone, accumulated chunk by chunk """
+    def __init__(self, zone):
+        self.zone = zone
+        self.pages = {queue: 0 for queue in ZONE_PAGE_QUEUES}
+        self.total = 0
+        self.free = 0
+        self.free_walked = 0
+        self.partial_total = 0
+        self.partial_free = 0
+        self.broken = 0
+
+    def add(self, chunk):
+        self.pages[chunk.queue] += 1
+        self.total += chunk.total
+        self.free += chunk.free_count
+        self.free_walked += chunk.free_walked
+        self.broken += chunk.broken
+        if chunk.free_count < chunk.total:
+            # pages holding allocations, their free slots can not be given back
+            self.partial_total += chunk.total
+            self.partial_free += chunk.free_count
+
+    @property
+    def allocated(self):
+        return self.total - self.free
+
+    @property
+    def fragmentation(self):
+        return (100.0 * self.partial_free / self.partial_total) if self.partial_total else 0.0
+
+    def to_record(self):
+        record = {
+            "zone": ptr(self.zone.addr),
+            "index": self.zone.index,
+            "zone_name": self.zone.zone_name,
+            "elem_size": self.zone.elem_size,
+        }
+        record.update({f"pages_{queue}": count for queue, count in self.pages.items()})
+        record.update({
+            "elements": self.total,
+            "allocated": self.allocated,
+            "free": self.free,
+            "count": self.zone.count,
+            "countfree": self.zone.countfree,
+            "free_walked": self.free_walked,
+            "broken": self.broken,
+            "fragmentation": round(self.fragmentation, 2),
+        })
+        return record
+
+    def format(self):
+        pages = ", ".join(f"{queue}: {count}" for queue, count in self.pages.items())
+        out = f"zone {self.zone.index} {self.zone.zone_name} (elem_size {self.zone.elem_size})\n"
+        out += f"        pages: {pages}\n"
+        out += f"        elements: {self.total}, allocated: {self.allocated}, free: {self.free}\n"
+        out += f"        zone counters: count {self.zone.count}, countfree {self.zone.countfree}\n"
+        out += f"        free list walked: {self.free_walked}"
+        out += f", broken free lists: {self.broken}\n" if self.broken else "\n"
+        out += f"        fragmentation: {self.fragmentation:.1f}% of the slots in pages "\
+            f"holding allocations are free\n"
+        return out
+
+
+# zone names are static, share them between all commands of the stop
+get_zone_name = utils.stop_scoped(utils.get_string_at)
+
+# write the output every that many zones
+ZONES_PER_WRITE = 32
+
 
 class PrintZoneInformationCommand(gdb.Command):
     def __init__(self):
@@ -67,37 +313,115 @@ class PrintZoneInformationCommand(gdb.Command):
               self).__init__("xnu-zones", gdb.COMMAND_DATA)
 
     def invoke(self, arg, from_tty):
+        """ xnu-zones [--format jsonl/csv] [--out ${FILE}] """
         if sys_info.is_in_kernel_space() is False:
             gdb.write("\nYou are currently in user space, "\
                 "this functionality is not available here.\n\n")
             return         
-        self.print_zones()
+        try:
+            _, writer = export.parse_export_args(gdb.string_to_argv(arg))
+            if writer is not None:
+                with writer:
+                    writer.write_all(zone.to_record(i) for i, zone in StructZone.iter_valid_zones())
+                return
+            self.print_zones()
+        except Exception:
+            raise gdb.GdbError(traceback.format_exc())
 
     def print_zones(self):
         zone_arr_addr = StructZone.get_zone_array()
         max_zones_addr = StructZone.get_max_zones()
         max_zones = utils.get_4_byte_at(max_zones_addr)
-        struct_size = StructZone.get_struct_size()
         out = "Printing zones info:\n"
         out += f"zone_arr_addr: 0x{zone_arr_addr:016x}\n"
         out += f"max_zones: {max_zones}\n"
         gdb.write(out)
-        for i in range(max_zones):
-            zone_addr = zone_arr_addr + (struct_size * i)
-            zone = StructZone(zone_addr)
-            if (not zone.is_valid()):
-                continue
-            out = f"Valid zone at 0x{zone_addr:016x} at index {i}\n"
-            out += f"        zone_name: {zone.zone_name}\n"
-            out += f"        elem_size: {zone.elem_size}\n"
-            out += f"        index: {zone.index}\n"
-            out += f"        flags: 0x{zone.flags:08x}\n"
-            out += f"        sum_count: {zone.sum_count}\n"
-            out += f"        page_count: {zone.page_count}\n"
-            out += f"        alloc_size: 0x{zone.alloc_size:016x}\n"
-            out += f"        max_size: 0x{zone.max_size:016x}\n"
-            out += f"        cur_size: 0x{zone.cur_size:016x}\n"
-            gdb.write(out)
+        chunk = []
+        for i, zone in StructZone.iter_valid_zones():
+            chunk.append(self.format_zone(i, zone))
+            if len(chunk) == ZONES_PER_WRITE:
+                gdb.write("".join(chunk))
+                chunk = []
+        gdb.write("".join(chunk))
+
+    @staticmethod
+    def format_zone(i, zone):
+        out = f"Valid zone at 0x{zone.addr:016x} at index {i}\n"
+        out += f"        zone_name: {utils.quote_string(zone.zone_name)}\n"
+        out += f"        elem_size: {zone.elem_size}\n"
+        out += f"        index: {zone.index}\n"
+        out += f"        flags: 0x{zone.flags:08x}\n"
+        out += f"        sum_count: {zone.sum_count}\n"
+        out += f"        page_count: {zone.page_count}\n"
+        out += f"        alloc_size: 0x{zone.alloc_size:016x}\n"
+        out += f"        max_size: 0x{zone.max_size:016x}\n"
+        out += f"        cur_size: 0x{zone.cur_size:016x}\n"
+        return out
 
 
 PrintZoneInformationCommand()
+
+
+class ZoneWalkCommand(gdb.Command):
+    """ gdb command to walk the pages and free lists of zones
+    xnu kernel ref: darwin-xnu/osfmk/kern/zalloc.c
+    """
+    def __init__(self):
+        super(ZoneWalkCommand, self).__init__("xnu-zone-walk", gdb.COMMAND_DATA)
+
+    def invoke(self, arg, from_tty):
+        """ xnu-zone-walk ${ZONE_INDEX}/${ZONE_NAME}/all [-elements]
+        [--format jsonl/csv] [--out ${FILE}] - one record per zone, or per element
+        with -elements
+        """
+        if sys_info.is_in_kernel_space() is False:
+            gdb.write("\nYou are currently in user space, "
+                      "this functionality is not available here.\n\n")
+            return
+        try:
+            argv, writer = export.parse_export_args(gdb.string_to_argv(arg))
+            elements = "-elements" in argv
+            argv = [argument for argument in argv if argument != "-elements"]
+            if len(argv) != 1:
+                gdb.write("\nUsage: xnu-zone-walk ${ZONE_INDEX}/${ZONE_NAME}/all [-elements]\n")
+                return
+            zones = [zone for i, zone in StructZone.iter_valid_zones()
+                     if argv[0] in ("all", zone.zone_name) or argv[0] == str(i)]
+            if not zones:
+                gdb.write(f"No valid zone {argv[0]}\n")
+            elif writer is None:
+                for zone in zones:
+                    self.walk_zone(zone, elements)
+            else:
+                with writer:
+                    for zone in zones:
+                        self.walk_zone(zone, elements, writer)
+        except Exception:
+            raise gdb.GdbError(traceback.format_exc())
+
+    @staticmethod
+    def walk_zone(zone, elements, writer=None):
+        """ Output is written chunk by chunk, nothing is kept but the counters """
+        stats = ZoneStats(zone)
+        for chunk, free in ZoneWalker(zone).walk():
+            stats.add(chunk)
+            if elements and writer is not None:
+                for k in range(chunk.total):
+                    offset = chunk.first + k * zone.elem_size
+                    writer.write(zone_element_record(zone, chunk, offset, offset in free))
+            elif elements:
+                out = f"{chunk.queue} page 0x{chunk.page:016x} meta 0x{chunk.meta:016x} "\
+                    f"free {chunk.free_count}/{chunk.total}"
+                out += " BROKEN FREE LIST\n" if chunk.broken else "\n"
+                for k in range(chunk.total):
+                    offset = chunk.first + k * zone.elem_size
+                    out += f"    0x{chunk.page + offset:016x} "\
+                        f"{'free' if offset in free else 'allocated'}\n"
+                gdb.write(out)
+        if writer is None:
+            gdb.write(stats.format())
+        elif not elements:
+            writer.write(stats.to_record())
+
+
+ZoneWalkCommand()